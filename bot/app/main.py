@@ -1,13 +1,65 @@
 #!/usr/bin/env python3
 
 import logging
+import logging.handlers
 from dotenv import load_dotenv
 import os
+import mmap
+import tempfile
+import sys
+import json
+import queue
+import hashlib
+import importlib
 from telegram import Update, ForceReply, BotCommand, BotCommandScopeChat, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler
+from telegram.error import RetryAfter, BadRequest, NetworkError, TelegramError
 import re
-import paramiko
-import psycopg2
+import time
+import array
+import zlib
+import bisect
+import heapq
+import codecs
+import select
+import random
+import contextlib
+import collections
+import http.server
+import itertools
+import threading
+import secrets
+import http.client
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+class lazy_module:
+    """Модуль, загружаемый при первом обращении к атрибуту.
+    paramiko и psycopg2 импортируются долго, а нужны только при подключении"""
+
+    def __getattr__(self, name):
+        """Загрузка модуля и получение атрибута (или подмодуля - psycopg2.pool)
+
+        :param name: имя атрибута
+        """
+        module=importlib.import_module(self.__name)
+        try:
+            value=getattr(module, name)
+        except AttributeError:
+            value=importlib.import_module(f"{self.__name}.{name}")
+        # следующие обращения - без __getattr__
+        setattr(self, name, value)
+        return value
+
+    def __init__(self, name: str):
+        """Инициализация
+
+        :param name: имя модуля
+        """
+        self.__name=name
+
+paramiko=lazy_module("paramiko")
+psycopg2=lazy_module("psycopg2")
 
 class config:
     """Конфигурация приложения"""
@@ -16,9 +68,34 @@ class config:
     log_level="NOTSET"
     # файл журнала
     log_file=None
+    # формат журнала: text или json (JSON lines с полями user, command, duration)
+    log_format="text"
+    # ротация файла журнала по размеру, байт (0 - без ротации), и количество старых файлов
+    log_max_bytes=10*1024*1024
+    log_backups=5
+    # доля сохраняемых DEBUG-записей каждого вида (1 - все)
+    log_debug_sample=1.0
 
     # токен бота
     token=None
+    # адрес Bot API (None - api.telegram.org), например локальный сервер Bot API
+    telegram_api_url=None
+    # режим получения обновлений: polling или webhook
+    bot_mode="polling"
+    # потоков диспетчера telegram
+    bot_workers=4
+    # webhook: адрес и порт локального HTTP-сервера
+    webhook_listen="0.0.0.0"
+    webhook_port=8443
+    # webhook: внешний адрес, по которому Telegram доступен локальный сервер (https://host:port)
+    webhook_url=None
+    # webhook: секретная часть пути (None - случайная при каждом запуске)
+    webhook_secret=None
+    # webhook: максимум одновременных подключений Telegram
+    webhook_max_connections=40
+    # файл с хэшем меню команд: при совпадении меню в Telegram не обновляется
+    # (None - во временном каталоге, сохраняется при перезапуске контейнера)
+    menu_hash_file=None
 
     #ssh-хост
     ssh_host=None
@@ -28,6 +105,37 @@ class config:
     ssh_user=None
     #ssh пароль
     ssh_pass=None
+    #ssh ключ (путь к файлу) и пароль к нему
+    ssh_key=None
+    ssh_key_pass=None
+    # количество ssh-подключений в пуле
+    ssh_pool_size=2
+    # максимум одновременных каналов на одно подключение
+    ssh_channels=4
+    # интервал keepalive, секунд
+    ssh_keepalive=30
+    # таймаут подключения, секунд
+    ssh_timeout=10
+    # ожидание свободного канала, секунд
+    ssh_channel_wait=30
+    # интервал проверки подключений, секунд
+    ssh_health_interval=60
+    # попыток переподключения
+    ssh_reconnect_tries=5
+    # кодировка вывода удаленных команд
+    ssh_charset="utf-8"
+    # максимальный размер вывода одной команды, байт
+    ssh_max_output=10*1024*1024
+    # дополнительные хосты: имя - (пользователь, хост, порт); основной хост - под именем SSH_HOST
+    ssh_hosts={}
+    # группы хостов: имя - список имен хостов (группа all - все хосты)
+    ssh_groups={}
+    # одновременных команд при запуске на группе хостов
+    ssh_fanout=8
+    # ограничение времени команды на одном хосте группы, секунд
+    ssh_host_timeout=30
+    # хост группы после ошибки считается недоступным, секунд
+    ssh_host_backoff=60
 
     # параметры подключения к базе данных
     db_host=None
@@ -36,6 +144,90 @@ class config:
     db_password=None
     db_database=None
     db_schema="public"
+    # размер пула подключений к БД
+    db_pool_min=1
+    db_pool_max=8
+    # таймаут подключения к БД, секунд
+    db_timeout=5
+    # реплика для чтения (необязательно)
+    db_replica_host=None
+    db_replica_port=5432
+    # допустимое отставание реплики, секунд
+    db_replica_max_lag=5
+
+    # постраничный вывод: страниц в памяти на пользователя
+    more_pages=2
+    # постраничный вывод: максимум пользователей с незавершенным выводом
+    more_users=200
+    # постраничный вывод: время жизни незавершенного вывода, секунд
+    more_ttl=600
+    # постраничный вывод: лимит остатка вывода во временном файле на пользователя, байт
+    more_spool=16*1024*1024
+
+    # хранилище сессий: memory или postgres (переживает перезапуск, общее для нескольких ботов)
+    session_backend="memory"
+    # время жизни сессии (данные для кнопки сохранения), секунд
+    session_ttl=3600
+    # общий лимит памяти сессий, байт
+    session_memory=64*1024*1024
+    # общий лимит количества сессий
+    session_items=10000
+
+    # снимки вывода команд для режима diff: лимит памяти, байт, и время жизни, секунд
+    snapshot_memory=16*1024*1024
+    snapshot_ttl=3600
+
+    # ограничение времени поиска email/телефонов в одном тексте, секунд
+    extract_timeout=2
+    # максимальный размер файла для поиска, байт (лимит Bot API на скачивание - 20 МБ)
+    extract_max_file=20*1024*1024
+    # каталог временных файлов поиска - только для бота (создается с правами 0700)
+    tmp_dir=os.path.join(tempfile.gettempdir(), "laxian-key")
+    # общий лимит временных файлов поиска, байт
+    extract_tmp_max=200*1024*1024
+
+    # интервал проверки изменений списка пакетов, секунд
+    apt_index_check=60
+
+    # время жизни курсоров журналов и подписок без обращений, секунд
+    log_cursor_ttl=7*86400
+    # максимум новых записей журнала за один запрос
+    log_max_entries=500
+    # интервал проверки журналов для подписанных чатов, секунд (0 - отключено)
+    follow_interval=30
+
+    # интервал фонового замера free/uptime/mpstat, секунд (0 - отключено)
+    collect_interval=60
+    # хосты замера: хост, группа или список через запятую
+    collect_target="all"
+    # срок хранения замеров, дней
+    collect_retention=7
+
+    # порт метрик Prometheus (None - отключено) и адрес прослушивания
+    metrics_port=None
+    metrics_listen="127.0.0.1"
+
+    # допуск удаленных команд: пополнение токенов пользователя в секунду и размер ведра
+    admit_rate=0.5
+    admit_burst=6
+    # общая нагрузка одновременных удаленных команд (сумма стоимостей)
+    admit_capacity=8
+    # максимальное ожидаемое время в очереди, секунд (дольше - отказ)
+    admit_max_wait=60
+    # максимум команд, ожидающих в очереди (None - половина пула обработчиков,
+    # остальные потоки остаются для обработчиков БД)
+    admit_max_waiting=None
+
+    # отправка сообщений: потоков, сообщений в секунду на чат и всего (лимиты Telegram - 1 и 30)
+    send_workers=4
+    send_chat_rate=1.0
+    send_chat_burst=3
+    send_global_rate=25.0
+
+    # размер пула обработчиков (SSH, БД)
+    workers=8
+    # максимальное количество задач в очереди пула
+    workers_queue=100
 
     """Параметры приложения"""
     def __init__(self):
@@ -47,9 +239,39 @@ class config:
         if not self.log_level in ["NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]:
             raise BaseException(f"Неизвестный уровень логирования - {self.log_level}")
         self.log_file=os.environ.get("LOGFILE", default=None)
+        self.log_format=os.environ.get("LOG_FORMAT", default=self.log_format)
+        if not self.log_format in ["text", "json"]:
+            raise BaseException(f"Неизвестный формат журнала - {self.log_format}")
+        try:
+            self.log_max_bytes=int(os.environ.get("LOG_MAX_BYTES", default=self.log_max_bytes))
+            self.log_backups=int(os.environ.get("LOG_BACKUPS", default=self.log_backups))
+            self.log_debug_sample=float(os.environ.get("LOG_DEBUG_SAMPLE", default=self.log_debug_sample))
+        except ValueError: raise BaseException("Параметры журнала должны быть числами")
         # токен бота
         try: self.token = os.environ["TOKEN"]
         except KeyError: raise BaseException("Требуется api-ключ бота")
+        self.telegram_api_url=os.environ.get("TELEGRAM_API_URL", default=self.telegram_api_url)
+        self.menu_hash_file=os.environ.get("MENU_HASH_FILE",
+                                           default=os.path.join(tempfile.gettempdir(), f"bot_menu_{self.token.split(':')[0]}.sha256"))
+        # режим получения обновлений
+        self.bot_mode=os.environ.get("BOT_MODE", default=self.bot_mode)
+        if not self.bot_mode in ["polling", "webhook"]:
+            raise BaseException(f"Неизвестный режим получения обновлений - {self.bot_mode}")
+        try: self.bot_workers=int(os.environ.get("BOT_WORKERS", default=self.bot_workers))
+        except ValueError: raise BaseException("Количество потоков диспетчера должно быть числом")
+        if self.bot_workers < 1:
+            raise BaseException("Количество потоков диспетчера должно быть больше нуля")
+        self.webhook_listen=os.environ.get("WEBHOOK_LISTEN", default=self.webhook_listen)
+        try:
+            self.webhook_port=int(os.environ.get("WEBHOOK_PORT", default=self.webhook_port))
+            self.webhook_max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", default=self.webhook_max_connections))
+        except ValueError: raise BaseException("Параметры webhook должны быть числами")
+        self.webhook_url=os.environ.get("WEBHOOK_URL", default=self.webhook_url)
+        if self.bot_mode == "webhook" and not self.webhook_url:
+            raise BaseException("Для режима webhook требуется внешний адрес WEBHOOK_URL")
+        self.webhook_secret=os.environ.get("WEBHOOK_SECRET", default=self.webhook_secret) or secrets.token_urlsafe(32)
+        if not re.match(r"^[A-Za-z0-9_-]{16,256}$", self.webhook_secret):
+            raise BaseException("Секрет webhook - от 16 до 256 символов A-Z, a-z, 0-9, _ и -")
         # ssh
         try: self.ssh_host = os.environ["SSH_HOST"]
         except KeyError: raise BaseException("Требуется имя хоста удаленного сервера")
@@ -57,8 +279,53 @@ class config:
         except ValueError: raise BaseException("Номер порта SSH должен быть числом")
         try: self.ssh_user = os.environ["SSH_USER"]
         except KeyError: raise BaseException("Требуется имя пользователя удаленного сервера")
+        self.ssh_key=os.environ.get("SSH_KEY", default=self.ssh_key)
+        self.ssh_key_pass=os.environ.get("SSH_KEY_PASS", default=self.ssh_key_pass)
         try: self.ssh_pass = os.environ["SSH_PASS"]
-        except KeyError: raise BaseException("Требуется имя пароль удаленного сервера")
+        except KeyError:
+            if not self.ssh_key: raise BaseException("Требуется пароль или ключ удаленного сервера")
+        try:
+            self.ssh_pool_size=int(os.environ.get("SSH_POOL", default=self.ssh_pool_size))
+            self.ssh_channels=int(os.environ.get("SSH_CHANNELS", default=self.ssh_channels))
+            self.ssh_keepalive=int(os.environ.get("SSH_KEEPALIVE", default=self.ssh_keepalive))
+            self.ssh_timeout=int(os.environ.get("SSH_TIMEOUT", default=self.ssh_timeout))
+            self.ssh_channel_wait=int(os.environ.get("SSH_CHANNEL_WAIT", default=self.ssh_channel_wait))
+            self.ssh_health_interval=int(os.environ.get("SSH_HEALTH_INTERVAL", default=self.ssh_health_interval))
+            self.ssh_reconnect_tries=int(os.environ.get("SSH_RECONNECT_TRIES", default=self.ssh_reconnect_tries))
+        except ValueError: raise BaseException("Параметры пула SSH должны быть числами")
+        self.ssh_charset=os.environ.get("SSH_CHARSET", default=self.ssh_charset)
+        try: codecs.lookup(self.ssh_charset)
+        except LookupError: raise BaseException(f"Неизвестная кодировка SSH - {self.ssh_charset}")
+        try: self.ssh_max_output=int(os.environ.get("SSH_MAX_OUTPUT", default=self.ssh_max_output))
+        except ValueError: raise BaseException("Лимит вывода SSH должен быть числом")
+        if self.ssh_pool_size < 1 or self.ssh_channels < 1:
+            raise BaseException("Размер пула SSH и количество каналов должны быть больше нуля")
+        # хосты: SSH_HOSTS="web1=10.0.0.1,web2=admin@10.0.0.2:2222"
+        self.ssh_hosts={self.ssh_host: (self.ssh_user, self.ssh_host, self.ssh_port)}
+        for item in filter(None, os.environ.get("SSH_HOSTS", "").split(",")):
+            m=re.match(r"^([a-zA-Z0-9._-]+)=(?:([^@]+)@)?([^:@]+)(?::(\d+))?$", item.strip())
+            if not m:
+                raise BaseException(f"Неверное описание хоста SSH - {item}")
+            self.ssh_hosts[m[1]]=(m[2] or self.ssh_user, m[3], int(m[4] or self.ssh_port))
+        # группы: SSH_GROUPS="web=web1,web2;db=db1"
+        self.ssh_groups={}
+        for item in filter(None, os.environ.get("SSH_GROUPS", "").split(";")):
+            name, _, hosts=item.strip().partition("=")
+            hosts=[i.strip() for i in hosts.split(",") if i.strip()]
+            if not re.match(r"^[a-zA-Z0-9._-]+$", name) or not hosts:
+                raise BaseException(f"Неверное описание группы хостов - {item}")
+            for i in hosts:
+                if i not in self.ssh_hosts:
+                    raise BaseException(f"Неизвестный хост {i} в группе {name}")
+            self.ssh_groups[name]=hosts
+        self.ssh_groups.setdefault("all", list(self.ssh_hosts))
+        try:
+            self.ssh_fanout=int(os.environ.get("SSH_FANOUT", default=self.ssh_fanout))
+            self.ssh_host_timeout=float(os.environ.get("SSH_HOST_TIMEOUT", default=self.ssh_host_timeout))
+            self.ssh_host_backoff=float(os.environ.get("SSH_HOST_BACKOFF", default=self.ssh_host_backoff))
+        except ValueError: raise BaseException("Параметры запуска на группе хостов должны быть числами")
+        if self.ssh_fanout < 1:
+            raise BaseException("Количество одновременных команд на группе хостов должно быть больше нуля")
         # база данных
         try: self.db_host = os.environ["DB_HOST"]
         except KeyError: raise BaseException("Требуется имя сервера базы данных")
@@ -71,158 +338,2853 @@ class config:
         try: self.db_database = os.environ["DB_DTBS"]
         except KeyError: raise BaseException("Требуется имя базы данных")
         self.db_schema=os.environ.get("DB_SCHM", default=self.db_schema)
+        try:
+            self.db_pool_min=int(os.environ.get("DB_POOL_MIN", default=self.db_pool_min))
+            self.db_pool_max=int(os.environ.get("DB_POOL_MAX", default=self.db_pool_max))
+            self.db_timeout=int(os.environ.get("DB_TIMEOUT", default=self.db_timeout))
+        except ValueError: raise BaseException("Параметры пула БД должны быть числами")
+        if self.db_pool_max < 1 or self.db_pool_min > self.db_pool_max:
+            raise BaseException("Неверный размер пула БД")
+        # реплика
+        self.db_replica_host=os.environ.get("DB_REPLICA_HOST", default=self.db_replica_host)
+        try: self.db_replica_port=int(os.environ.get("DB_REPLICA_PORT", default=self.db_replica_port))
+        except ValueError: raise BaseException("Номер порта реплики БД должен быть числом")
+        try: self.db_replica_max_lag=float(os.environ.get("DB_REPLICA_MAX_LAG", default=self.db_replica_max_lag))
+        except ValueError: raise BaseException("Допустимое отставание реплики должно быть числом")
+        # постраничный вывод
+        try:
+            self.more_pages=int(os.environ.get("MORE_PAGES", default=self.more_pages))
+            self.more_users=int(os.environ.get("MORE_USERS", default=self.more_users))
+            self.more_ttl=int(os.environ.get("MORE_TTL", default=self.more_ttl))
+            self.more_spool=int(os.environ.get("MORE_SPOOL", default=self.more_spool))
+        except ValueError: raise BaseException("Параметры постраничного вывода должны быть числами")
+        if self.more_pages < 1 or self.more_users < 1:
+            raise BaseException("Параметры постраничного вывода должны быть больше нуля")
+        # хранилище сессий
+        self.session_backend=os.environ.get("SESSION_STORE", default=self.session_backend)
+        if not self.session_backend in ["memory", "postgres"]:
+            raise BaseException(f"Неизвестное хранилище сессий - {self.session_backend}")
+        try:
+            self.session_ttl=int(os.environ.get("SESSION_TTL", default=self.session_ttl))
+            self.session_memory=int(os.environ.get("SESSION_MEMORY", default=self.session_memory))
+            self.session_items=int(os.environ.get("SESSION_ITEMS", default=self.session_items))
+        except ValueError: raise BaseException("Параметры хранилища сессий должны быть числами")
+        try:
+            self.snapshot_memory=int(os.environ.get("SNAPSHOT_MEMORY", default=self.snapshot_memory))
+            self.snapshot_ttl=int(os.environ.get("SNAPSHOT_TTL", default=self.snapshot_ttl))
+        except ValueError: raise BaseException("Параметры снимков вывода должны быть числами")
+        # поиск email/телефонов
+        try: self.extract_timeout=float(os.environ.get("EXTRACT_TIMEOUT", default=self.extract_timeout))
+        except ValueError: raise BaseException("Ограничение времени поиска должно быть числом")
+        try: self.extract_max_file=int(os.environ.get("EXTRACT_MAX_FILE", default=self.extract_max_file))
+        except ValueError: raise BaseException("Максимальный размер файла для поиска должен быть числом")
+        self.tmp_dir=os.environ.get("TMP_DIR", default=self.tmp_dir)
+        try: self.extract_tmp_max=int(os.environ.get("EXTRACT_TMP_MAX", default=self.extract_tmp_max))
+        except ValueError: raise BaseException("Лимит временных файлов поиска должен быть числом")
+        # индекс пакетов
+        try: self.apt_index_check=int(os.environ.get("APT_INDEX_CHECK", default=self.apt_index_check))
+        except ValueError: raise BaseException("Интервал проверки списка пакетов должен быть числом")
+        # журналы
+        try:
+            self.log_cursor_ttl=int(os.environ.get("LOG_CURSOR_TTL", default=self.log_cursor_ttl))
+            self.log_max_entries=int(os.environ.get("LOG_MAX_ENTRIES", default=self.log_max_entries))
+            self.follow_interval=int(os.environ.get("FOLLOW_INTERVAL", default=self.follow_interval))
+        except ValueError: raise BaseException("Параметры чтения журналов должны быть числами")
+        # фоновый замер показателей хостов
+        try:
+            self.collect_interval=int(os.environ.get("COLLECT_INTERVAL", default=self.collect_interval))
+            self.collect_retention=int(os.environ.get("COLLECT_RETENTION", default=self.collect_retention))
+        except ValueError: raise BaseException("Параметры замера показателей должны быть числами")
+        self.collect_target=os.environ.get("COLLECT_TARGET", default=self.collect_target)
+        # метрики
+        try:
+            if os.environ.get("METRICS_PORT"): self.metrics_port=int(os.environ["METRICS_PORT"])
+        except ValueError: raise BaseException("Номер порта метрик должен быть числом")
+        self.metrics_listen=os.environ.get("METRICS_LISTEN", default=self.metrics_listen)
+        # допуск удаленных команд
+        try:
+            self.admit_rate=float(os.environ.get("ADMIT_RATE", default=self.admit_rate))
+            self.admit_burst=float(os.environ.get("ADMIT_BURST", default=self.admit_burst))
+            self.admit_capacity=int(os.environ.get("ADMIT_CAPACITY", default=self.admit_capacity))
+            self.admit_max_wait=float(os.environ.get("ADMIT_MAX_WAIT", default=self.admit_max_wait))
+            if os.environ.get("ADMIT_MAX_WAITING"): self.admit_max_waiting=int(os.environ["ADMIT_MAX_WAITING"])
+        except ValueError: raise BaseException("Параметры допуска удаленных команд должны быть числами")
+        if self.admit_rate <= 0 or self.admit_burst < 1 or self.admit_capacity < 1:
+            raise BaseException("Параметры допуска удаленных команд должны быть больше нуля")
+        # отправка сообщений
+        try:
+            self.send_workers=int(os.environ.get("SEND_WORKERS", default=self.send_workers))
+            self.send_chat_rate=float(os.environ.get("SEND_CHAT_RATE", default=self.send_chat_rate))
+            self.send_chat_burst=float(os.environ.get("SEND_CHAT_BURST", default=self.send_chat_burst))
+            self.send_global_rate=float(os.environ.get("SEND_GLOBAL_RATE", default=self.send_global_rate))
+        except ValueError: raise BaseException("Параметры отправки сообщений должны быть числами")
+        if self.send_workers < 1 or self.send_chat_rate <= 0 or self.send_chat_burst < 1 or self.send_global_rate <= 0:
+            raise BaseException("Параметры отправки сообщений должны быть больше нуля")
+        # пул обработчиков
+        try: self.workers=int(os.environ.get("WORKERS", default=self.workers))
+        except ValueError: raise BaseException("Размер пула обработчиков должен быть числом")
+        try: self.workers_queue=int(os.environ.get("WORKERS_QUEUE", default=self.workers_queue))
+        except ValueError: raise BaseException("Размер очереди пула обработчиков должен быть числом")
+        if self.workers < 1 or self.workers_queue < 1:
+            raise BaseException("Размер пула и очереди обработчиков должен быть больше нуля")
+
+
+class metrics_registry:
+    """Реестр метрик: счетчики, значения и гистограммы.
+    Отдаются в текстовом формате Prometheus по HTTP"""
+
+    # границы гистограмм по-умолчанию, секунд
+    default_buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __declare(self, name: str, type: str, help: str, buckets=None, func=None):
+        """Объявление метрики
+
+        :param name: имя
+        :param type: counter, gauge или histogram
+        :param help: описание
+        :param buckets: границы гистограммы
+        :param func: функция получения значения при выдаче (значение или словарь метки - значение)
+        """
+        with self.__lock:
+            self.__metrics.setdefault(name, {"type": type, "help": help, "buckets": buckets, "func": func, "values": {}})
+
+    def counter(self, name: str, help: str, func=None):
+        """Объявление счетчика"""
+        self.__declare(name, "counter", help, func=func)
+
+    def gauge(self, name: str, help: str, func=None):
+        """Объявление значения"""
+        self.__declare(name, "gauge", help, func=func)
+
+    def histogram(self, name: str, help: str, buckets=None):
+        """Объявление гистограммы"""
+        self.__declare(name, "histogram", help, buckets=tuple(buckets or self.default_buckets))
+
+    def inc(self, name: str, value: float=1, **labels):
+        """Увеличение счетчика
+
+        :param name: имя
+        :param value: приращение
+        :param labels: метки
+        """
+        key=tuple(sorted(labels.items()))
+        with self.__lock:
+            values=self.__metrics[name]["values"]
+            values[key]=values.get(key, 0)+value
+
+    def set(self, name: str, value: float, **labels):
+        """Установка значения
+
+        :param name: имя
+        :param value: значение
+        :param labels: метки
+        """
+        with self.__lock:
+            self.__metrics[name]["values"][tuple(sorted(labels.items()))]=value
+
+    def observe(self, name: str, value: float, **labels):
+        """Наблюдение в гистограмму
+
+        :param name: имя
+        :param value: значение
+        :param labels: метки
+        """
+        key=tuple(sorted(labels.items()))
+        with self.__lock:
+            metric=self.__metrics[name]
+            data=metric["values"].get(key)
+            if data is None:
+                data=metric["values"][key]=[[0]*len(metric["buckets"]), 0.0, 0]
+            # счетчик только первой подходящей границы, накопление - при выдаче
+            pos=bisect.bisect_left(metric["buckets"], value)
+            if pos < len(metric["buckets"]):
+                data[0][pos] += 1
+            data[1] += value
+            data[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Замер времени выполнения блока в гистограмму
+
+        :param name: имя
+        :param labels: метки
+        """
+        started=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-started, **labels)
+
+    @staticmethod
+    def __labels(key, extra: tuple=()):
+        """Метки в формате Prometheus
+
+        :param key: кортеж пар (имя, значение)
+        :param extra: дополнительные пары
+        """
+        items=[]
+        for k, v in key+extra:
+            v=str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            items.append(f'{k}="{v}"')
+        return "{"+",".join(items)+"}" if items else ""
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self.__lock:
+            metrics={name: dict(metric, values=dict(metric["values"])) for name, metric in self.__metrics.items()}
+        lines=[]
+        for name, metric in metrics.items():
+            values=metric["values"]
+            if metric["func"]:
+                try:
+                    value=metric["func"]()
+                except Exception as e:
+                    logging.warning("metrics: %s failed: %s", name, e)
+                    continue
+                # значение или словарь: метки (кортеж пар) - значение
+                values=value if isinstance(value, dict) else {(): value}
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in values.items():
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{self.__labels(key)} {value}")
+                    continue
+                cumulative=0
+                for bound, count in zip(metric["buckets"], value[0]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.__labels(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self.__labels(key, (('le', '+Inf'),))} {value[2]}")
+                lines.append(f"{name}_sum{self.__labels(key)} {value[1]}")
+                lines.append(f"{name}_count{self.__labels(key)} {value[2]}")
+        return "\n".join(lines)+"\n"
+
+    def serve(self, listen: str, port: int):
+        """Запуск HTTP-сервера метрик в фоновом потоке
+
+        :param listen: адрес прослушивания
+        :param port: порт
+        """
+        routes=self.routes
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                route=routes.get(self.path.split("?")[0])
+                if not route:
+                    self.send_error(404)
+                    return
+                status, body=route()
+                data=body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: "+format, *args)
+        self.server=http.server.ThreadingHTTPServer((listen, port), handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logging.info("metrics: listen on %s:%s", listen, port)
+
+    def close(self):
+        """Остановка HTTP-сервера"""
+        if self.server:
+            self.server.shutdown()
+
+    def __init__(self):
+        """Инициализация реестра"""
+        self.__lock=threading.Lock()
+        self.__metrics={}
+        self.server=None
+        # пути HTTP-сервера: путь - функция, возвращающая (код, текст)
+        self.routes={"/metrics": lambda: (200, self.render())}
+
+# общий реестр метрик
+metrics=metrics_registry()
+
+class ssh_connection:
+    """Одно подключение пула SSH"""
+    # клиент
+    client=None
+    # занятые каналы
+    channels=0
+
+    def is_alive(self):
+        """Проверка работоспособности подключения"""
+        if not self.client:
+            return False
+        transport=self.client.get_transport()
+        return bool(transport and transport.is_active() and transport.is_authenticated())
+
+    def connect(self, deadline: float=None):
+        """Подключение с повторными попытками и экспоненциальной задержкой.
+        С крайним сроком - одна попытка в пределах оставшегося времени
+
+        :param deadline: крайний срок, time.monotonic() (None - без ограничения)
+        """
+        tries=1 if deadline else self.config.ssh_reconnect_tries
+        delay=1
+        for attempt in range(1, tries+1):
+            self.close()
+            timeout=self.config.ssh_timeout
+            if deadline:
+                timeout=min(timeout, deadline-time.monotonic())
+                if timeout <= 0:
+                    raise TimeoutError(f"{self.host}: превышено время подключения")
+            try:
+                self.client=paramiko.SSHClient()
+                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                self.client.connect(
+                    hostname=self.host,
+                    port=self.port,
+                    username=self.user,
+                    password=self.config.ssh_pass,
+                    key_filename=self.config.ssh_key,
+                    passphrase=self.config.ssh_key_pass,
+                    timeout=timeout,
+                    banner_timeout=timeout,
+                    auth_timeout=timeout
+                )
+                self.client.get_transport().set_keepalive(self.config.ssh_keepalive)
+                logging.debug("ssh_connection: connected to %s", self.host)
+                return
+            except (paramiko.SSHException, OSError) as e:
+                logging.warning("ssh_connection: %s connect attempt %s failed: %s", self.host, attempt, e)
+                if attempt == tries:
+                    raise
+                time.sleep(delay+random.uniform(0, delay/2))
+                delay=min(delay*2, 30)
+
+    def close(self):
+        """Закрытие подключения"""
+        if self.client:
+            self.client.close()
+            self.client=None
+
+    def __init__(self, config: config, host: str, port: int, user: str):
+        """Инициализация подключения
+
+        :param config: класс с конфигурацией
+        :param host: хост
+        :param port: порт
+        :param user: пользователь
+        """
+        self.config=config
+        self.host=host
+        self.port=port
+        self.user=user
+        # блокировка переподключения
+        self.lock=threading.Lock()
+
+class ssh_stream:
+    """Вывод удаленной команды: итератор строк, удерживающий ssh-канал
+    до конца чтения или закрытия. Постраничный вывод не оставляет такой
+    источник ждать пользователя"""
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def close(self):
+        """Закрытие канала"""
+        self.lines.close()
+
+    def __init__(self, lines):
+        """Инициализация
+
+        :param lines: генератор строк вывода
+        """
+        self.lines=lines
+
+class remote_execution:
+    """Удаленный запуск"""
+    # пул подключений
+    connections=[]
+
+    safe_args_regex=re.compile('^[a-zA-Z0-9.,_-]+$')
+
+    def build_command(self, command:str, args:dict={}):
+        """Формирование командной строки.
+        Возвращает None при недопустимых аргументах
+
+        :param command: команда
+        :param args: аргументы
+        """
+        # проверка аргументов
+        for a in args:
+            if not self.safe_args_regex.match(args[a]):
+                logging.warning("remote_execution.build_command: unsafe argument: %s", args[a])
+                return None
+        # конечная строка
+        return command.format_map(args)
+
+    @contextlib.contextmanager
+    def connection(self, timeout: float=None, deadline: float=None):
+        """Получение подключения из пула.
+        Выбирается наименее загруженное, при нехватке каналов - ожидание
+
+        :param timeout: ограничение ожидания свободного канала, секунд (None - SSH_CHANNEL_WAIT)
+        :param deadline: крайний срок команды, time.monotonic() - ограничивает и переподключение
+        """
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: min(c.channels for c in self.connections) < self.max_channels,
+                                        timeout or self.channel_wait):
+                raise TimeoutError(f"нет свободного канала к {self.host}")
+            conn=min(self.connections, key=lambda c: c.channels)
+            conn.channels += 1
+        try:
+            # проверка и прозрачное переподключение; переподключение другим потоком ждем не дольше срока
+            if not conn.lock.acquire(timeout=max(deadline-time.monotonic(), 0) if deadline else -1):
+                raise TimeoutError(f"{self.host}: подключение не готово")
+            try:
+                if not conn.is_alive():
+                    logging.warning("remote_execution: connection to %s is down, reconnecting", self.host)
+                    conn.connect(deadline)
+            finally:
+                conn.lock.release()
+            yield conn
+        finally:
+            with self.__cond:
+                conn.channels -= 1
+                self.__cond.notify()
+
+    def run_stream(self, command:str, args:dict={}, timeout: float=None):
+        """Выполнение удаленной команды с потоковым чтением.
+        Возвращает генератор строк вывода или None при недопустимых аргументах
+
+        :param command: команда
+        :param args: аргументы
+        :param timeout: ограничение времени выполнения, секунд (TimeoutError)
+        """
+        real_comm=self.build_command(command=command, args=args)
+        if real_comm is None:
+            logging.warning("remote_execution.run_stream: unable to get data")
+            return None
+        logging.debug("remote_execution.run_stream: try to run %s", real_comm)
+        return ssh_stream(self.__stream(real_comm, timeout))
+
+    def __open_channel(self, conn, real_comm:str, deadline: float=None):
+        """Открытие канала и запуск команды. Одна повторная попытка:
+        при обрыве соединения - на переподключенном, иначе - на том же.
+        Живое подключение не закрывается из-за ошибки одного канала
+        (например, лимит MaxSessions) - на нем работают каналы других потоков
+
+        :param conn: подключение пула
+        :param real_comm: командная строка
+        :param deadline: крайний срок команды, time.monotonic()
+        """
+        for attempt in (1, 2):
+            try:
+                channel=conn.client.get_transport().open_session()
+                channel.exec_command(real_comm)
+                return channel
+            except (paramiko.SSHException, EOFError, OSError, AttributeError) as e:
+                logging.warning("remote_execution: exec attempt %s failed: %s", attempt, e)
+                if attempt == 2:
+                    raise
+                # AttributeError - подключение переоткрывается другим потоком: ожидание на блокировке
+                with conn.lock:
+                    if not conn.is_alive():
+                        conn.connect(deadline)
+
+    def __stream(self, real_comm:str, timeout: float=None):
+        """Генератор строк вывода команды.
+        stdout и stderr читаются одновременно, чтобы не заблокироваться
+        на переполненном буфере одного из них
+
+        :param real_comm: командная строка
+        :param timeout: ограничение времени выполнения, секунд
+        """
+        # метка команды - без аргументов
+        label=real_comm.split()[0] if real_comm.split() else ""
+        started=time.perf_counter()
+        deadline=time.monotonic()+timeout if timeout else None
+        with self.connection(timeout, deadline) as conn:
+            channel=self.__open_channel(conn, real_comm, deadline)
+            # инкрементальные декодеры и недочитанные хвосты строк: stdout, stderr
+            decoders=[codecs.getincrementaldecoder(self.charset)(errors="replace") for i in range(2)]
+            tails=["", ""]
+            received=0
+            first_byte=None
+            # время ожидания потребителя (постраничный вывод) - не в счет передачи
+            idle=0.0
+            try:
+                while True:
+                    # срок проверяется и при непрерывном выводе
+                    if deadline and time.monotonic() > deadline:
+                        raise TimeoutError(f"{label} на {self.host}: превышено время {timeout} с")
+                    chunks=[]
+                    # чтение прекращается сразу при превышении лимита вывода
+                    while received <= self.max_output and channel.recv_ready():
+                        chunks.append((0, channel.recv(32768)))
+                        received += len(chunks[-1][1])
+                    while received <= self.max_output and channel.recv_stderr_ready():
+                        chunks.append((1, channel.recv_stderr(32768)))
+                        received += len(chunks[-1][1])
+                    if chunks and first_byte is None:
+                        first_byte=time.perf_counter()
+                        metrics.observe("ssh_exec_seconds", first_byte-started, command=label)
+                    for stream, chunk in chunks:
+                        lines=(tails[stream]+decoders[stream].decode(chunk)).split("\n")
+                        tails[stream]=lines.pop()
+                        paused=time.perf_counter()
+                        yield from lines
+                        idle += time.perf_counter()-paused
+                    if received > self.max_output:
+                        logging.warning("remote_execution: output limit %s exceeded, abort %s", self.max_output, real_comm)
+                        yield f"... вывод прерван: превышен лимит {self.max_output} байт"
+                        return
+                    if not chunks:
+                        if channel.closed or channel.eof_received:
+                            break
+                        # ожидание данных на любом из потоков
+                        select.select([channel], [], [], min(1, max(deadline-time.monotonic(), 0)) if deadline else 1)
+                # остатки
+                for stream in (0, 1):
+                    tail=tails[stream]+decoders[stream].decode(b"", final=True)
+                    if tail:
+                        yield tail
+                logging.debug("remote_execution: %s received %s bytes", real_comm, received)
+                if first_byte is not None:
+                    metrics.observe("ssh_transfer_seconds", time.perf_counter()-first_byte-idle, command=label)
+            finally:
+                metrics.inc("ssh_received_bytes_total", received, command=label)
+                channel.close()
+
+    def run(self, command:str, args:list=[], timeout: float=None):
+        """Выполнение удаленной команды.
+        Возвращает конечную стоку.
+        
+        :param command: команда
+        :param args: аргументы
+        :param timeout: ограничение времени выполнения, секунд (TimeoutError)
+        """
+        lines=self.run_stream(command=command, args=args, timeout=timeout)
+        if lines is None:
+            logging.warning("remote_execution.run: unable to get data")
+            return None
+        return "\n".join(lines)
+
+    def health_check(self):
+        """Периодическая проверка и переподключение простаивающих подключений"""
+        while not self.__stop.wait(self.health_interval):
+            for conn in self.connections:
+                with conn.lock:
+                    if conn.is_alive():
+                        continue
+                    logging.warning("remote_execution.health_check: connection to %s is down, reconnecting", self.host)
+                    try:
+                        conn.connect()
+                    except (paramiko.SSHException, OSError) as e:
+                        logging.error("remote_execution.health_check: reconnect to %s failed: %s", self.host, e)
+
+    def close(self):
+        """Завершить работу"""
+        self.__stop.set()
+        for conn in self.connections:
+            conn.close()
+
+    ##
+    # Инициализация класса
+    ## 
+    def __init__(self, config: config, host: str=None, port: int=None, user: str=None, lazy: bool=False):
+        """Инициализация пула удаленных подключений
+
+        :param config: класс с конфигурацией
+        :param host: хост (по-умолчанию - SSH_HOST)
+        :param port: порт
+        :param user: пользователь
+        :param lazy: подключение при первой команде (недоступный хост не мешает запуску)
+        """
+        metrics.histogram("ssh_exec_seconds", "SSH: от запуска команды до первого байта вывода")
+        metrics.histogram("ssh_transfer_seconds", "SSH: передача вывода без ожидания потребителя")
+        metrics.counter("ssh_received_bytes_total", "SSH: получено байт вывода")
+        self.max_channels=config.ssh_channels
+        self.channel_wait=config.ssh_channel_wait
+        self.charset=config.ssh_charset
+        self.max_output=config.ssh_max_output
+        self.health_interval=config.ssh_health_interval
+        self.__cond=threading.Condition()
+        self.__stop=threading.Event()
+        self.host=host or config.ssh_host
+        self.connections=[]
+        for i in range(config.ssh_pool_size):
+            conn=ssh_connection(config, self.host, port or config.ssh_port, user or config.ssh_user)
+            if not lazy:
+                conn.connect()
+            self.connections.append(conn)
+        threading.Thread(target=self.health_check, name="ssh_health", daemon=True).start()
+
+class remote_fleet:
+    """Группы хостов: параллельный запуск команды на нескольких хостах"""
+
+    def resolve(self, target: str):
+        """Имена хостов по цели: хост, группа или их список через запятую.
+        Возвращает None при неизвестном имени
+
+        :param target: цель
+        """
+        names=[]
+        for part in target.split(","):
+            if part in self.groups:
+                items=self.groups[part]
+            elif part in self.hosts:
+                items=[part]
+            else:
+                return None
+            names.extend(i for i in items if i not in names)
+        return names
+
+    def host(self, name: str):
+        """Удаленный запуск на хосте. Подключение - при первом обращении
+
+        :param name: имя хоста
+        """
+        with self.__lock:
+            exec=self.__execs.get(name)
+            if exec is None:
+                user, host, port=self.hosts[name]
+                exec=self.__execs[name]=remote_execution(self.config, host, port, user, lazy=True)
+            return exec
+
+    def run(self, names: list, func):
+        """Параллельный запуск на хостах с ограничением одновременных команд.
+        Медленные и недоступные хосты не задерживают остальные.
+        Возвращает список словарей: host, output, error, seconds - в порядке names
+
+        :param names: имена хостов
+        :param func: функция (имя хоста, remote_execution) - вывод
+        """
+        def task(name):
+            started=time.monotonic()
+            try:
+                result={"host": name, "output": func(name, self.host(name)), "error": None, "seconds": time.monotonic()-started}
+                with self.__lock:
+                    self.__down.pop(name, None)
+                return result
+            except Exception as e:
+                logging.warning("remote_fleet: %s failed: %s", name, e)
+                self.mark_down(name)
+                return {"host": name, "output": None, "error": str(e) or type(e).__name__, "seconds": time.monotonic()-started}
+        results={}
+        # недоступные хосты - сразу ошибка, без задачи в общем пуле
+        now=time.monotonic()
+        with self.__lock:
+            for name in names:
+                if self.__down.get(name, 0) > now:
+                    results[name]={"host": name, "output": None, "seconds": None,
+                                   "error": f"недоступен, повтор через {self.__down[name]-now:.0f} с"}
+        futures={self.__pool.submit(task, name): name for name in names if name not in results}
+        # хосты ждут свободного места в пуле - общее ограничение с запасом на очередь
+        rounds=-(-len(names)//self.config.ssh_fanout)
+        done, pending=concurrent.futures.wait(futures, timeout=self.timeout*rounds+self.config.ssh_timeout)
+        for future in done:
+            results[futures[future]]=future.result()
+        for future in pending:
+            future.cancel()
+            self.mark_down(futures[future])
+            results[futures[future]]={"host": futures[future], "output": None, "error": "нет ответа", "seconds": None}
+        return [results[name] for name in names]
+
+    def mark_down(self, name: str):
+        """Хост недоступен на время SSH_HOST_BACKOFF: следующие запуски не ждут его
+
+        :param name: имя хоста
+        """
+        with self.__lock:
+            self.__down[name]=time.monotonic()+self.config.ssh_host_backoff
+
+    def close(self):
+        """Завершить работу"""
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+        for name, exec in self.__execs.items():
+            if exec is not self.__default:
+                exec.close()
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config, default: remote_execution):
+        """Инициализация групп хостов
+
+        :param config: класс с конфигурацией
+        :param default: удаленный запуск на основном хосте (SSH_HOST)
+        """
+        self.config=config
+        self.hosts=config.ssh_hosts or {config.ssh_host: (config.ssh_user, config.ssh_host, config.ssh_port)}
+        self.groups=config.ssh_groups or {"all": list(self.hosts)}
+        self.timeout=config.ssh_host_timeout
+        self.__lock=threading.Lock()
+        # недоступные хосты: имя - время следующей попытки
+        self.__down={}
+        self.__default=default
+        self.__execs={config.ssh_host: default}
+        self.__pool=ThreadPoolExecutor(max_workers=config.ssh_fanout, thread_name_prefix="fanout")
+
+class db_pool:
+    """Пул подключений к серверу PostgreSQL.
+    При отсутствии свободного подключения - ожидание"""
+
+    # пул
+    pool=None
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Получение подключения из пула"""
+        with self.__slots:
+            conn=self.pool.getconn()
+            broken=False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # подключение потеряно (например, перезапуск сервера) - не возвращаем в пул
+                broken=True
+                raise
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def close(self):
+        """Закрытие всех подключений"""
+        self.pool.closeall()
+
+    def __init__(self, config: config, host: str, port: int):
+        """Инициализация пула
+
+        :param config: класс с конфигурацией
+        :param host: сервер
+        :param port: порт
+        """
+        self.host=host
+        self.pool=psycopg2.pool.ThreadedConnectionPool(
+            config.db_pool_min,
+            config.db_pool_max,
+            dbname=config.db_database,
+            user=config.db_user,
+            password=config.db_password,
+            host=host,
+            port=port,
+            connect_timeout=config.db_timeout,
+            options=f"-c search_path={config.db_schema}"
+        )
+        self.__slots=threading.BoundedSemaphore(config.db_pool_max)
+
+class db: 
+    """"Работа с базой данных"""
+
+    # пул основного сервера
+    primary=None
+    # пул реплики
+    replica=None
+    # попыток выполнения запроса при потере подключения
+    # (после перезапуска сервера все подключения пула могут быть потеряны)
+    retries=0
+    # интервал проверки отставания реплики, секунд
+    replica_check_interval=5
+
+    # таблица email`ов
+    email_tbl="emails"
+    # таблица номеров телефонов
+    phones_tbl="phones"
+    # максимальная длина записи (record VARCHAR(64))
+    record_max_len=64
+
+    # нормализация записей: lower для email, +7XXXXXXXXXX для телефонов
+    # (для уже сохраненных данных - в миграции уникального индекса)
+    normalize_sql={
+        "emails": "lower(trim(record))",
+        "phones": "CASE WHEN regexp_replace(record, '\\D', '', 'g') ~ '^[78]\\d{10}$' "
+                  +"THEN '+7' || substr(regexp_replace(record, '\\D', '', 'g'), 2) ELSE record END",
+    }
+
+    @staticmethod
+    def normalize_email(record: str):
+        """Нормализация email
+
+        :param record: email"""
+        return record.strip().lower()
+
+    @staticmethod
+    def normalize_phone(record: str):
+        """Нормализация номера телефона к виду +7XXXXXXXXXX
+
+        :param record: номер телефона"""
+        digits=re.sub(r'\D', '', record)
+        if len(digits) == 11 and digits[0] in "78":
+            return "+7"+digits[1:]
+        return record.strip()
+
+    def close(self):
+        """Закрытие подключения к БД"""
+        self.primary.close()
+        if self.replica:
+            self.replica.close()
+
+    def replica_ok(self):
+        """Можно ли читать с реплики: доступна и отставание в допустимых пределах.
+        Возвращается результат последней проверки; устаревшая проверка запускается
+        в фоновом потоке и не задерживает запросы (недоступная реплика - до DB_TIMEOUT)"""
+        if not self.config.db_replica_host:
+            return False
+        with self.__replica_lock:
+            if not self.__replica_probing and time.monotonic()-self.__replica_checked >= self.replica_check_interval:
+                self.__replica_probing=True
+                threading.Thread(target=self.__probe_replica, name="replica-probe", daemon=True).start()
+            return self.__replica_state
+
+    def __probe_replica(self):
+        """Проверка реплики. Время проверки фиксируется после ее завершения"""
+        state=False
+        try:
+            if not self.replica:
+                self.replica=db_pool(self.config, self.config.db_replica_host, self.config.db_replica_port)
+            with self.replica.connection() as conn:
+                with conn.cursor() as cursor:
+                    # при полностью примененном WAL отставания нет, даже если основной сервер простаивает
+                    cursor.execute("SELECT pg_is_in_recovery(), "
+                                   +"CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                                   +"ELSE COALESCE(EXTRACT(EPOCH FROM now()-pg_last_xact_replay_timestamp()), 0) END")
+                    recovery, lag=cursor.fetchone()
+                conn.rollback()
+            if not recovery:
+                logging.warning("db: replica is not in recovery mode, not used")
+            elif lag > self.config.db_replica_max_lag:
+                logging.warning("db: replica lag %.1fs exceeds %ss, read from primary", lag, self.config.db_replica_max_lag)
+            else:
+                state=True
+        except psycopg2.Error as e:
+            logging.warning("db: replica unavailable: %s", e)
+        finally:
+            with self.__replica_lock:
+                self.__replica_state=state
+                self.__replica_checked=time.monotonic()
+                self.__replica_probing=False
+
+    ##
+    # Миграции схемы
+    ##
+    # ключ advisory-блокировки миграций (одновременный запуск нескольких ботов)
+    migration_lock_id=0x4C4B4559
+
+    def migration_tables(self, cursor):
+        """Таблицы email и телефонов.
+        IF NOT EXISTS - для баз, созданных до появления миграций"""
+        for table in [self.email_tbl, self.phones_tbl]:
+            cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_seq INCREMENT BY 1 START 1 NO CYCLE NO MAXVALUE CACHE 1")
+            # unique на id - индекс для keyset-пагинации чтения
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INT DEFAULT nextval('{table}_seq') unique not null, record VARCHAR(64) not null)")
+
+    def migration_unique_records(self, cursor):
+        """Уникальный индекс записей для сохранения без дублей.
+        Уже сохраненное нормализуется и очищается от дублей"""
+        for table in [self.email_tbl, self.phones_tbl]:
+            cursor.execute(f"UPDATE {table} SET record={self.normalize_sql[table]}")
+            cursor.execute(f"DELETE FROM {table} a USING {table} b WHERE a.record = b.record AND a.id > b.id")
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_record_uniq ON {table} (record)")
+            # статистика для оценки количества записей (pg_class.reltuples)
+            cursor.execute(f"ANALYZE {table}")
+
+    def migration_sessions(self, cursor):
+        """Хранилище сессий"""
+        cursor.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                       +"namespace VARCHAR(32) NOT NULL, key VARCHAR(64) NOT NULL, value JSONB NOT NULL, "
+                       +"expires TIMESTAMPTZ NOT NULL, PRIMARY KEY (namespace, key))")
+        cursor.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def migration_host_samples(self, cursor):
+        """Замеры показателей хостов.
+        Первичный ключ (host, ts) - индекс выборок за период по хосту"""
+        cursor.execute("CREATE TABLE IF NOT EXISTS host_samples ("
+                       +"host VARCHAR(64) NOT NULL, ts TIMESTAMPTZ NOT NULL, "
+                       +"mem_total INT, mem_used INT, mem_available INT, swap_used INT, "
+                       +"users INT, load1 REAL, load5 REAL, load15 REAL, "
+                       +"cpu_usr REAL, cpu_sys REAL, cpu_iowait REAL, cpu_idle REAL, "
+                       +"PRIMARY KEY (host, ts))")
+
+    def migration_follow(self, cursor):
+        """Подписки чатов на новые записи журналов"""
+        cursor.execute("CREATE TABLE IF NOT EXISTS follow ("
+                       +"command VARCHAR(64) NOT NULL, chat_id BIGINT NOT NULL, "
+                       +"PRIMARY KEY (command, chat_id))")
+
+    def migration_follow_cursor(self, cursor):
+        """Курсоры журналов подписок: общие для экземпляров бота, не вытесняются"""
+        cursor.execute("CREATE TABLE IF NOT EXISTS follow_cursor ("
+                       +"command VARCHAR(64) PRIMARY KEY, cursor TEXT NOT NULL)")
+
+    # упорядоченный список миграций: версия - позиция в списке, начиная с 1
+    migrations=[
+        ("Таблицы email и телефонов", migration_tables),
+        ("Уникальный индекс записей", migration_unique_records),
+        ("Хранилище сессий", migration_sessions),
+        ("Замеры показателей хостов", migration_host_samples),
+        ("Подписки на журналы", migration_follow),
+        ("Курсоры подписок", migration_follow_cursor),
+    ]
+
+    def schema_version(self):
+        """Текущая версия схемы (0 - схема не создана)"""
+        def select(cursor):
+            cursor.execute("SELECT to_regclass('schema_version')")
+            if not cursor.fetchone()[0]:
+                return 0
+            cursor.execute("SELECT COALESCE(max(version), 0) FROM schema_version")
+            return cursor.fetchone()[0]
+        return self.run(select)
+
+    def migrate(self):
+        """Применение недостающих миграций.
+        При актуальной схеме DDL не выполняется"""
+        if self.schema_version() >= len(self.migrations):
+            logging.debug("db: schema is up to date")
+            return
+        def apply(cursor):
+            # блокировка до конца транзакции - остальные экземпляры ждут
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (self.migration_lock_id,))
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                           +"version INT PRIMARY KEY, description TEXT NOT NULL, applied TIMESTAMPTZ NOT NULL DEFAULT now())")
+            # версия могла измениться, пока ждали блокировку
+            cursor.execute("SELECT COALESCE(max(version), 0) FROM schema_version")
+            current=cursor.fetchone()[0]
+            for version, (description, step) in enumerate(self.migrations, 1):
+                if version <= current:
+                    continue
+                logging.info("db: apply migration %s - %s", version, description)
+                step(self, cursor)
+                cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+        self.run(apply)
+
+    def run(self, func, read: bool=False):
+        """Выполнение функции func(cursor) в транзакции.
+        При потере подключения - повтор на новом подключении
+
+        :param func: функция работы с курсором
+        :param read: только чтение - допускается реплика
+        """
+        # метка запроса: метод и вложенная функция (get_records.select)
+        statement=func.__qualname__.replace("<locals>.", "").split(".", 1)[-1]
+        for attempt in range(1, self.retries+1):
+            pool=self.replica if read and self.replica_ok() else self.primary
+            try:
+                with pool.connection() as conn:
+                    with metrics.timer("db_query_seconds", statement=statement, server=pool.host):
+                        with conn.cursor() as cursor:
+                            result=func(cursor)
+                        conn.commit()
+                    return result
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logging.warning("db: query on %s failed (attempt %s): %s", pool.host, attempt, e)
+                if pool is self.replica:
+                    # до следующей проверки читаем с основного
+                    with self.__replica_lock:
+                        self.__replica_state=False
+                        self.__replica_checked=time.monotonic()
+                if attempt == self.retries:
+                    raise
+
+    def __init__(self, config: config):
+        """Инициализация подключение и создание базы данных
+
+        :param config: класс с конфигурацией
+        """
+        self.config=config
+        self.retries=config.db_pool_max+1
+        metrics.histogram("db_query_seconds", "БД: время выполнения запроса (с фиксацией)")
+        self.__replica_lock=threading.Lock()
+        self.__replica_checked=-self.replica_check_interval
+        self.__replica_state=False
+        self.__replica_probing=False
+        # подключение
+        self.primary=db_pool(config, config.db_host, config.db_port)
+        # создание и обновление структуры
+        self.migrate()
+
+    def get_records(self, table: str, after_id: int=0, limit: int=200):
+        """Получение страницы списка из базы данных (keyset-пагинация)
+        
+        :param table: имя таблицы
+        :param after_id: id последней полученной записи
+        :param limit: размер страницы"""
+        def select(cursor):
+            cursor.execute(f"SELECT id,record FROM {table} WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit))
+            return cursor.fetchall()
+        return self.run(select, read=True)
+
+    def iter_records(self, table: str, batch: int=200):
+        """Генератор записей таблицы: по одной странице за запрос,
+        подключение между страницами не удерживается
+
+        :param table: имя таблицы
+        :param batch: размер страницы"""
+        last_id=0
+        while True:
+            rows=self.get_records(table, last_id, batch)
+            yield from rows
+            if len(rows) < batch:
+                return
+            last_id=rows[-1][0]
+
+    def count_estimate(self, table: str):
+        """Оценка количества записей по статистике pg_class.
+        None - если статистики еще нет
+
+        :param table: имя таблицы"""
+        def select(cursor):
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row=cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        return self.run(select, read=True)
+    
+    def add_records(self, table: str, list: list):
+        """Добавление в базу данных одним запросом без дублей.
+        Возвращает количество новых и уже существовавших записей
+        
+        :param table: имя таблицы
+        :param list: добавляемые элементы (уже нормализованные)"""
+        # без дублей внутри пачки, с сохранением порядка
+        save_data=[(row,) for row in dict.fromkeys(list) if len(row) <= self.record_max_len]
+        if len(save_data) < len(set(list)):
+            logging.warning("db.add_records: %s records longer than %s skipped", len(set(list))-len(save_data), self.record_max_len)
+        if not save_data:
+            return {"new": 0, "existing": 0}
+        def insert(cursor):
+            # один запрос на всю пачку
+            return psycopg2.extras.execute_values(
+                cursor,
+                f"INSERT INTO {table} (record) VALUES %s ON CONFLICT (record) DO NOTHING RETURNING id",
+                save_data,
+                page_size=len(save_data),
+                fetch=True
+            )
+        new=len(self.run(insert))
+        return {"new": new, "existing": len(save_data)-new}
+
+    def get_emails(self):
+        """Получение email"""
+        return self.iter_records(self.email_tbl)
+    
+    def get_phones(self):
+        """Получение номеров телефонов"""
+        return self.iter_records(self.phones_tbl)
+    
+    def add_stream(self, table: str, rows, batch: int=5000):
+        """Добавление потока записей пачками: один запрос на пачку,
+        память не зависит от общего количества записей
+
+        :param table: имя таблицы
+        :param rows: итератор добавляемых элементов (уже нормализованных)
+        :param batch: размер пачки"""
+        saved={"new": 0, "existing": 0}
+        rows=iter(rows)
+        while True:
+            chunk=list(itertools.islice(rows, batch))
+            if not chunk:
+                return saved
+            result=self.add_records(table, chunk)
+            saved["new"] += result["new"]
+            saved["existing"] += result["existing"]
+
+    # столбцы замеров показателей хостов
+    sample_columns=("host", "ts", "mem_total", "mem_used", "mem_available", "swap_used",
+                    "users", "load1", "load5", "load15", "cpu_usr", "cpu_sys", "cpu_iowait", "cpu_idle")
+    # показатели для истории и трендов
+    sample_metrics=("mem_used", "mem_available", "load1", "cpu_usr", "cpu_sys", "cpu_iowait")
+
+    def add_samples(self, rows: list):
+        """Добавление замеров одним запросом
+
+        :param rows: словари со столбцами sample_columns (ts - время unix)
+        """
+        def insert(cursor):
+            psycopg2.extras.execute_values(
+                cursor,
+                f"INSERT INTO host_samples ({','.join(self.sample_columns)}) VALUES %s ON CONFLICT DO NOTHING",
+                [tuple(row.get(i) for i in self.sample_columns) for row in rows],
+                template="("+",".join("to_timestamp(%s)" if i == "ts" else "%s" for i in self.sample_columns)+")",
+                page_size=len(rows)
+            )
+        self.run(insert)
+
+    def get_follows(self):
+        """Подписки чатов: словарь команда - множество chat_id"""
+        def select(cursor):
+            cursor.execute("SELECT command, chat_id FROM follow")
+            return cursor.fetchall()
+        follows={}
+        for command, chat_id in self.run(select):
+            follows.setdefault(command, set()).add(chat_id)
+        return follows
+
+    def set_follow(self, command: str, chat_id: int, enabled: bool):
+        """Подписка или отписка чата
+
+        :param command: команда бота
+        :param chat_id: чат
+        :param enabled: True - подписать, False - отписать
+        """
+        def change(cursor):
+            if enabled:
+                cursor.execute("INSERT INTO follow (command, chat_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (command, chat_id))
+            else:
+                cursor.execute("DELETE FROM follow WHERE command=%s AND chat_id=%s", (command, chat_id))
+        self.run(change)
+
+    def get_follow_cursor(self, command: str):
+        """Курсор журнала подписки (None - журнал еще не читался)
+
+        :param command: команда бота
+        """
+        def select(cursor):
+            cursor.execute("SELECT cursor FROM follow_cursor WHERE command=%s", (command,))
+            row=cursor.fetchone()
+            return row[0] if row else None
+        return self.run(select)
+
+    def set_follow_cursor(self, command: str, value: str):
+        """Сохранение курсора журнала подписки
+
+        :param command: команда бота
+        :param value: курсор
+        """
+        def upsert(cursor):
+            cursor.execute("INSERT INTO follow_cursor (command, cursor) VALUES (%s, %s) "
+                           +"ON CONFLICT (command) DO UPDATE SET cursor=EXCLUDED.cursor", (command, value))
+        self.run(upsert)
+
+    def drop_samples(self, days: int):
+        """Удаление замеров старше срока хранения
+
+        :param days: срок хранения, дней
+        """
+        def delete(cursor):
+            cursor.execute("DELETE FROM host_samples WHERE ts < now() - make_interval(days => %s)", (days,))
+            return cursor.rowcount
+        return self.run(delete)
+
+    def sample_trend(self, hosts: list, seconds: int):
+        """Минимум, среднее и максимум показателей за период по каждому хосту.
+        Возвращает строки: host, количество замеров, затем min/avg/max по sample_metrics
+
+        :param hosts: имена хостов
+        :param seconds: период, секунд
+        """
+        aggregates=",".join(f"min({i}),avg({i}),max({i})" for i in self.sample_metrics)
+        def select(cursor):
+            cursor.execute(f"SELECT host, count(*), {aggregates} FROM host_samples "
+                           +"WHERE host = ANY(%s) AND ts > now() - make_interval(secs => %s) GROUP BY host ORDER BY host",
+                           (hosts, seconds))
+            return cursor.fetchall()
+        return self.run(select, read=True)
+
+    def sample_history(self, hosts: list, seconds: int, step: int):
+        """Средние значения показателей по интервалам.
+        Возвращает строки: host, начало интервала, затем avg по sample_metrics
+
+        :param hosts: имена хостов
+        :param seconds: период, секунд
+        :param step: длина интервала, секунд
+        """
+        averages=",".join(f"avg({i})" for i in self.sample_metrics)
+        def select(cursor):
+            cursor.execute(f"SELECT host, to_timestamp(floor(extract(epoch FROM ts)/%s)*%s) AS bucket, {averages} "
+                           +"FROM host_samples WHERE host = ANY(%s) AND ts > now() - make_interval(secs => %s) "
+                           +"GROUP BY host, bucket ORDER BY host, bucket",
+                           (step, step, hosts, seconds))
+            return cursor.fetchall()
+        return self.run(select, read=True)
+
+    def add_emails(self, list):
+        """Добавление email
+        
+        :param list: добавляемые элементы (список или итератор)"""
+        return self.add_stream(self.email_tbl, (self.normalize_email(i) for i in list))
+    
+    def add_phones(self, list):
+        """Добавление номеров телефонов
+        
+        :param list: добавляемые элементы (список или итератор)"""
+        return self.add_stream(self.phones_tbl, (self.normalize_phone(i) for i in list))
+
+class apt_index:
+    """Локальный индекс пакетов удаленного сервера.
+    Список пакетов загружается один раз и обновляется при изменении
+    состояния dpkg/apt, поиск выполняется локально"""
+
+    # команда проверки изменений: время изменения базы dpkg и списков apt
+    mtime_cmd="stat -c %Y /var/lib/dpkg/status /var/lib/apt/lists 2>/dev/null"
+    # полный список пакетов
+    list_cmd="apt list 2>/dev/null"
+    # детальная информация о пакете
+    show_cmd="apt-cache show {pkg}"
+    # признаки установленного пакета в apt list: в выводе версия-кандидат,
+    # поэтому установленный пакет с обновлением помечен upgradable from
+    installed_flags=("[installed", "[upgradable from:")
+
+    @staticmethod
+    def parse(lines):
+        """Разбор вывода apt list.
+        Возвращает словарь: имя пакета - строки apt list
+
+        :param lines: итератор строк
+        """
+        packages={}
+        for line in lines:
+            # формат: name/suite[,suite] version arch [flags]
+            name, sep, rest=line.partition("/")
+            if not sep or not rest:
+                continue
+            packages.setdefault(name, []).append(line)
+        return packages
+
+    def refresh(self):
+        """Обновление индекса при изменении состояния пакетов на сервере"""
+        with self.__lock:
+            if time.monotonic()-self.__checked < self.check_interval:
+                return
+            mtime=self.exec.run(self.mtime_cmd)
+            self.__checked=time.monotonic()
+            if self.__index and mtime == self.__mtime:
+                return
+            started=time.monotonic()
+            packages=self.parse(self.exec.run_stream(self.list_cmd))
+            names=sorted(packages)
+            installed=sorted(i for i in names if any(f in j for j in packages[i] for f in self.installed_flags))
+            # индекс заменяется целиком - читатели работают со своей копией ссылки
+            self.__index={
+                "packages": packages,
+                "names": names,
+                "joined": "\n"+"\n".join(names)+"\n",
+                "installed": installed,
+            }
+            self.__mtime=mtime
+            logging.info("apt_index: loaded %s packages (%s installed) in %.3fs", len(names), len(installed), time.monotonic()-started)
+
+    def installed(self):
+        """Строки apt list установленных пакетов"""
+        self.refresh()
+        index=self.__index
+        for name in index["installed"]:
+            yield from index["packages"][name]
+
+    def find(self, query:str):
+        """Поиск пакетов: точное имя, затем префикс, затем подстрока.
+        Возвращает отсортированный список имен
+
+        :param query: строка поиска
+        """
+        self.refresh()
+        started=time.perf_counter()
+        index=self.__index
+        names=index["names"]
+        # точное совпадение
+        pos=bisect.bisect_left(names, query)
+        if pos < len(names) and names[pos] == query:
+            result=[query]
+        else:
+            # префикс - непрерывный диапазон отсортированного списка
+            end=bisect.bisect_left(names, query+"\uffff", lo=pos)
+            result=names[pos:end]
+            if not result:
+                # подстрока - поиск по склеенным именам
+                joined=index["joined"]
+                found=set()
+                start=joined.find(query)
+                while start >= 0:
+                    begin=joined.rfind("\n", 0, start)+1
+                    finish=joined.find("\n", start)
+                    found.add(joined[begin:finish])
+                    start=joined.find(query, finish)
+                result=sorted(found)
+        logging.debug("apt_index: '%s' found %s in %.0fus", query, len(result), (time.perf_counter()-started)*1e6)
+        return result
+
+    def lines(self, names:list):
+        """Строки apt list для списка пакетов
+
+        :param names: имена пакетов
+        """
+        index=self.__index
+        for name in names:
+            yield from index["packages"][name]
+
+    def show(self, name:str):
+        """Детальная информация о пакете (удаленно)
+
+        :param name: имя пакета
+        """
+        return self.exec.run_stream(self.show_cmd, {"pkg": name})
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, exec: remote_execution, config: config):
+        """Инициализация индекса. Список загружается при первом обращении
+
+        :param exec: удаленный запуск
+        :param config: класс с конфигурацией
+        """
+        self.exec=exec
+        self.check_interval=config.apt_index_check
+        self.__lock=threading.Lock()
+        self.__index=None
+        self.__mtime=None
+        self.__checked=-self.check_interval
+
+class log_reader:
+    """Инкрементальное чтение журналов по курсору: с сервера передаются
+    только записи, появившиеся после прошлого чтения"""
+
+    # курсор journalctl: s=...;i=...;b=...;m=...;t=...;x=...
+    cursor_regex=re.compile(r"^[a-zA-Z0-9=;]+$")
+    # время записи docker logs --timestamps (RFC3339Nano)
+    since_regex=re.compile(r"^\d{4}-\d\d-\d\dT[0-9:.]+Z$")
+    # строк журнала контейнера при первом чтении
+    docker_first_read=10000
+    # отметка курсора в выводе awk
+    cursor_mark="@@cursor@@"
+
+    def journal(self, exec: remote_execution, filter: str, cursor: str, tail: int):
+        """Записи journalctl после курсора (без курсора - последние tail).
+        Возвращает записи и новый курсор
+
+        :param exec: удаленный запуск
+        :param filter: условия journalctl
+        :param cursor: курсор прошлого чтения
+        :param tail: записей при первом чтении
+        """
+        if cursor and self.cursor_regex.match(cursor):
+            cmd=f"journalctl --no-pager --show-cursor {filter} --after-cursor='{cursor}' -n {self.max_entries}"
+        else:
+            cmd=f"journalctl --no-pager --show-cursor {filter} -n {tail}"
+        lines=collections.deque(maxlen=self.max_entries)
+        for line in exec.run_stream(cmd):
+            if line.startswith("-- cursor: "):
+                cursor=line[len("-- cursor: "):].strip()
+            elif not line.startswith("-- No entries --"):
+                lines.append(line)
+        return list(lines), cursor
+
+    def docker(self, exec: remote_execution, container: str, pattern: str, since: str, tail: int):
+        """Строки журнала контейнера с подстрокой pattern после времени since
+        (без него - последние tail из docker_first_read строк).
+        Курсор - время последней строки журнала, в том числе не совпавшей.
+        Возвращает строки и новый курсор
+
+        :param exec: удаленный запуск
+        :param container: имя контейнера
+        :param pattern: подстрока (без учета регистра)
+        :param since: курсор прошлого чтения
+        :param tail: строк при первом чтении
+        """
+        if not exec.safe_args_regex.match(container) or not exec.safe_args_regex.match(pattern):
+            raise ValueError("Недопустимое имя контейнера или подстрока")
+        first=not (since and self.since_regex.match(since))
+        select=f"--tail {self.docker_first_read}" if first else f"--since {since}"
+        # фильтр и курсор - на сервере; фигурные скобки awk экранированы для build_command
+        cmd=(f"docker logs --timestamps {select} {container} 2>&1 | awk '"
+             +"{{last=$1}} tolower($0) ~ /"+pattern.lower()+"/ {{print}} END {{print \""+self.cursor_mark+" \" last}}'")
+        lines=collections.deque(maxlen=tail if first else self.max_entries)
+        for line in exec.run_stream(cmd):
+            if line.startswith(self.cursor_mark):
+                since=line[len(self.cursor_mark):].strip() or since
+            # --since включает запись с тем же временем - уже показана
+            elif first or line.split(" ", 1)[0] != since:
+                lines.append(line)
+        return list(lines), since
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config):
+        """Инициализация
+
+        :param config: класс с конфигурацией
+        """
+        self.max_entries=config.log_max_entries
+
+class host_query:
+    """Процессы и сокеты: фильтрация, сортировка и ограничение количества
+    на сервере, разбор вывода в записи. Объем передачи и вывода зависит
+    от размера ответа, а не от количества процессов и сокетов на сервере"""
+
+    # ограничение количества записей по-умолчанию и максимальное
+    default_limit={"ps": 30, "ss": 100}
+    max_limit=1000
+    # допустимые фильтры
+    filters={"ps": ("name", "user", "sort", "limit"), "ss": ("port", "state", "proto", "limit")}
+    # сортировка ps
+    sort_keys={"cpu": "-pcpu", "rss": "-rss"}
+    # состояния и протоколы ss
+    states=("all", "connected", "synchronized", "bucket", "big", "established", "syn-sent", "syn-recv",
+            "fin-wait-1", "fin-wait-2", "time-wait", "closed", "close-wait", "last-ack", "listening", "closing")
+    protocols={"tcp": "-t", "udp": "-u", "unix": "-x"}
+    # группы состояний: ss выводит столбец State (для одного состояния - нет)
+    state_groups=("all", "connected", "synchronized", "bucket", "big")
+    usage={
+        "ps": "Фильтры: name=подстрока user=имя sort=cpu|rss limit=N (по-умолчанию sort=cpu limit=30)",
+        "ss": "Фильтры: port=N state=established|listening|... proto=tcp|udp|unix limit=N (по-умолчанию tcp и udp, limit=100)",
+    }
+
+    def build(self, kind: str, filters: dict, state: str=None):
+        """Командная строка и функция разбора вывода.
+        ValueError - при недопустимом фильтре
+
+        :param kind: ps или ss
+        :param filters: фильтры имя - значение
+        :param state: состояние сокетов по-умолчанию (ss)
+        """
+        for key, value in filters.items():
+            if key not in self.filters[kind]:
+                raise ValueError(f"Неизвестный фильтр {key}")
+            if not remote_execution.safe_args_regex.match(value):
+                raise ValueError(f"Недопустимое значение {key}")
+        try:
+            limit=int(filters.get("limit", self.default_limit[kind]))
+        except ValueError:
+            raise ValueError("limit должен быть числом")
+        if not 0 < limit <= self.max_limit:
+            raise ValueError(f"limit - от 1 до {self.max_limit}")
+        if kind == "ps":
+            sort=self.sort_keys.get(filters.get("sort", "cpu"))
+            if not sort:
+                raise ValueError("sort - cpu или rss")
+            select=f"-u {filters['user']}" if "user" in filters else "-e"
+            cmd=f"ps {select} -o pid=,user:32=,pcpu=,rss=,stat=,comm= --sort={sort}"
+            if "name" in filters:
+                cmd += f" | awk 'index($6, \"{filters['name']}\")'"
+            return cmd+f" | head -n {limit}", lambda output: self.render_ps(self.parse_ps(output), limit)
+        state=filters.get("state", state)
+        if state and state not in self.states:
+            raise ValueError(f"Неизвестное состояние {state}")
+        proto=filters.get("proto")
+        if proto and proto not in self.protocols:
+            raise ValueError("proto - tcp, udp или unix")
+        cmd=f"ss -Hna {self.protocols[proto] if proto else '-tu'}"
+        if state:
+            cmd += f" state {state}"
+        if "port" in filters:
+            if not filters["port"].isdigit():
+                raise ValueError("port должен быть числом")
+            cmd += f" '( sport = :{filters['port']} or dport = :{filters['port']} )'"
+        # с фильтром одного состояния ss не выводит столбец State
+        single=state if state not in self.state_groups else None
+        return cmd+f" | head -n {limit}", lambda output: self.render_ss(self.parse_ss(output, single), limit)
+
+    @staticmethod
+    def parse_ps(output: str):
+        """Разбор ps -o pid,user,pcpu,rss,stat,comm
+
+        :param output: вывод
+        """
+        records=[]
+        for line in output.splitlines():
+            fields=line.split(None, 5)
+            if len(fields) < 6 or not fields[0].isdigit():
+                continue
+            try:
+                records.append({"pid": int(fields[0]), "user": fields[1], "cpu": float(fields[2]),
+                                "rss": int(fields[3]), "stat": fields[4], "command": fields[5]})
+            except ValueError:
+                continue
+        return records
+
+    @staticmethod
+    def parse_ss(output: str, state: str=None):
+        """Разбор ss -H: Netid [State] Recv-Q Send-Q Local Peer [Process]
+
+        :param output: вывод
+        :param state: состояние из фильтра (столбца State нет)
+        """
+        records=[]
+        for line in output.splitlines():
+            fields=line.split()
+            skip=1 if state else 2
+            if len(fields) < skip+4:
+                continue
+            records.append({"proto": fields[0], "state": state if state else fields[1],
+                            "recv_q": fields[skip], "send_q": fields[skip+1],
+                            "local": fields[skip+2], "peer": fields[skip+3]})
+        return records
+
+    @staticmethod
+    def render_ps(records: list, limit: int):
+        """Таблица процессов
+
+        :param records: записи
+        :param limit: ограничение количества
+        """
+        lines=[f"{'PID':>7} {'USER':12} {'%CPU':>5} {'RSS MB':>8} {'STAT':5} COMMAND"]
+        for r in records:
+            lines.append(f"{r['pid']:>7} {r['user'][:12]:12} {r['cpu']:>5.1f} {r['rss']/1024:>8.1f} {r['stat']:5} {r['command']}")
+        lines.append(f"Процессов: {len(records)}"+(f" (показаны первые {limit})" if len(records) >= limit else ""))
+        return "\n".join(lines)
+
+    @staticmethod
+    def render_ss(records: list, limit: int):
+        """Таблица сокетов
+
+        :param records: записи
+        :param limit: ограничение количества
+        """
+        lines=[]
+        for r in records:
+            lines.append(f"{r['proto']:5} {r['state']:11} {r['recv_q']:>6} {r['send_q']:>6} {r['local']:24} {r['peer']}")
+        lines.append(f"Сокетов: {len(records)}"+(f" (показаны первые {limit})" if len(records) >= limit else ""))
+        return "\n".join(lines)
+
+class host_sampler:
+    """Фоновый замер показателей хостов (free, uptime, mpstat).
+    Один SSH-запуск на хост за замер, разобранные значения - пачкой в БД,
+    последний вывод - для мгновенного ответа на команды"""
+
+    # разделитель выводов команд в одном запуске
+    separator="@@sample@@"
+    # максимум замеров в памяти при недоступной БД
+    max_pending=10000
+
+    @staticmethod
+    def parse_free(text: str):
+        """Разбор free -m
+
+        :param text: вывод
+        """
+        row={}
+        for line in text.splitlines():
+            fields=line.split()
+            if fields and fields[0] == "Mem:" and len(fields) >= 7:
+                row.update(mem_total=int(fields[1]), mem_used=int(fields[2]), mem_available=int(fields[6]))
+            elif fields and fields[0] == "Swap:" and len(fields) >= 3:
+                row["swap_used"]=int(fields[2])
+        return row
+
+    @staticmethod
+    def parse_uptime(text: str):
+        """Разбор uptime
+
+        :param text: вывод
+        """
+        row={}
+        m=re.search(r"(\d+)\s+users?", text)
+        if m:
+            row["users"]=int(m[1])
+        m=re.search(r"load averages?:\s*([\d.]+),?\s+([\d.]+),?\s+([\d.]+)", text)
+        if m:
+            row.update(load1=float(m[1]), load5=float(m[2]), load15=float(m[3]))
+        return row
+
+    @staticmethod
+    def parse_mpstat(text: str):
+        """Разбор mpstat: строка all по заголовку столбцов.
+        Столбцы выравниваются справа - время может занимать два поля (AM/PM)
+
+        :param text: вывод
+        """
+        header=None
+        for line in text.splitlines():
+            fields=line.split()
+            if "%idle" in fields:
+                header=fields[fields.index("CPU")+1:] if "CPU" in fields else None
+            elif header and "all" in fields:
+                values=fields[fields.index("all")+1:]
+                if len(values) != len(header):
+                    return {}
+                data=dict(zip(header, values))
+                try:
+                    return {i: float(data["%"+i[4:]].replace(",", ".")) for i in ("cpu_usr", "cpu_sys", "cpu_iowait", "cpu_idle")}
+                except (KeyError, ValueError):
+                    return {}
+        return {}
+
+    def sample(self, name: str, exec: remote_execution):
+        """Замер одного хоста. Возвращает выводы команд и строку для БД
+
+        :param name: имя хоста
+        :param exec: удаленный запуск
+        """
+        command=f"; echo {self.separator}; ".join(f"({i}) 2>&1" for i in self.commands.values())
+        outputs=exec.run(command, timeout=self.timeout).split(self.separator+"\n")
+        outputs=dict(zip(self.commands, (i.rstrip("\n") for i in outputs)))
+        row={"host": name, "ts": time.time()}
+        for comm, parse in self.parsers.items():
+            row.update(parse(outputs.get(comm, "")))
+        return {"outputs": outputs, "row": row, "time": time.monotonic()}
+
+    def collect(self):
+        """Один замер всех хостов и сохранение в БД"""
+        names=self.fleet.resolve(self.target) or []
+        for result in self.fleet.run(names, self.sample):
+            if result["error"]:
+                continue
+            with self.__lock:
+                self.__latest[result["host"]]=result["output"]
+                self.__pending.append(result["output"]["row"])
+        with self.__lock:
+            rows=list(self.__pending)
+        if not rows:
+            return
+        try:
+            self.db.add_samples(rows)
+        except psycopg2.Error as e:
+            logging.warning("host_sampler: save %s samples failed: %s", len(rows), e)
+            return
+        with self.__lock:
+            for i in rows:
+                self.__pending.popleft()
+
+    def latest(self, host: str, comm: str):
+        """Вывод команды из последнего замера и его возраст, секунд.
+        None - замера нет или он устарел
+
+        :param host: имя хоста
+        :param comm: команда бота
+        """
+        with self.__lock:
+            sample=self.__latest.get(host)
+        if not sample or comm not in sample["outputs"]:
+            return None
+        age=time.monotonic()-sample["time"]
+        if age > 2*self.interval:
+            return None
+        return sample["outputs"][comm], age
+
+    def loop(self):
+        """Замеры по расписанию и очистка старых"""
+        cleaned=0
+        while True:
+            started=time.monotonic()
+            try:
+                self.collect()
+                if time.monotonic()-cleaned > 3600:
+                    logging.info("host_sampler: %s old samples removed", self.db.drop_samples(self.retention))
+                    cleaned=time.monotonic()
+            except Exception:
+                logging.exception("host_sampler: collect failed")
+            if self.__stop.wait(max(0, self.interval-(time.monotonic()-started))):
+                return
+
+    def close(self):
+        """Завершить работу"""
+        self.__stop.set()
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config, fleet: remote_fleet, db: db, commands: dict):
+        """Инициализация и запуск фонового замера
+
+        :param config: класс с конфигурацией
+        :param fleet: группы хостов
+        :param db: база данных
+        :param commands: команды бота и их командные строки: get_free, get_uptime, get_mpstat
+        """
+        self.fleet=fleet
+        self.db=db
+        self.commands=commands
+        self.parsers={"get_free": self.parse_free, "get_uptime": self.parse_uptime, "get_mpstat": self.parse_mpstat}
+        self.interval=config.collect_interval
+        self.target=config.collect_target
+        self.retention=config.collect_retention
+        self.timeout=min(config.ssh_host_timeout, self.interval)
+        self.__lock=threading.Lock()
+        self.__latest={}
+        self.__pending=collections.deque(maxlen=self.max_pending)
+        self.__stop=threading.Event()
+        threading.Thread(target=self.loop, name="host_sampler", daemon=True).start()
+
+class executor:
+    """Пул выполнения обработчиков.
+    Задачи одного пользователя выполняются строго по порядку,
+    задачи разных пользователей - параллельно"""
+
+    # пул потоков
+    pool=None
+    # максимальное количество задач в очереди
+    max_queue=0
+
+    def submit(self, key, func, *args, name: str=None):
+        """Постановка задачи в очередь.
+        Возвращает False при переполнении очереди
+
+        :param key: ключ упорядочивания (id пользователя)
+        :param func: функция
+        :param args: аргументы функции
+        :param name: имя задачи для метрик (по-умолчанию - имя функции)
+        """
+        with self.__lock:
+            if self.__pending >= self.max_queue:
+                logging.warning("executor: queue is full (%s), reject %s", self.__pending, func.__name__)
+                metrics.inc("bot_rejected_total", handler=name or func.__name__)
+                return False
+            self.__queues.setdefault(key, collections.deque()).append((func, args, time.monotonic(), name or func.__name__))
+            self.__pending += 1
+            # задачи пользователя уже выполняются - встанет в их очередь
+            if key in self.__running:
+                return True
+            self.__running.add(key)
+        self.pool.submit(self.__run_next, key)
+        return True
+
+    def __run_next(self, key):
+        """Выполнение следующей задачи пользователя
+
+        :param key: ключ упорядочивания
+        """
+        with self.__lock:
+            func, args, queued, name = self.__queues[key].popleft()
+            self.__pending -= 1
+        started=time.monotonic()
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("executor: %s failed", name)
+        finished=time.monotonic()
+        logging.info("executor: %s queue wait %.3fs, exec %.3fs", name, started-queued, finished-started,
+                     extra={"user": key, "command": name, "duration": round(finished-started, 6)})
+        metrics.observe("bot_queue_wait_seconds", started-queued, handler=name)
+        metrics.observe("bot_handler_seconds", finished-started, handler=name)
+        with self.__lock:
+            if not self.__queues[key]:
+                del self.__queues[key]
+                self.__running.discard(key)
+                self.__lock.notify_all()
+                return
+        # следующая задача - в конец очереди пула, чтобы не занимать поток одним пользователем
+        self.pool.submit(self.__run_next, key)
+
+    def handler(self, func, result=None):
+        """Обертка обработчика telegram для выполнения в пуле
+
+        :param func: обработчик (update, context)
+        :param result: значение для диспетчера (состояние диалога)
+        """
+        def wrapper(update: Update, context):
+            # метка - команда (/get_ps), иначе имя обработчика
+            text=update.message.text if update.message and update.message.text else ""
+            name=text.split()[0][1:] if text.startswith("/") else func.__name__
+            if not self.submit(update.effective_user.id, func, update, context, name=name):
+                msg=update.callback_query.message if update.callback_query else update.message
+                self.reply(msg, "Бот перегружен, попробуйте позже")
+            return result
+        wrapper.__name__=func.__name__
+        return wrapper
+
+    def close(self):
+        """Завершить работу, дождавшись выполнения задач"""
+        with self.__lock:
+            # новые задачи не принимаются
+            self.max_queue=0
+            self.__lock.wait_for(lambda: not self.__running)
+        self.pool.shutdown(wait=True)
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config, reply=None):
+        """Инициализация пула
+
+        :param config: класс с конфигурацией
+        :param reply: ответ в чат (message, text), по-умолчанию message.reply_text
+        """
+        self.reply=reply or (lambda message, text: message.reply_text(text))
+        self.max_queue=config.workers_queue
+        metrics.histogram("bot_queue_wait_seconds", "Ожидание обработчика в очереди пула")
+        metrics.histogram("bot_handler_seconds", "Время выполнения обработчика")
+        metrics.counter("bot_rejected_total", "Отклонено при переполнении очереди")
+        metrics.gauge("bot_queue_depth", "Задач в очереди пула", func=lambda: self.__pending)
+        self.__lock=threading.Condition()
+        # очереди задач по пользователям
+        self.__queues={}
+        # пользователи, задачи которых сейчас выполняются
+        self.__running=set()
+        # задач в очередях
+        self.__pending=0
+        self.pool=ThreadPoolExecutor(max_workers=config.workers, thread_name_prefix="executor")
+
+class extractor:
+    """Поиск нескольких видов данных (email, телефоны) в тексте.
+    Текст просматривается блоками с перекрытием, в каждом блоке виды ищутся
+    независимо (совпадения разных видов могут пересекаться). По истечении
+    отведенного времени поиск прерывается с неполным результатом"""
+
+    # размер блока, символов
+    chunk=1024*1024
+    # перекрытие блоков - максимальная длина совпадения
+    overlap=256
+
+    def scan(self, text, deadline: float=None, kinds: list=None):
+        """Генератор совпадений: (вид, нормализованное значение, начало, конец).
+        Совпадение на границе блоков находится ровно один раз.
+        В пределах блока совпадения идут по видам, внутри вида - по порядку
+
+        :param text: строка, байты или mmap
+        :param deadline: момент прерывания поиска (time.monotonic)
+        :param kinds: нужные виды (None - все)
+        """
+        is_str=isinstance(text, str)
+        regexes=self.regexes if is_str else self.bytes_regexes
+        kinds=kinds or list(regexes)
+        # позиция продолжения поиска для каждого вида
+        positions=dict.fromkeys(kinds, 0)
+        pos=0
+        length=len(text)
+        while pos < length:
+            if deadline and time.monotonic() > deadline:
+                raise TimeoutError(f"extractor: timeout at {pos} of {length}")
+            chunk_end=min(pos+self.chunk, length)
+            for kind in kinds:
+                # совпадения, начатые в блоке, дочитываются в перекрытии
+                for match in regexes[kind].finditer(text, positions[kind], min(chunk_end+self.overlap, length)):
+                    if match.start() >= chunk_end:
+                        break
+                    value=match.group()
+                    if not is_str:
+                        value=value.decode("ascii")
+                    yield kind, self.normalizers[kind](value), match.start(), match.end()
+                    positions[kind]=match.end()
+                positions[kind]=max(positions[kind], chunk_end)
+            pos=chunk_end
+
+    def extract(self, text, kinds: list=None):
+        """Поиск с нормализацией и удалением дублей.
+        Возвращает словарь: matches (вид - {значение: позиция первого вхождения}),
+        truncated (прервано по времени), size, seconds
+
+        :param text: строка
+        :param kinds: нужные виды (None - все)
+        """
+        started=time.monotonic()
+        matches={kind: {} for kind in (kinds or self.normalizers)}
+        truncated=False
+        try:
+            for kind, value, start, end in self.scan(text, started+self.timeout, list(matches)):
+                matches[kind].setdefault(value, start)
+        except TimeoutError as e:
+            logging.warning(str(e))
+            truncated=True
+        seconds=time.monotonic()-started
+        logging.debug("extractor: %s chars in %.3fs (%.1f MB/s)", len(text), seconds, len(text)/max(seconds, 1e-9)/1e6)
+        return {"matches": matches, "truncated": truncated, "size": len(text), "seconds": seconds}
+
+    @staticmethod
+    def unique(values):
+        """Генератор значений без повторов
+
+        :param values: итератор значений
+        """
+        seen=set()
+        for value in values:
+            if value not in seen:
+                seen.add(value)
+                yield value
+
+    def scan_file(self, path: str, kind: str):
+        """Генератор нормализованных значений одного вида из файла.
+        Файл отображается в память и просматривается блоками
+
+        :param path: путь к файлу
+        :param kind: вид значений
+        """
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                matches=self.scan(data, kinds=[kind])
+                try:
+                    for match_kind, value, start, end in matches:
+                        yield value
+                finally:
+                    # освобождение буфера mmap до его закрытия
+                    matches.close()
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, patterns: dict, normalizers: dict, config: config):
+        """Инициализация поиска
+
+        :param patterns: вид - регулярное выражение
+        :param normalizers: вид - функция нормализации
+        :param config: класс с конфигурацией
+        """
+        # выражение на каждый вид: совпадения разных видов не вытесняют друг друга
+        self.regexes={kind: re.compile(pattern) for kind, pattern in patterns.items()}
+        # то же для файлов (байты)
+        self.bytes_regexes={kind: re.compile(pattern.encode()) for kind, pattern in patterns.items()}
+        self.normalizers=normalizers
+        self.timeout=config.extract_timeout
+
+class session_store:
+    """Хранилище пользовательских сессий: незавершенный вывод, данные для сохранения.
+    Вытеснение по LRU и времени жизни, общий лимит памяти и количества.
+    Опционально копия хранится в PostgreSQL - переживает перезапуск
+    и доступна нескольким экземплярам бота"""
+
+    # интервал очистки устаревших сессий, секунд
+    sweep_interval=60
+
+    @classmethod
+    def estimate_size(cls, value):
+        """Приблизительный размер значения в памяти, байт
+
+        :param value: значение
+        """
+        if isinstance(value, dict):
+            return sys.getsizeof(value)+sum(cls.estimate_size(k)+cls.estimate_size(v) for k, v in value.items())
+        if isinstance(value, (list, tuple, set, collections.deque)):
+            return sys.getsizeof(value)+sum(cls.estimate_size(i) for i in value)
+        return sys.getsizeof(value)
+
+    def register(self, namespace: str, ttl: int, max_items: int=None, on_evict=None, dump=None, load=None, max_bytes: int=None):
+        """Регистрация вида сессий
+
+        :param namespace: имя вида
+        :param ttl: время жизни без обращений, секунд
+        :param max_items: максимум сессий этого вида
+        :param max_bytes: лимит памяти сессий этого вида, байт
+        :param on_evict: вызывается для вытесненного значения
+        :param dump: преобразование значения в JSON-совместимое для PostgreSQL (None - только память)
+        :param load: обратное преобразование
+        """
+        self.__namespaces[namespace]={
+            "ttl": ttl,
+            "max_items": max_items,
+            "max_bytes": max_bytes,
+            "on_evict": on_evict,
+            "dump": dump,
+            "load": load,
+            "items": 0,
+            "bytes": 0,
+        }
+
+    def attach(self, db):
+        """Подключение хранения в PostgreSQL
+
+        :param db: работа с базой данных
+        """
+        self.db=db
+
+    def __remove(self, full_key):
+        """Удаление из памяти, под блокировкой
+
+        :param full_key: (вид, ключ)
+        """
+        item=self.__items.pop(full_key)
+        self.__bytes -= item["size"]
+        self.__namespaces[full_key[0]]["items"] -= 1
+        self.__namespaces[full_key[0]]["bytes"] -= item["size"]
+        return item
+
+    def __evict(self, now: float):
+        """Вытеснение устаревших и лишних сессий, под блокировкой.
+        Возвращает вытесненные (вид, значение) - обрабатываются вне блокировки
+
+        :param now: текущее время
+        """
+        evicted=[]
+        # устаревшие - полный проход не чаще sweep_interval
+        if now-self.__swept > self.sweep_interval:
+            self.__swept=now
+            for full_key in [k for k, v in self.__items.items() if v["expires"] <= now]:
+                evicted.append((full_key[0], self.__remove(full_key)["value"]))
+                self.expired += 1
+        # лимиты вида
+        for namespace, ns in self.__namespaces.items():
+            if ns["max_items"] is not None and ns["items"] > ns["max_items"]:
+                for full_key in [k for k in self.__items if k[0] == namespace][:ns["items"]-ns["max_items"]]:
+                    evicted.append((namespace, self.__remove(full_key)["value"]))
+                    self.evictions += 1
+            if ns["max_bytes"] is not None and ns["bytes"] > ns["max_bytes"]:
+                for full_key in [k for k in self.__items if k[0] == namespace]:
+                    if ns["bytes"] <= ns["max_bytes"]:
+                        break
+                    evicted.append((namespace, self.__remove(full_key)["value"]))
+                    self.evictions += 1
+        # общие лимиты - самые давние по обращению
+        while self.__items and (self.__bytes > self.max_bytes or len(self.__items) > self.max_items):
+            full_key=next(iter(self.__items))
+            evicted.append((full_key[0], self.__remove(full_key)["value"]))
+            self.evictions += 1
+        return evicted
+
+    def __on_evict(self, evicted: list):
+        """Обработка вытесненных значений
+
+        :param evicted: список (вид, значение)
+        """
+        for namespace, value in evicted:
+            logging.debug("session_store: evict %s", namespace)
+            if self.__namespaces[namespace]["on_evict"]:
+                self.__namespaces[namespace]["on_evict"](value)
+
+    def __db_run(self, func):
+        """Запрос к PostgreSQL; ошибки не прерывают работу с памятью
+
+        :param func: функция работы с курсором
+        """
+        try:
+            return self.db.run(func)
+        except Exception as e:
+            logging.warning("session_store: database error: %s", e)
+            return None
+
+    def get(self, namespace: str, key):
+        """Получение значения, None - нет или устарело
+
+        :param namespace: вид сессии
+        :param key: ключ
+        """
+        full_key=(namespace, key)
+        ns=self.__namespaces[namespace]
+        now=time.monotonic()
+        evicted=[]
+        with self.__lock:
+            item=self.__items.get(full_key)
+            if item and item["expires"] <= now:
+                evicted.append((namespace, self.__remove(full_key)["value"]))
+                self.expired += 1
+                item=None
+            if item:
+                self.hits += 1
+                item["expires"]=now+ns["ttl"]
+                self.__items.move_to_end(full_key)
+                return item["value"]
+        self.__on_evict(evicted)
+        if self.db and ns["dump"]:
+            def select(cursor):
+                cursor.execute("SELECT value FROM sessions WHERE namespace=%s AND key=%s AND expires > now()", (namespace, str(key)))
+                return cursor.fetchone()
+            row=self.__db_run(select)
+            if row:
+                self.hits += 1
+                value=ns["load"](row[0])
+                self.set(namespace, key, value, persist=False)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, namespace: str, key, value, size: int=None, persist: bool=True):
+        """Сохранение значения
+
+        :param namespace: вид сессии
+        :param key: ключ
+        :param value: значение
+        :param size: размер значения в памяти (если не указан - оценивается)
+        :param persist: сохранить копию в PostgreSQL
+        """
+        full_key=(namespace, key)
+        ns=self.__namespaces[namespace]
+        if size is None:
+            size=self.estimate_size(value)
+        now=time.monotonic()
+        with self.__lock:
+            if full_key in self.__items:
+                self.__remove(full_key)
+            self.__items[full_key]={"value": value, "size": size, "expires": now+ns["ttl"]}
+            self.__bytes += size
+            ns["items"] += 1
+            ns["bytes"] += size
+            evicted=self.__evict(now)
+        self.__on_evict(evicted)
+        if persist and self.db and ns["dump"]:
+            data=json.dumps(ns["dump"](value))
+            def upsert(cursor):
+                cursor.execute("INSERT INTO sessions (namespace, key, value, expires) "
+                               +"VALUES (%s, %s, %s, now() + %s * interval '1 second') "
+                               +"ON CONFLICT (namespace, key) DO UPDATE SET value=EXCLUDED.value, expires=EXCLUDED.expires",
+                               (namespace, str(key), data, ns["ttl"]))
+                # устаревшие сессии всех экземпляров
+                cursor.execute("DELETE FROM sessions WHERE expires < now() - interval '1 hour'")
+            self.__db_run(upsert)
+
+    def pop(self, namespace: str, key):
+        """Извлечение значения с удалением
+
+        :param namespace: вид сессии
+        :param key: ключ
+        """
+        ns=self.__namespaces[namespace]
+        with self.__lock:
+            item=self.__items.get((namespace, key))
+            if item:
+                self.__remove((namespace, key))
+        value=item["value"] if item and item["expires"] > time.monotonic() else None
+        if self.db and ns["dump"]:
+            def delete(cursor):
+                cursor.execute("DELETE FROM sessions WHERE namespace=%s AND key=%s RETURNING value, expires > now()", (namespace, str(key)))
+                return cursor.fetchone()
+            row=self.__db_run(delete)
+            if value is None and row and row[1]:
+                value=ns["load"](row[0])
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        """Статистика хранилища"""
+        with self.__lock:
+            return {
+                "items": len(self.__items),
+                "bytes": self.__bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "namespaces": {k: {"items": v["items"], "bytes": v["bytes"]} for k, v in self.__namespaces.items()},
+            }
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config):
+        """Инициализация хранилища. Хранение в PostgreSQL - после attach()
+
+        :param config: класс с конфигурацией
+        """
+        self.max_bytes=config.session_memory
+        self.max_items=config.session_items
+        self.db=None
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.expired=0
+        self.__lock=threading.Lock()
+        self.__namespaces={}
+        # сессии в порядке последнего обращения
+        self.__items=collections.OrderedDict()
+        self.__bytes=0
+        self.__swept=time.monotonic()
+        # метрики; память постраничного вывода - session_bytes{namespace="more"}
+        metrics.gauge("session_items", "Сессий в памяти",
+                      func=lambda: {(("namespace", k),): v["items"] for k, v in self.stats()["namespaces"].items()})
+        metrics.gauge("session_bytes", "Память сессий, байт",
+                      func=lambda: {(("namespace", k),): v["bytes"] for k, v in self.stats()["namespaces"].items()})
+        metrics.counter("session_events_total", "Обращения и вытеснения сессий",
+                        func=lambda: {(("event", k),): self.stats()[k] for k in ("hits", "misses", "evictions", "expired")})
+
+class snapshot_diff:
+    """Изменения вывода команды относительно прошлого снимка.
+    Снимок компактный: 64-битные хэши строк для сравнения и сжатый текст -
+    распаковывается, только если есть удаленные строки"""
+
+    # максимум строк в снимке (больше - снимок не сохраняется)
+    max_lines=200000
+
+    def diff(self, key, text: str, header: str=None):
+        """Отчет об изменениях и сохранение нового снимка.
+        Сравнение - мультимножество строк, порядок не учитывается, O(n)
+
+        :param key: ключ снимка (пользователь, команда, аргументы)
+        :param text: текущий вывод
+        :param header: изменчивая сводка (время, количество) - выводится перед отчетом, в снимок не входит
+        """
+        if header:
+            return header+"\n"+self.diff(key, text)
+        lines=text.split("\n")
+        if len(lines) > self.max_lines:
+            return f"[diff недоступен: больше {self.max_lines} строк]\n"+text
+        # hash() стабилен в пределах процесса, снимки хранятся только в памяти
+        hashes=array.array("q", map(hash, lines))
+        old=self.sessions.get("snapshot", key)
+        compressed=zlib.compress(text.encode(), 1)
+        self.sessions.set("snapshot", key, {"hashes": hashes, "text": compressed},
+                          size=hashes.itemsize*len(hashes)+len(compressed)+256)
+        if old is None:
+            return f"[снимок сохранен: {len(lines)} строк, следующий вызов с diff покажет изменения]\n"+text
+        remaining=collections.Counter(old["hashes"])
+        added=[]
+        for h, line in zip(hashes, lines):
+            if remaining[h] > 0:
+                remaining[h] -= 1
+            else:
+                added.append(line)
+        removed=[]
+        if +remaining:
+            for line in zlib.decompress(old["text"]).decode().split("\n"):
+                h=hash(line)
+                if remaining[h] > 0:
+                    remaining[h] -= 1
+                    removed.append(line)
+        if not added and not removed:
+            return f"Без изменений ({len(lines)} строк)"
+        return "\n".join([f"Изменений: +{len(added)} -{len(removed)}"]+["+ "+i for i in added]+["- "+i for i in removed])
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, sessions: session_store):
+        """Инициализация. Снимки - в хранилище сессий, вид snapshot
+
+        :param sessions: хранилище сессий
+        """
+        self.sessions=sessions
+
+class pager:
+    """Постраничный вывод.
+    Страницы строятся лениво по мере нажатия --More--, в памяти хранится
+    не более заданного количества готовых страниц на пользователя.
+    Источник с открытым ssh-каналом не ждет пользователя: после первой
+    страницы остаток выгружается во временный файл, канал закрывается.
+    Остальные источники (текст, постраничное чтение БД) читаются лениво"""
+
+    # готовых страниц на пользователя
+    max_pages=0
+    # лимит временного файла на пользователя, байт
+    max_spool=0
+
+    @staticmethod
+    def escape_code(text:str):
+        """Экранирование текста для блока кода MarkdownV2
+
+        :param text: текст
+        """
+        return text.replace('\\', '\\\\').replace('`', '\\`')
+
+    @classmethod
+    def paginate(cls, lines, max_char:int=3096, max_lines:int=500):
+        """Генератор страниц: строки собираются в страницы по мере поступления.
+        Страницы уже экранированы для блока кода MarkdownV2
+
+        :param lines: итератор строк
+        :param max_char: максимальный размер одного блока
+        :param max_lines: максимальное количество строк
+        """
+        page=[]
+        page_chars=0
+        for line in lines:
+            line=line.rstrip("\r")
+            # делим строки при выходе за границы размера
+            parts=[cls.escape_code(line[i:i+max_char]) for i in range(0, len(line), max_char)] or [""]
+            if max(len(i) for i in parts) > max_char:
+                # экранирование может удвоить длину
+                half=max_char//2
+                parts=[cls.escape_code(line[i:i+half]) for i in range(0, len(line), half)]
+            for part in parts:
+                # если переполнено - то новая страница
+                if page and ((page_chars+len(part)+1 > max_char) or (len(page) >= max_lines)):
+                    yield "\n".join(page)
+                    page=[]
+                    page_chars=0
+                page.append(part)
+                page_chars += len(part)+1
+        if page:
+            yield "\n".join(page)
+
+    def __fill(self, entry:dict):
+        """Опережающее чтение страниц до заполнения буфера
+
+        :param entry: буфер пользователя
+        """
+        while entry["pages"] and len(entry["buffer"]) < self.max_pages:
+            page=next(entry["pages"], None)
+            if page is None:
+                # вывод закончился - источник (например, ssh-канал) освобожден
+                entry["pages"]=None
+                entry["total"]=entry["current"]+len(entry["buffer"])
+                break
+            entry["buffer"].append(page)
+
+    @staticmethod
+    def close_entry(entry:dict):
+        """Закрытие источника страниц
+
+        :param entry: буфер пользователя
+        """
+        if entry and entry["pages"]:
+            try:
+                entry["pages"].close()
+            except ValueError:
+                # генератор сейчас выполняется в другом потоке
+                pass
+
+    @staticmethod
+    def dump(entry:dict):
+        """Сохраняемая часть буфера: готовые страницы
+
+        :param entry: буфер пользователя
+        """
+        return {"buffer": list(entry["buffer"]), "current": entry["current"],
+                "total": entry["total"], "estimate": entry["estimate"]}
+
+    @staticmethod
+    def load(data:dict):
+        """Буфер из сохраненного. Источник страниц не восстанавливается
+
+        :param data: сохраненная часть буфера
+        """
+        return {"pages": None, "buffer": collections.deque(data["buffer"]), "current": data["current"],
+                "total": data["total"], "estimate": data["estimate"]}
+
+    @staticmethod
+    def iter_lines(text:str):
+        """Ленивый разбор текста на строки: без списка всех строк в памяти
+
+        :param text: текст
+        """
+        start=0
+        while start < len(text):
+            end=text.find("\n", start)
+            if end < 0:
+                end=len(text)
+            yield text[start:end]
+            start=end+1
+
+    def __store(self, id, entry:dict):
+        """Сохранение буфера в хранилище сессий.
+        Пока источник не прочитан - в размере учитывается и исходный текст
+
+        :param id: id пользователя
+        :param entry: буфер пользователя
+        """
+        size=sum(sys.getsizeof(i) for i in entry["buffer"])+1024
+        if entry["pages"]:
+            size += entry.get("source_size", 0)
+        self.sessions.set("more", id, entry, size=size)
+
+    def open(self, id, text, max_char:int=3096, max_lines:int=500, estimate:int=None):
+        """Новый вывод для пользователя
+
+        :param id: id пользователя
+        :param text: текст или итератор строк
+        :param max_char: максимальный размер одного блока
+        :param max_lines: максимальное количество строк
+        :param estimate: оценка количества страниц
+        """
+        source_size=0
+        if isinstance(text, str):
+            source_size=sys.getsizeof(text)
+            text=self.iter_lines(text)
+        entry={
+            "pages": self.paginate(text, max_char, max_lines),
+            "buffer": collections.deque(),
+            "current": 0,
+            "total": None,
+            "estimate": estimate,
+            "source_size": source_size,
+            # открытый ssh-канал - выгружается после первой страницы
+            "live": isinstance(text, ssh_stream),
+        }
+        self.__fill(entry)
+        self.close(id)
+        self.__store(id, entry)
+
+    def next_page(self, id):
+        """Следующая страница пользователя.
+        Возвращает словарь text, current, total (None - неизвестно),
+        estimate (оценка total), more или None если данных нет
+
+        :param id: id пользователя
+        """
+        entry=self.sessions.get("more", id)
+        if not entry or not entry["buffer"]:
+            self.close(id)
+            return None
+        page=entry["buffer"].popleft()
+        entry["current"] += 1
+        self.__fill(entry)
+        more=bool(entry["buffer"])
+        if more:
+            self.__store(id, entry)
+        else:
+            self.close(id)
+        # оценка не может быть меньше уже показанного
+        estimate=entry["estimate"] and max(entry["estimate"], entry["current"]+1)
+        return {"text": page, "current": entry["current"], "total": entry["total"], "estimate": estimate, "more": more}
 
+    @staticmethod
+    def read_spool(spool):
+        """Страницы из временного файла. Закрытие генератора удаляет файл
 
-class remote_execution:
-    """Удаленный запуск"""
-    # клиент
-    client=None
+        :param spool: временный файл, страница - строка JSON
+        """
+        with spool:
+            for line in spool:
+                yield json.loads(line)
 
-    safe_args_regex=re.compile('^[a-zA-Z0-9.,_-]+$')
+    def spool(self, id):
+        """Выгрузка остатка вывода ssh-команды во временный файл и закрытие канала.
+        Вывод сверх лимита MORE_SPOOL обрезается (сам вывод ограничен SSH_MAX_OUTPUT)
 
-    def run_pipes(self, command:str, args:dict={}):
-        """Выполнение удаленной команды.
-        Возвращает сырые пайпы
-        
-        :param command: команда
-        :param args: аргументы
+        :param id: id пользователя
         """
-        # проверка аргументов
-        for a in args:
-            if not self.safe_args_regex.match(args[a]):
-                logging.warning(f"remote_execution.run_pipes: unsafe argument: {args[a]}")
+        entry=self.sessions.get("more", id)
+        if not entry or not entry["pages"] or not entry.get("live"):
+            return
+        spool=tempfile.TemporaryFile("w+", encoding="utf-8")
+        size=0
+        pages=0
+        try:
+            for page in entry["pages"]:
+                if size+len(page) > self.max_spool:
+                    page=f"... вывод обрезан: больше {self.max_spool} байт"
+                    spool.write(json.dumps(page)+"\n")
+                    pages += 1
+                    break
+                spool.write(json.dumps(page)+"\n")
+                size += len(page)
+                pages += 1
+        except BaseException:
+            spool.close()
+            raise
+        finally:
+            # источник освобождается сразу
+            self.close_entry(entry)
+        spool.seek(0)
+        entry["pages"]=self.read_spool(spool)
+        entry["live"]=False
+        entry["total"]=entry["current"]+len(entry["buffer"])+pages
+        self.__store(id, entry)
+
+    def close(self, id):
+        """Сброс вывода пользователя
+
+        :param id: id пользователя
+        """
+        self.close_entry(self.sessions.pop("more", id))
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config, sessions: session_store):
+        """Инициализация постраничного вывода
+
+        :param config: класс с конфигурацией
+        :param sessions: хранилище сессий
+        """
+        self.max_pages=config.more_pages
+        self.max_spool=config.more_spool
+        self.sessions=sessions
+        # буферы пользователей: вытеснение закрывает источник (освобождает ssh-канал)
+        self.sessions.register("more", config.more_ttl, config.more_users,
+                               on_evict=self.close_entry, dump=self.dump, load=self.load)
+
+class result_cache:
+    """Кэш результатов с ограниченным временем жизни.
+    Одинаковые запросы, которые уже выполняются, ждут общий результат"""
+
+    def get(self, key, ttl:float, func, retry: tuple=()):
+        """Получение значения из кэша или его вычисление.
+        Возвращает значение и его возраст в секундах
+
+        :param key: ключ
+        :param ttl: время жизни значения, секунд
+        :param func: функция получения значения
+        :param retry: ошибки лидера, которые относятся только к нему (например, отказ в допуске) -
+                      ожидающие не получают их, а повторяют запрос сами
+        """
+        while True:
+            value=self.__get(key, ttl, func, retry)
+            if value is not None:
+                return value
+
+    def __get(self, key, ttl:float, func, retry: tuple):
+        """Одна попытка получения значения. None - ошибка лидера из retry, нужен повтор
+
+        :param key: ключ
+        :param ttl: время жизни значения, секунд
+        :param func: функция получения значения
+        :param retry: ошибки лидера, после которых ожидающие повторяют запрос
+        """
+        with self.__lock:
+            cached=self.__values.get(key)
+            if cached and time.monotonic()-cached[1] < ttl:
+                logging.debug("result_cache: hit %s", key)
+                return cached[0], time.monotonic()-cached[1]
+            flight=self.__in_flight.get(key)
+            leader=flight is None
+            if leader:
+                flight={"done": threading.Event(), "value": None, "error": None}
+                self.__in_flight[key]=flight
+        if not leader:
+            # такой же запрос уже выполняется - ждем его результат
+            logging.debug("result_cache: wait in-flight %s", key)
+            flight["done"].wait()
+            if isinstance(flight["error"], retry):
                 return None
-        # конечная строка
-        real_comm=command.format_map(args)
-        # запуск
-        logging.debug(f"remote_execution.run: try to run {real_comm}")
-        return self.client.exec_command(real_comm)
+            if flight["error"]:
+                raise flight["error"]
+            return flight["value"], 0
+        logging.debug("result_cache: miss %s", key)
+        try:
+            flight["value"]=func()
+        except Exception as e:
+            flight["error"]=e
+            raise
+        finally:
+            with self.__lock:
+                if flight["value"] is not None:
+                    self.__values[key]=(flight["value"], time.monotonic())
+                del self.__in_flight[key]
+            flight["done"].set()
+        return flight["value"], 0
 
-    def run(self, command:str, args:list=[]):
-        """Выполнение удаленной команды.
-        Возвращает конечную стоку.
-        
-        :param command: команда
-        :param args: аргументы
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self):
+        """Инициализация кэша"""
+        self.__lock=threading.Lock()
+        # значения и время их получения
+        self.__values={}
+        # выполняющиеся запросы
+        self.__in_flight={}
+
+class admission_rejected(Exception):
+    """Отказ в допуске. wait - оценка времени до возможного допуска, секунд"""
+    def __init__(self, wait: float):
+        super().__init__(f"retry in {wait:.0f}s")
+        self.wait=wait
+
+class admission:
+    """Допуск удаленных команд: ведро токенов на пользователя, общий лимит
+    одновременной нагрузки и справедливая очередь между пользователями.
+    Стоимость команды расходует токены и занимает часть общего лимита"""
+
+    # максимум хранимых ведер (полные удаляются при превышении)
+    max_buckets=1000
+
+    def __take(self, user, cost: float, now: float):
+        """Расход токенов пользователя, под блокировкой.
+        Возвращает 0 или время до накопления нужного количества, секунд
+
+        :param user: пользователь
+        :param cost: стоимость
+        :param now: текущее время
         """
-        pipes=self.run_pipes(command=command, args=args)
-        if not pipes:
-            logging.warning(f"remote_execution.run: unable to get data")
-            return None
-        data = pipes[1].read()+pipes[2].read()
-        data = str(data).replace('\\n', '\n').replace('\\t', '\t')[2:-1]
-        return data
+        tokens, last=self.__buckets.get(user, (self.burst, now))
+        tokens=min(self.burst, tokens+(now-last)*self.rate)
+        if tokens < cost:
+            self.__buckets[user]=(tokens, now)
+            return (cost-tokens)/self.rate
+        self.__buckets[user]=(tokens-cost, now)
+        if len(self.__buckets) > self.max_buckets:
+            for key in [k for k, (t, l) in self.__buckets.items() if t+(now-l)*self.rate >= self.burst]:
+                del self.__buckets[key]
+        return 0
 
-    def close(self):
-        """Завершить работу"""
-        self.client.close()
+    def __cancel(self, user, ticket, cost: float):
+        """Снятие билета с очереди и возврат токенов, под блокировкой
+
+        :param user: пользователь
+        :param ticket: билет очереди
+        :param cost: стоимость
+        """
+        self.__queue.remove((ticket, cost))
+        heapq.heapify(self.__queue)
+        tokens, last=self.__buckets.get(user, (self.burst, time.monotonic()))
+        self.__buckets[user]=(min(self.burst, tokens+cost), last)
+        self.__cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, user, cost: float=1, on_wait=None):
+        """Допуск команды: при нехватке токенов или слишком долгой очереди - admission_rejected,
+        при занятом общем лимите - ожидание в справедливой очереди
+
+        :param user: пользователь
+        :param cost: стоимость команды
+        :param on_wait: вызывается с оценкой ожидания, если команда ждет в очереди
+        """
+        cost=min(cost, self.capacity, self.burst)
+        with self.__cond:
+            now=time.monotonic()
+            wait=self.__take(user, cost, now)
+            if wait:
+                metrics.inc("admission_rejected_total", reason="rate")
+                raise admission_rejected(wait)
+            # метка справедливой очереди: пользователь, много потративший недавно, - позже
+            tag=max(self.__vtime, self.__tags.get(user, 0))+cost
+            ticket=(tag, next(self.__seq))
+            ready=lambda: self.__queue[0][0] == ticket and self.__used+cost <= self.capacity
+            heapq.heappush(self.__queue, (ticket, cost))
+            estimate=None
+            if not ready():
+                ahead=sum(c for t, c in self.__queue if t < ticket)
+                estimate=max(self.__used+ahead+cost-self.capacity, 1)*self.__unit_seconds
+                # ожидание занимает поток пула обработчиков - их число ограничено
+                if estimate > self.max_wait or self.__waiting >= self.max_waiting:
+                    self.__cancel(user, ticket, cost)
+                    metrics.inc("admission_rejected_total", reason="queue")
+                    raise admission_rejected(estimate)
+                self.__waiting += 1
+            self.__tags[user]=tag
+        try:
+            if estimate is not None and on_wait:
+                on_wait(estimate)
+            with self.__cond:
+                self.__cond.wait_for(ready)
+        except BaseException:
+            # билет не должен остаться в голове очереди - иначе допуск остановится для всех
+            with self.__cond:
+                self.__cancel(user, ticket, cost)
+                if estimate is not None:
+                    self.__waiting -= 1
+            raise
+        with self.__cond:
+            if estimate is not None:
+                self.__waiting -= 1
+            heapq.heappop(self.__queue)
+            self.__used += cost
+            self.__vtime=tag
+            # следующая в очереди может уместиться в остаток лимита
+            self.__cond.notify_all()
+        metrics.observe("admission_wait_seconds", time.monotonic()-now)
+        started=time.monotonic()
+        try:
+            yield
+        finally:
+            with self.__cond:
+                self.__used -= cost
+                # время выполнения единицы стоимости - для оценки ожидания
+                self.__unit_seconds=0.8*self.__unit_seconds+0.2*(time.monotonic()-started)/cost
+                if not self.__queue:
+                    self.__tags.clear()
+                self.__cond.notify_all()
 
     ##
     # Инициализация класса
-    ## 
+    ##
     def __init__(self, config: config):
-        """Инициализация удаленного подключения
+        """Инициализация
 
         :param config: класс с конфигурацией
         """
-        self.client=paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.client.connect(
-            hostname=config.ssh_host,
-            port=config.ssh_port,
-            username=config.ssh_user,
-            password=config.ssh_pass
-        )
+        self.rate=config.admit_rate
+        self.burst=config.admit_burst
+        self.capacity=config.admit_capacity
+        self.max_wait=config.admit_max_wait
+        self.max_waiting=config.admit_max_waiting or max(1, config.workers//2)
+        # команд в ожидании
+        self.__waiting=0
+        self.__cond=threading.Condition()
+        # пользователь - (токены, время расчета)
+        self.__buckets={}
+        # очередь: ((метка, номер), стоимость); занятый лимит
+        self.__queue=[]
+        self.__seq=itertools.count()
+        self.__used=0
+        # виртуальное время очереди и последние метки пользователей
+        self.__vtime=0
+        self.__tags={}
+        # оценка времени выполнения единицы стоимости, секунд
+        self.__unit_seconds=1.0
+        metrics.counter("admission_rejected_total", "Отказано в допуске удаленной команды")
+        metrics.histogram("admission_wait_seconds", "Ожидание допуска удаленной команды")
+        metrics.gauge("admission_used", "Занятая общая нагрузка удаленных команд", func=lambda: self.__used)
 
-class db: 
-    """"Работа с базой данных"""
+class sender:
+    """Очередь отправки сообщений с учетом лимитов Telegram:
+    ведро токенов на чат и общее, приоритет интерактивных ответов,
+    повтор после RetryAfter, склейка подряд идущих коротких ответов.
+    Порядок сообщений внутри чата сохраняется, приоритет - между чатами"""
 
-    # подключение
-    conn=None
+    # приоритеты
+    interactive=0
+    bulk=1
+    background=2
+    priority_names=("interactive", "bulk", "background")
+    # максимальная длина сообщения Telegram
+    max_length=4096
+    # повторов при сетевых ошибках
+    max_attempts=3
 
-    # таблица email`ов
-    email_tbl="emails"
-    # таблица номеров телефонов
-    phones_tbl="phones"
+    @staticmethod
+    def __refill(bucket: dict, rate: float, burst: float, now: float):
+        """Пополнение ведра токенов
 
-    def close(self):
-        """Закрытие подключения к БД"""
-        self.conn.close()
+        :param bucket: словарь tokens, last
+        :param rate: токенов в секунду
+        :param burst: размер ведра
+        :param now: текущее время
+        """
+        bucket["tokens"]=min(burst, bucket["tokens"]+(now-bucket["last"])*rate)
+        bucket["last"]=now
 
-    def __init__(self, config: config):
-        """Инициализация подключение и создание базы данных
+    def send(self, chat_id, text: str, priority: int=0, **kwargs):
+        """Постановка сообщения в очередь
 
-        :param config: класс с конфигурацией
+        :param chat_id: чат
+        :param text: текст
+        :param priority: приоритет
+        :param kwargs: параметры send_message
         """
-        # подключение
-        self.conn=psycopg2.connect(
-            dbname=config.db_database,
-            user=config.db_user,
-            password=config.db_password,
-            host=config.db_host,
-            port=config.db_port,
-            options=f"-c search_path={config.db_schema}"
-        )
-        cursor = self.conn.cursor()
-        # создание структуры
-        logging.debug("Создание структуры базы данных")
-        for table in [self.email_tbl, self.phones_tbl]:
-            cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_seq INCREMENT BY 1 START 1 NO CYCLE NO MAXVALUE CACHE 1")
-            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INT DEFAULT nextval('{table}_seq') unique not null, record VARCHAR(64) not null)")
-        self.conn.commit()
-        cursor.close()
+        with self.__cond:
+            chat=self.__chats.get(chat_id)
+            if chat is None:
+                chat=self.__chats[chat_id]={"queue": collections.deque(), "busy": False, "paused": 0,
+                                           "tokens": self.chat_burst, "last": time.monotonic()}
+            chat["queue"].append({"text": text, "kwargs": kwargs, "priority": priority,
+                                  "enqueued": time.monotonic(), "attempt": 0})
+            self.__pending += 1
+            self.__cond.notify()
 
-    def get_records(self, table: str):
-        """Получение списка из базы данных
-        
-        :param table: имя таблицы"""
-        cursor = self.conn.cursor()
-        cursor.execute(f"SELECT id,record FROM {table}")
-        data=cursor.fetchall()
-        cursor.close()
-        return data
-    
-    def add_records(self, table: str, list: list):
-        """Добавление в базу данных
-        
-        :param table: имя таблицы
-        :param list: добавляемые элементы"""
-        cursor = self.conn.cursor()
-        # проще чем executemany
-        save_data=[]
-        for row in list:
-            save_data.append((row,))
-        cursor.executemany(f"INSERT INTO {table} (record) VALUES (%s)", vars_list=save_data)
-        self.conn.commit()
-        cursor.close()
-        return True
+    def __pick(self, now: float):
+        """Выбор чата для отправки, под блокировкой.
+        Возвращает id чата (None - нет готовых) и время до готовности следующего
 
-    def get_emails(self):
-        """Получение email"""
-        return self.get_records(self.email_tbl)
-    
-    def get_phones(self):
-        """Получение номеров телефонов"""
-        return self.get_records(self.phones_tbl)
-    
-    def add_emails(self, list: list):
-        """Добавление email
-        
-        :param list: добавляемые элементы"""
-        return self.add_records(self.email_tbl, list)
-    
-    def add_phones(self, list: list):
-        """Добавление номеров телефонов
-        
-        :param list: добавляемые элементы"""
-        return self.add_records(self.phones_tbl, list)
+        :param now: текущее время
+        """
+        best=None
+        wait=None
+        for chat_id, chat in list(self.__chats.items()):
+            if chat["busy"]:
+                continue
+            self.__refill(chat, self.chat_rate, self.chat_burst, now)
+            if not chat["queue"]:
+                # простаивающий чат с полным ведром не нужен
+                if chat["tokens"] >= self.chat_burst:
+                    del self.__chats[chat_id]
+                continue
+            delay=max((1-chat["tokens"])/self.chat_rate, chat["paused"]-now)
+            if delay > 0:
+                wait=delay if wait is None else min(wait, delay)
+                continue
+            head=chat["queue"][0]
+            key=(head["priority"], head["enqueued"])
+            if best is None or key < best[0]:
+                best=(key, chat_id)
+        return best and best[1], wait
+
+    def __take(self, chat: dict):
+        """Извлечение сообщения чата со склейкой подряд идущих коротких
+        текстов без разметки и кнопок, под блокировкой
+
+        :param chat: чат
+        """
+        item=chat["queue"].popleft()
+        count=1
+        while (not item["kwargs"] and chat["queue"] and not chat["queue"][0]["kwargs"]
+               and chat["queue"][0]["priority"] == item["priority"]
+               and len(item["text"])+len(chat["queue"][0]["text"])+2 <= self.max_length):
+            following=chat["queue"].popleft()
+            item=dict(item, text=item["text"]+"\n\n"+following["text"])
+            count += 1
+        if count > 1:
+            metrics.inc("telegram_coalesced_total", count-1)
+        return item, count
+
+    def worker(self):
+        """Поток отправки"""
+        while True:
+            with self.__cond:
+                while True:
+                    now=time.monotonic()
+                    if self.__stop and (not self.__pending or now > self.__stop):
+                        return
+                    chat_id, wait=self.__pick(now)
+                    if chat_id is not None:
+                        self.__refill(self.__global, self.global_rate, self.global_rate, now)
+                        if self.__global["tokens"] >= 1:
+                            break
+                        delay=(1-self.__global["tokens"])/self.global_rate
+                        wait=delay if wait is None else min(wait, delay)
+                    self.__cond.wait(wait if not self.__stop else min(wait or 0.1, 0.1))
+                chat=self.__chats[chat_id]
+                chat["busy"]=True
+                chat["tokens"] -= 1
+                self.__global["tokens"] -= 1
+                item, count=self.__take(chat)
+            retry=None
+            try:
+                # время вызова Bot API, без ожидания в очереди
+                with metrics.timer("telegram_reply_seconds", priority=self.priority_names[item["priority"]]):
+                    self.bot.send_message(chat_id=chat_id, text=item["text"], **item["kwargs"])
+                for i in range(count):
+                    self.__latency.append(time.monotonic()-item["enqueued"])
+                metrics.observe("telegram_delivery_seconds", time.monotonic()-item["enqueued"],
+                                priority=self.priority_names[item["priority"]])
+            except RetryAfter as e:
+                logging.warning("sender: flood limit for chat %s, retry after %ss", chat_id, e.retry_after)
+                metrics.inc("telegram_retry_after_total")
+                retry=e.retry_after
+            except BadRequest as e:
+                # ошибка разметки, неизвестный чат - повтор не поможет (BadRequest - подкласс NetworkError)
+                logging.warning("sender: send to chat %s rejected: %s", chat_id, e)
+                metrics.inc("telegram_send_errors_total")
+            except NetworkError as e:
+                item["attempt"] += 1
+                logging.warning("sender: chat %s attempt %s failed: %s", chat_id, item['attempt'], e)
+                if item["attempt"] < self.max_attempts:
+                    retry=item["attempt"]
+                else:
+                    metrics.inc("telegram_send_errors_total")
+            except TelegramError as e:
+                # бот заблокирован пользователем и прочее - повтор не поможет
+                logging.warning("sender: send to chat %s failed: %s", chat_id, e)
+                metrics.inc("telegram_send_errors_total")
+            with self.__cond:
+                chat["busy"]=False
+                if retry is None:
+                    self.__pending -= count
+                else:
+                    # сообщение возвращается в начало очереди чата
+                    chat["queue"].appendleft(item)
+                    chat["paused"]=time.monotonic()+retry
+                    self.__pending -= count-1
+                self.__cond.notify_all()
+
+    def quantiles(self):
+        """Задержка доставки по последним сообщениям: медиана, 95 и 99 процентили"""
+        with self.__cond:
+            values=sorted(self.__latency)
+        if not values:
+            return {}
+        return {(("quantile", q),): values[min(len(values)-1, int(len(values)*q))] for q in (0.5, 0.95, 0.99)}
+
+    def close(self, timeout: float=5):
+        """Отправка оставшихся сообщений (не дольше timeout) и остановка
+
+        :param timeout: ограничение времени, секунд
+        """
+        with self.__cond:
+            self.__stop=time.monotonic()+timeout
+            self.__cond.notify_all()
+        for thread in self.__threads:
+            thread.join(timeout)
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, config: config, bot):
+        """Инициализация и запуск потоков отправки
+
+        :param config: класс с конфигурацией
+        :param bot: telegram.Bot
+        """
+        self.bot=bot
+        self.chat_rate=config.send_chat_rate
+        self.chat_burst=config.send_chat_burst
+        self.global_rate=config.send_global_rate
+        self.__cond=threading.Condition()
+        self.__chats={}
+        self.__pending=0
+        self.__global={"tokens": self.global_rate, "last": time.monotonic()}
+        # время остановки (None - работает)
+        self.__stop=None
+        # задержки последних сообщений для процентилей
+        self.__latency=collections.deque(maxlen=1000)
+        metrics.histogram("telegram_delivery_seconds", "Задержка доставки: от постановки в очередь до отправки")
+        metrics.histogram("telegram_reply_seconds", "Отправка сообщения в telegram (sendMessage)")
+        metrics.gauge("telegram_delivery_quantile_seconds", "Процентили задержки доставки (последние 1000 сообщений)", func=self.quantiles)
+        metrics.gauge("telegram_send_queue", "Сообщений в очереди отправки", func=lambda: self.__pending)
+        metrics.counter("telegram_retry_after_total", "Ответов Telegram 429 (RetryAfter)")
+        metrics.counter("telegram_send_errors_total", "Неотправленных сообщений")
+        metrics.counter("telegram_coalesced_total", "Сообщений, склеенных с предыдущим")
+        self.__threads=[threading.Thread(target=self.worker, name=f"sender_{i}", daemon=True) for i in range(config.send_workers)]
+        for thread in self.__threads:
+            thread.start()
 
 class bot:
     """Бот"""
 
     # простое регулярное выражение для поиска email
     # да, я знаю про RFC
-    email_regex=re.compile(r'[a-zA-Z0-9+_.-]+@[a-zA-Z0-9.-]+')
+    # начало только на границе "слова": иначе на длинной строке без @
+    # попытка с каждой позиции дает квадратичное время
+    email_regex=re.compile(r'(?<![a-zA-Z0-9+_.-])[a-zA-Z0-9+_.-]+@[a-zA-Z0-9.-]+')
 
     # просто регулярное выражение для поиска номеров телефонов:
     # 8XXXXXXXXXX
@@ -256,29 +3218,131 @@ class bot:
     def do_start(self, update: Update, context):
         """/start"""
         user = update.effective_user
-        update.message.reply_text(f"Привет {user.full_name}!\nИспользуй /help для подсказки") 
+        self.reply(update.message, f"Привет {user.full_name}!\nИспользуй /help для подсказки") 
 
-    def find_re_report(self, input: str, re: re.Pattern, save_id: int=0, save_type: str=None):
-        """Поиск регулярного выражения и вывод информации
+    def find_re_report(self, input: str, kind: str, save_id: int=0):
+        """Поиск email или телефонов и вывод информации
         
         :param input: входная строка
-        :param re: регулярное выражение"""
+        :param kind: что искать - emails или phones
+        :param save_id: id пользователя для кнопки сохранения"""
         # поиск
-        search=re.findall(input)
-        logging.debug(f"find_re_report: found {len(search)}")
+        result=self.extractor.extract(input, [kind])
+        search=list(result["matches"][kind])
+        logging.debug("find_re_report: found %s", len(search))
         # если ничего не найдено - Null:
         if not search:
             return None
-        if save_id and save_id > 0 and save_type:
-            logging.debug(f"save search for do_save_button")
-            self.__save_data[save_id]={"type": save_type, "list": search}
+        if save_id and save_id > 0:
+            logging.debug("save search for do_save_button")
+            self.set_save_data(save_id, {"type": kind, "list": search})
         # формируем вывод
-        output=""
-        for i in range(len(search)):
-            output += f"{i+1}. {search[i]}\n"
+        output="\n".join(f"{i}. {value}" for i, value in enumerate(search, 1))+"\n"
+        if result["truncated"]:
+            output += "Поиск прерван по времени, результат неполный\n"
         return output
 
-    __save_data={}
+    @staticmethod
+    def drop_save_data(save_data: dict):
+        """Освобождение данных для сохранения: удаление временного файла
+
+        :param save_data: данные для сохранения
+        """
+        if save_data and save_data.get("file"):
+            try:
+                os.remove(save_data["file"])
+            except FileNotFoundError:
+                pass
+
+    def set_save_data(self, id, save_data: dict):
+        """Данные для кнопки сохранения (предыдущие освобождаются).
+        Ссылка на файл в PostgreSQL не сохраняется - файл есть только на этом хосте
+
+        :param id: id пользователя
+        :param save_data: type и list (найденное) или file (файл для повторного поиска)
+        """
+        self.drop_save_data(self.sessions.pop("save", id))
+        self.sessions.set("save", id, save_data, persist=not save_data.get("file"))
+
+    def tmp_files(self):
+        """Временные файлы поиска: список (путь, размер)"""
+        files=[]
+        with os.scandir(self.config.tmp_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("find_") and entry.is_file(follow_symlinks=False):
+                    try:
+                        files.append((entry.path, entry.stat().st_size))
+                    except FileNotFoundError:
+                        pass
+        return files
+
+    def clean_tmp(self):
+        """Создание каталога временных файлов и удаление файлов поиска,
+        оставшихся после прошлого запуска.
+        Каталог TMP_DIR не должен быть общим с другими экземплярами бота"""
+        os.makedirs(self.config.tmp_dir, mode=0o700, exist_ok=True)
+        # не подмененный каталог (ссылка, чужой) в общем /tmp
+        info=os.lstat(self.config.tmp_dir)
+        if os.path.islink(self.config.tmp_dir) or info.st_uid != os.getuid():
+            raise BaseException(f"Каталог временных файлов {self.config.tmp_dir} должен принадлежать пользователю бота")
+        for path, size in self.tmp_files():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logging.info("clean_tmp: removed %s (%s bytes)", path, size)
+
+    def find_document(self, update: Update, context, kind: str):
+        """Поиск в присланном файле: файл скачивается во временный
+        и просматривается блоками через mmap, без загрузки в память
+
+        :param kind: что искать - emails или phones
+        """
+        document=update.message.document
+        logging.info("[U:%s] find %s in document %s bytes", update.effective_user.username, kind, document.file_size)
+        if document.file_size and document.file_size > self.config.extract_max_file:
+            self.reply(update.message, f"Файл слишком большой, максимум {self.config.extract_max_file//1024//1024} МБ")
+            return
+        # общий объем временных файлов ограничен
+        if sum(i[1] for i in self.tmp_files())+(document.file_size or 0) > self.config.extract_tmp_max:
+            logging.warning("[U:%s] find %s: temporary files limit reached", update.effective_user.username, kind)
+            self.reply(update.message, "Сервер занят обработкой других файлов, повторите позже")
+            return
+        fd, path=tempfile.mkstemp(prefix="find_", dir=self.config.tmp_dir)
+        os.close(fd)
+        try:
+            document.get_file().download(custom_path=path)
+            # совпадения без дублей, по мере листания
+            values=self.extractor.scan_file(path, kind)
+            found=(f"{i}. {value}" for i, value in enumerate(extractor.unique(values), 1))
+            first=next(found, None)
+        except Exception:
+            os.remove(path)
+            raise
+        if first is None:
+            os.remove(path)
+            self.reply(update.message, "Не найдены email-адреса" if kind == "emails" else "Не найдены номера телефонов")
+            return
+        # при сохранении файл просматривается повторно - прямо в пакетную запись
+        self.set_save_data(update.effective_user.id, {"type": kind, "file": path})
+        self.reply(update.message, "Найдено в файле",
+                                  reply_markup=InlineKeyboardMarkup(
+                                            [
+                                                [InlineKeyboardButton(f"Сохранить результат", callback_data="save_search")]
+                                            ]
+                                        )
+                                    )
+        self.more(update.effective_user.id, itertools.chain([first], found))
+        self.do_more(update, context)
+
+    def find_email_document(self, update: Update, context):
+        """/find_email - поиск в файле"""
+        self.find_document(update, context, "emails")
+
+    def find_phone_number_document(self, update: Update, context):
+        """/find_phone_number - поиск в файле"""
+        self.find_document(update, context, "phones")
+
     def do_save_button(self, update: Update, context):
         """Команда поддержка работы кнопки save"""
         id=update.effective_user.id
@@ -287,23 +3351,34 @@ class bot:
             msg=update.callback_query.message
         else:
             msg=update.message
-        if id in self.__save_data:
-            if self.__save_data[id]["type"] == "emails":
-                logging.error(f"[U:{update.effective_user.username}] save emails to DB")
-                self.db.add_emails(self.__save_data[id]["list"])
-                del self.__save_data[id]
-                msg.reply_text("Сохранено")
-            elif self.__save_data[id]["type"] == "phones":
-                logging.error(f"[U:{update.effective_user.username}] save phones to DB")
-                self.db.add_phones(self.__save_data[id]["list"])
-                del self.__save_data[id]
-                msg.reply_text("Сохранено")
+        save_data=self.sessions.get("save", id)
+        if save_data:
+            # найденное в тексте или повторный поиск в файле
+            if save_data.get("file"):
+                if not os.path.exists(save_data["file"]):
+                    # файл удален (перезапуск) или сессия с другого хоста
+                    self.sessions.pop("save", id)
+                    self.reply(msg, "Файл больше недоступен, пришлите его еще раз")
+                    return
+                records=self.extractor.scan_file(save_data["file"], save_data["type"])
             else:
-                logging.error(f"[U:{update.effective_user.username}] save to DB unknown type {self.__save_data[id]['type']}")
-                msg.reply_text("Неизвестная ошибка")
+                records=save_data["list"]
+            if save_data["type"] == "emails":
+                logging.info("[U:%s] save emails to DB", update.effective_user.username)
+                saved=self.db.add_emails(records)
+                self.drop_save_data(self.sessions.pop("save", id))
+                self.reply(msg, f"Сохранено: новых {saved['new']}, уже было {saved['existing']}")
+            elif save_data["type"] == "phones":
+                logging.info("[U:%s] save phones to DB", update.effective_user.username)
+                saved=self.db.add_phones(records)
+                self.drop_save_data(self.sessions.pop("save", id))
+                self.reply(msg, f"Сохранено: новых {saved['new']}, уже было {saved['existing']}")
+            else:
+                logging.error("[U:%s] save to DB unknown type %s", update.effective_user.username, save_data['type'])
+                self.reply(msg, "Неизвестная ошибка")
         else:
-            logging.error(f"[U:{update.effective_user.username}] save to DB unknown id {id}")
-            msg.reply_text("Неизвестная ошибка")
+            logging.warning("[U:%s] save to DB unknown id %s", update.effective_user.username, id)
+            self.reply(msg, "Неизвестная ошибка")
 
     ##
     # Поиск Email`ов
@@ -311,39 +3386,50 @@ class bot:
     def find_email(self, update: Update, context):
         """/find_email - получение и проверка ввода пользователя"""
         input = update.message.text
-        reply=self.find_re_report(input, self.email_regex, update.effective_user.id, "emails")
+        reply=self.find_re_report(input, "emails", update.effective_user.id)
         if not reply:
-            logging.info(f"[U:{update.effective_user.username}] find_email: not found")
-            update.message.reply_text("Не найдены email-адреса")
+            logging.info("[U:%s] find_email: not found", update.effective_user.username)
+            self.reply(update.message, "Не найдены email-адреса")
             return
-        update.message.reply_text(reply,
+        self.reply(update.message, reply,
                                   reply_markup=InlineKeyboardMarkup(
                                             [
                                                 [InlineKeyboardButton(f"Сохранить результат", callback_data="save_search")]
                                             ]
                                         )
                                     )
-        logging.info(f"[U:{update.effective_user.username}] find_email: end")
+        logging.info("[U:%s] find_email: end", update.effective_user.username)
         return ConversationHandler.END
 
     def do_find_email(self, update: Update, context):
         """/find_email - инициализация диалога"""
-        logging.info(f"[U:{update.effective_user.username}] find_email: start")
-        update.message.reply_text(f'Введите текст для поиска email-адресов')
+        logging.info("[U:%s] find_email: start", update.effective_user.username)
+        self.reply(update.message, f'Введите текст или пришлите файл для поиска email-адресов')
         return 'find_email'
 
+    # строк сохраненных записей на странице: id + record VARCHAR(64) гарантированно
+    # укладываются в страницу, поэтому количество страниц можно оценить заранее
+    records_per_page=35
+
+    def records_report(self, update: Update, context, rows, count: int=None):
+        """Постраничный вывод записей из БД
+
+        :param rows: итератор записей (id, record)
+        :param count: оценка количества записей
+        """
+        first=next(rows, None)
+        if first is None:
+            self.reply(update.message, "Нет данных")
+            return
+        lines=(f"{row[0]}. {row[1]}" for row in itertools.chain([first], rows))
+        estimate=-(-count//self.records_per_page) if count else None
+        self.more(update.effective_user.id, lines, max_lines=self.records_per_page, estimate=estimate)
+        self.do_more(update, context)
+
     def do_get_emails(self, update: Update, context):
         """/get_emails - получение из БД"""
-        logging.info(f"[U:{update.effective_user.username}] get_emails")
-        rows=self.db.get_emails()
-        output=""
-        if rows:
-            # формируем вывод
-            for i in range(len(rows)):
-                output += f"{rows[i][0]}. {rows[i][1]}\n"
-        else:
-            output="Нет данных"
-        update.message.reply_text(output)
+        logging.info("[U:%s] get_emails", update.effective_user.username)
+        self.records_report(update, context, self.db.get_emails(), self.db.count_estimate(self.db.email_tbl))
 
     ##
     # Поиск номеров телефонов
@@ -351,39 +3437,31 @@ class bot:
     def find_phone_number(self, update: Update, context):
         """/find_phone_number - получение и проверка ввода пользователя"""
         input = update.message.text
-        reply=self.find_re_report(input, self.phone_number_regex, update.effective_user.id, "phones")
+        reply=self.find_re_report(input, "phones", update.effective_user.id)
         if not reply:
-            logging.info(f"[U:{update.effective_user.username}] find_phone_number: not found")
-            update.message.reply_text("Не найдены номера телефонов")
+            logging.info("[U:%s] find_phone_number: not found", update.effective_user.username)
+            self.reply(update.message, "Не найдены номера телефонов")
             return
-        update.message.reply_text(reply,
+        self.reply(update.message, reply,
                                   reply_markup=InlineKeyboardMarkup(
                                             [
                                                 [InlineKeyboardButton(f"Сохранить результат", callback_data="save_search")]
                                             ]
                                         )
                                     )        
-        logging.info(f"[U:{update.effective_user.username}] find_phone_number: end")
+        logging.info("[U:%s] find_phone_number: end", update.effective_user.username)
         return ConversationHandler.END
     
     def do_find_phone_number(self, update: Update, context):
         """/find_phone_number - инициализация диалога"""
-        logging.info(f"[U:{update.effective_user.username}] find_phone_number: start")
-        update.message.reply_text(f'Введите текст для поиска номеров телефона')
+        logging.info("[U:%s] find_phone_number: start", update.effective_user.username)
+        self.reply(update.message, f'Введите текст или пришлите файл для поиска номеров телефона')
         return 'find_phone_number'
 
     def do_get_phones(self, update: Update, context):
         """/get_phones - получение из БД"""
-        logging.info(f"[U:{update.effective_user.username}] get_phones")
-        rows=self.db.get_phones()
-        output=""
-        if rows:
-            # формируем вывод
-            for i in range(len(rows)):
-                output += f"{rows[i][0]}. {rows[i][1]}\n"
-        else:
-            output="Нет данных"
-        update.message.reply_text(output)
+        logging.info("[U:%s] get_phones", update.effective_user.username)
+        self.records_report(update, context, self.db.get_phones(), self.db.count_estimate(self.db.phones_tbl))
 
     ##
     # Проверка сложности пароля
@@ -395,69 +3473,32 @@ class bot:
         passed_tests=0
         for test in self.password_verify_complexity_tests:
             if test.findall(input): passed_tests += 1
-        logging.info(f"[U:{update.effective_user.username}] verify_password: passed {passed_tests}")
+        logging.info("[U:%s] verify_password: passed %s", update.effective_user.username, passed_tests)
         # количество пройденных тестов должно совпадать с количеством
         if passed_tests == len(self.password_verify_complexity_tests):
-            update.message.reply_text("Пароль сложный")
+            self.reply(update.message, "Пароль сложный")
         else:
-            update.message.reply_text("Пароль простой")
-        logging.info(f"[U:{update.effective_user.username}] verify_password: end")
+            self.reply(update.message, "Пароль простой")
+        logging.info("[U:%s] verify_password: end", update.effective_user.username)
         return ConversationHandler.END
 
     def do_verify_password(self, update: Update, context):
         """/verify_password - инициализация диалога"""
-        logging.info(f"[U:{update.effective_user.username}] verify_password: start")
-        update.message.reply_text(f'Введите пароль для проверки')
+        logging.info("[U:%s] verify_password: start", update.effective_user.username)
+        self.reply(update.message, f'Введите пароль для проверки')
         return 'verify_password'
 
-    def more(self, id, text:str, max_char:int=3096, max_lines:int=500):
+    def more(self, id, text, max_char:int=3096, max_lines:int=500, estimate:int=None):
         """Разбить вывод по строкам чтобы влезать в лимит сообщений
-        
+
         :param id: id буфера more
-        :param text: текст для разбивки
+        :param text: текст или итератор строк для разбивки
         :param max_char: максимальный размер одного блока
         :param max_lines: максимальное количество строк
+        :param estimate: оценка количества страниц
         """
-        lines_no_limits=text.splitlines()
-        logging.debug(f"more: input have {len(lines_no_limits)} lines in {len(text)} chars")
-        # делим строки при выходе за границы размера
-        lines=[]
-        for i in lines_no_limits:
-            if len(i) > max_char:
-                split_line_parts=len(i)//max_char + int(len(i)%max_char > 0)
-                logging.debug(f"more: split line ({len(i)} chars) to {split_line_parts} parts")
-                for j in range(split_line_parts):
-                    lines.append(i[j+max_char:(j+1)+max_char])
-            else:
-                lines.append(i)
-        lines_no_limits=None
-        logging.debug(f"more: output have {len(lines)} lines")
-        # теперь разбираемся с страницами
-        pages=[]
-        page=lines[0]
-        current_page_chars=len(lines[0])+1
-        current_page_lines=1
-        for i in range(1, (len(lines)-1)):
-            current_page_chars += len(lines[i])+1
-            current_page_lines += 1
-            # если переполнено
-            if (
-                ( current_page_chars >= max_char ) or
-                ( current_page_lines >= max_lines )
-            ):
-                # то новая страница
-                pages.append(page)
-                page=lines[i]
-                current_page_chars=len(lines[i])+1
-                current_page_lines=1
-            else:
-                # иначе - добавляем строку к текущей
-                page += f"\n{lines[i]}"
-        pages.append(page)
-        logging.debug(f"more: output have {len(pages)} pages")
-        self.__more_pages[id]={"pages":pages,"current": 1, "total": len(pages)}
+        self.pager.open(id, text, max_char, max_lines, estimate)
 
-    __more_pages={}
     def do_more(self, update: Update, context):
         """Команда поддержка работы кнопки more"""
         id=update.effective_user.id
@@ -466,50 +3507,77 @@ class bot:
             msg=update.callback_query.message
         else:
             msg=update.message
-        if id in self.__more_pages:
-            cur_more=self.__more_pages[id]            
-            if cur_more and (cur_more["total"]>1) and (cur_more["current"] < cur_more["total"]):
-                logging.debug(f"more: next_page")
-                msg.reply_text(
-                    f"```\n{cur_more['pages'][cur_more['current']-1]}\n```",
-                    parse_mode='MarkdownV2',
-                    reply_markup=InlineKeyboardMarkup(
-                            [
-                                [InlineKeyboardButton(f"--More-- Page {cur_more['current']} of {cur_more['total']}", callback_data="more")]
-                            ]
-                        )
-                    )
-                self.__more_pages[id]["current"] += 1
-            elif cur_more and (cur_more["current"] == cur_more["total"]):
-                msg.reply_text(
-                    f"```\n{cur_more['pages'][cur_more['current']-1]}\n```",
-                    parse_mode='MarkdownV2'
+        with metrics.timer("pager_page_seconds"):
+            page=self.pager.next_page(id)
+        if not page:
+            logging.debug("more: no new data - reset more")
+            self.reply(msg, f"No more data")
+            return
+        try:
+            self.__send_page(msg, page)
+        finally:
+            # страница отправлена - остаток вывода ssh-команды во временный файл, канал освобождается
+            self.pager.spool(id)
+
+    def __send_page(self, msg, page: dict):
+        """Отправка страницы с кнопкой --More--
+
+        :param msg: сообщение, на которое отвечать
+        :param page: страница из pager.next_page
+        """
+        if page["more"]:
+            logging.debug("more: next_page")
+            label=f"--More-- Page {page['current']}"
+            if page["total"]:
+                label += f" of {page['total']}"
+            elif page["estimate"]:
+                label += f" of ~{page['estimate']}"
+            self.reply(msg,
+                f"```\n{page['text']}\n```",
+                priority=sender.bulk,
+                parse_mode='MarkdownV2',
+                reply_markup=InlineKeyboardMarkup(
+                        [
+                            [InlineKeyboardButton(label, callback_data="more")]
+                        ]
                     )
-                if self.__more_pages[id]: del self.__more_pages[id]
-            else:
-                logging.debug(f"more: no new data - reset more")
-                if self.__more_pages[id]: del self.__more_pages[id]
-                msg.reply_text(f"No more data")
+                )
         else:
-            msg.reply_text(f"No more data")
+            self.reply(msg,
+                f"```\n{page['text']}\n```",
+                priority=sender.bulk,
+                parse_mode='MarkdownV2'
+                )
 
     ##
     # apt-list с поддержкой поиска
     ##
     def get_apt_list_filter(self, update: Update, context):
         input = update.message.text
-        logging.info(f"[U:{update.effective_user.username}] get_apt_list: do filter")
-        data=self.exec.run("apt list --installed {pkg} &>/dev/null && apt-cache show {pkg} || apt list | grep {pkg}", {"pkg": input})
-        if data:
-            self.more(update.effective_user.id,data)
-            self.do_more(update, context)
-        else:
-             update.message.reply_text("Недопустимые данные, попробуйте еще.")
+        logging.info("[U:%s] get_apt_list: do filter", update.effective_user.username)
+        if not self.exec.safe_args_regex.match(input):
+            self.reply(update.message, "Недопустимые данные, попробуйте еще.")
+            return "get_apt_list"
+        try:
+            # обновление индекса и apt-cache show - обращения к серверу
+            with self.admit(update):
+                found=self.apt.find(input)
+                if len(found) == 1:
+                    # один пакет - детальная информация
+                    self.more(update.effective_user.id,self.apt.show(found[0]))
+                    self.do_more(update, context)
+                elif found:
+                    self.more(update.effective_user.id,self.apt.lines(found))
+                    self.do_more(update, context)
+                else:
+                    self.reply(update.message, "Пакеты не найдены, попробуйте еще.")
+        except admission_rejected as e:
+            self.rejected(update, "get_apt_list", e)
         return "get_apt_list"
         
     def get_apt_list_end(self, update: Update, context):
-        logging.info(f"[U:{update.effective_user.username}] get_apt_list: end")
-        update.message.reply_text("Прекращаю работу с /get_apt_list")
+        logging.info("[U:%s] get_apt_list: end", update.effective_user.username)
+        self.reply(update.message, "Прекращаю работу с /get_apt_list")
         # сброс меню
         self.updater.bot.delete_my_commands(
             scope=BotCommandScopeChat(
@@ -521,61 +3589,86 @@ class bot:
     # меню для команды
     def do_get_apt_list(self, update: Update, context):
         """/get_apt_list - старт"""
-        logging.info(f"[U:{update.effective_user.username}] get_apt_list: start")
+        logging.info("[U:%s] get_apt_list: start", update.effective_user.username)
         # подсказка и данные
-        update.message.reply_text("Напечатайте уточнение для поиска\n"
-                                  +"Когда будет найден один пакет - будет выдана его детальная информация")
-        self.more(update.effective_user.id,self.exec.run("apt list --installed"))
-        self.do_more(update, context)
+        self.reply(update.message, "Напечатайте уточнение для поиска\n"
+                                   +"Когда будет найден один пакет - будет выдана его детальная информация")
+        try:
+            with self.admit(update):
+                self.more(update.effective_user.id,self.apt.installed())
+                self.do_more(update, context)
+        except admission_rejected as e:
+            self.rejected(update, "get_apt_list", e)
         return "get_apt_list"
 
     ##
     # Команда удаленного запуска
+    # ttl - время жизни кэшированного результата, секунд (без ttl - не кэшируется)
+    # journal/docker - инкрементальное чтение журнала по курсору пользователя,
+    # tail - записей при первом чтении, follow - подписка на новые записи
+    # cost - стоимость для допуска (нагрузка на сервер), по-умолчанию 1
+    # query - фильтры и ограничение на сервере, разбор вывода (host_query), state - состояние по-умолчанию
     ##
     __remote_exec_comm={
         'get_release': {
             "desc": "Релиз ОС",
             "cmd": 'cat /etc/*release*',
+            "ttl": 3600,
             },
         'get_uname': {
             "desc": "Архитектура процессора, имя хоста системы и версия ядра.",
             "cmd": 'uname -a',
+            "ttl": 3600,
             },
         'get_uptime': {
             "desc": "Время работы ОС",
             "cmd": 'uptime',
+            "ttl": 10,
             },
         'get_df': {
             "desc": "Использование файловой системы",
             "cmd": 'df -h',
+            "ttl": 30,
             },
         'get_free': {
             "desc": "Использование оперативной памяти",
             "cmd": 'free -m',
+            "ttl": 5,
             },
         'get_mpstat': {
             "desc": "Сбор информации о производительности",
             "cmd": 'mpstat',
+            "ttl": 2,
             },
         'get_w': {
             "desc": "Работающие пользователи",
             "cmd": 'w',
+            "ttl": 10,
             },
         'get_auths': {
             "desc": "События входа в систему",
             "cmd": 'journalctl --no-pager SYSLOG_FACILITY=10 -n 10',
+            "journal": 'SYSLOG_FACILITY=10',
+            "tail": 10,
             },
         'get_critical': {
             "desc": "Критические события системы",
             "cmd": 'journalctl --no-pager -p 2 -n5',
+            "journal": '-p 2',
+            "tail": 5,
+            "follow": True,
             },
         'get_ps': {
             "desc": "Информация о процессах",
             "cmd": 'ps -axf',
+            "query": "ps",
+            "cost": 3,
             },
         'get_ss': {
             "desc": "Информация об всех сокетах",
             "cmd": 'ss -a',
+            "query": "ss",
+            "cost": 3,
             },
         'get_ss_listen': {
             "desc": "Информация об прослушивателях",
@@ -583,28 +3676,341 @@ class bot:
             },
         'get_ss_connected': {
             "desc": "Информация об активных (connected) сокетах",
-            'cmd': 'ss state connected'
+            'cmd': 'ss state connected',
+            "query": "ss",
+            "state": "connected",
+            "cost": 2,
             },
         'get_services': {
             "desc": "Состояние сервисов",
-            "cmd": 'systemctl --no-pager --type=service'
+            "cmd": 'systemctl --no-pager --type=service',
+            "ttl": 30,
+            "cost": 2,
             },
         'get_repl_logs': {
             "desc": "Журнал лога БД репликации",
-            "cmd": 'docker logs the-laxian-key-db_main-1 2>&1 | grep -i replication | tail -n 10'
+            "cmd": 'docker logs --tail 10000 the-laxian-key-db_main-1 2>&1 | grep -i replication | tail -n 10',
+            "docker": 'the-laxian-key-db_main-1',
+            "grep": 'replication',
+            "tail": 10,
+            "cost": 2,
             },
     }
     def do_simple_remote_exec(self, update: Update, context):
         """/get_[имя]"""
         # проблема составными командами
         if not update.message.text:
-            logging.debug(f"[U:{update.effective_user.username}] do_simple_remote_exec: unknown {update.message.text}")
+            logging.debug("[U:%s] do_simple_remote_exec: unknown %s", update.effective_user.username, update.message.text)
             return
-        comm=update.message.text.split()[0][1:]
-        logging.info(f"[U:{update.effective_user.username}] do_simple_remote_exec: start {comm}")
+        comm, *args=update.message.text.split()
+        comm=comm[1:]
+        logging.info("[U:%s] do_simple_remote_exec: start %s %s", update.effective_user.username, comm, ' '.join(args),
+                     extra={"user": update.effective_user.id, "command": comm})
         if not self.__remote_exec_comm[comm]:
             raise BaseException("Неизвестная команда")
-        self.more(update.effective_user.id,self.exec.run(self.__remote_exec_comm[comm]["cmd"]))
+        spec=self.__remote_exec_comm[comm]
+        cmd=spec["cmd"]
+        ttl=spec.get("ttl")
+        id=update.effective_user.id
+        # аргументы: фильтры имя=значение, diff и цель (хост или группа)
+        diff="diff" in args
+        target=[i for i in args if "=" not in i and i != "diff"]
+        filters=dict(i.split("=", 1) for i in args if "=" in i)
+        render=None
+        if "query" in spec:
+            try:
+                cmd, render=self.query.build(spec["query"], filters, spec.get("state"))
+            except ValueError as e:
+                self.reply(update.message, f"{e}\n{self.query.usage[spec['query']]}")
+                return
+        elif filters:
+            self.reply(update.message, f"/{comm} не поддерживает фильтры")
+            return
+        # режим diff: только изменения вывода относительно прошлого снимка, сводка header не сравнивается
+        def show(data, header: str=None):
+            if diff:
+                data=self.snapshots.diff((id, comm, tuple(args)), data if isinstance(data, str) else "\n".join(data), header)
+            elif header:
+                data="\n".join([header]+([data] if data else []))
+            self.more(id, data)
+        # допуск только для обращений к серверу; слот удерживается до готовности вывода
+        def admitted(func):
+            with self.admit(update, self.__remote_exec_comm[comm].get("cost", 1)):
+                return func()
+        # фоновый замер читается один раз: между проверкой и чтением он может устареть
+        sample=self.sampled(self.config.ssh_host, comm)
+        try:
+            if target:
+                # хост, группа или список через запятую
+                names=self.fleet.resolve(target[0]) if self.exec.safe_args_regex.match(target[0]) else None
+                if not names:
+                    self.reply(update.message, f"Неизвестный хост или группа: {target[0]}\n"
+                                               +f"Группы: {', '.join(self.fleet.groups)}\nХосты: {', '.join(self.fleet.hosts)}")
+                    return
+                def fleet():
+                    summary, report=self.fleet_report(comm, cmd, ttl, names, render, timing=not diff)
+                    show(report, summary)
+                admitted(fleet)
+            elif render:
+                # вывод ограничен на сервере - читается целиком и разбирается
+                admitted(lambda: show(render(self.exec.run(cmd))))
+            elif "journal" in self.__remote_exec_comm[comm] or "docker" in self.__remote_exec_comm[comm]:
+                # только новое с прошлого запроса пользователя
+                def log():
+                    summary, lines=self.log_report(f"{id}.{comm}", self.__remote_exec_comm[comm])
+                    show(lines, summary)
+                admitted(log)
+            elif sample:
+                # ответ из фонового замера без SSH
+                data, age=sample
+                show(data if diff else f"[замер {age:.0f} с назад]\n{data}")
+            elif ttl:
+                # кэшируемая команда - общий результат для всех пользователей
+                data, age=self.cache.get(comm, ttl, lambda: admitted(lambda: self.exec.run(cmd)), retry=(admission_rejected,))
+                show(data if diff else f"[данные получены {age:.0f} с назад]\n{data}")
+            else:
+                # слот удерживается, пока вывод не выгружен и ssh-канал не освобожден
+                def stream():
+                    show(self.exec.run_stream(cmd))
+                    self.do_more(update, context)
+                admitted(stream)
+                return
+        except admission_rejected as e:
+            self.rejected(update, comm, e)
+            return
+        self.do_more(update, context)
+
+    def admit(self, update: Update, cost: float=1):
+        """Слот допуска обращения пользователя к серверу (admission.slot).
+        Об ожидании в очереди пользователь получает сообщение
+
+        :param update: обновление
+        :param cost: стоимость команды
+        """
+        return self.admission.slot(update.effective_user.id, cost,
+                                   lambda wait: self.reply(update.message, f"Сервер занят, ожидание в очереди ~{wait:.0f} с"))
+
+    def rejected(self, update: Update, comm: str, e: admission_rejected):
+        """Ответ на отказ в допуске
+
+        :param update: обновление
+        :param comm: команда
+        :param e: отказ
+        """
+        logging.warning("[U:%s] %s: rejected, wait %.0fs", update.effective_user.username, comm, e.wait)
+        self.reply(update.message, f"Слишком много запросов, повторите через {e.wait:.0f} с")
+
+    def fleet_report(self, comm: str, cmd: str, ttl: float, names: list, render=None, timing: bool=True):
+        """Запуск команды на нескольких хостах и общий отчет.
+        Возвращает сводку с ошибками и медленными хостами и вывод каждого хоста
+
+        :param comm: имя команды
+        :param cmd: командная строка
+        :param ttl: время жизни кэшированного результата (None - без кэша)
+        :param names: имена хостов
+        :param render: разбор и форматирование вывода хоста
+        :param timing: время ответа и возраст замера в выводе хостов (для diff - нет)
+        """
+        def run(name, exec):
+            sample=self.sampled(name, comm)
+            if sample:
+                return f"[замер {sample[1]:.0f} с назад]\n{sample[0]}" if timing else sample[0]
+            if ttl:
+                return self.cache.get((comm, name), ttl, lambda: exec.run(cmd, timeout=self.fleet.timeout))[0]
+            return exec.run(cmd, timeout=self.fleet.timeout)
+        results=self.fleet.run(names, run)
+        failed=[r for r in results if r["error"]]
+        summary=[f"Хостов: {len(results)}, успешно: {len(results)-len(failed)}"]
+        for r in failed:
+            summary.append(f"  {r['host']}: {r['error']}")
+        done=[r for r in results if not r["error"]]
+        if len(done) > 1:
+            slowest=max(done, key=lambda r: r["seconds"])
+            summary.append(f"Самый медленный: {slowest['host']} ({slowest['seconds']:.1f} с)")
+        report=[]
+        for r in done:
+            report.append(f"=== {r['host']} ({r['seconds']:.1f} с) ===" if timing else f"=== {r['host']} ===")
+            report.append(render(r["output"]) if render and r["output"] is not None else r["output"] or "")
+        return "\n".join(summary), "\n".join(report)
+
+    def fetch_log(self, spec: dict, cursor: str):
+        """Новые записи журнала с курсора. Возвращает записи и новый курсор
+
+        :param spec: описание команды (journal или docker)
+        :param cursor: курсор прошлого чтения (None - первое чтение)
+        """
+        if "journal" in spec:
+            return self.logs.journal(self.exec, spec["journal"], cursor, spec["tail"])
+        return self.logs.docker(self.exec, spec["docker"], spec["grep"], cursor, spec["tail"])
+
+    def read_log(self, key: str, spec: dict):
+        """Новые записи журнала с курсора. Курсор сохраняется в сессиях.
+        Возвращает записи и признак первого чтения
+
+        :param key: ключ курсора
+        :param spec: описание команды (journal или docker)
+        """
+        cursor=self.sessions.get("cursor", key)
+        lines, new=self.fetch_log(spec, cursor)
+        if new:
+            self.sessions.set("cursor", key, new)
+        return lines, cursor is None
+
+    def log_report(self, key: str, spec: dict):
+        """Отчет по новым записям журнала: сводка и записи
+
+        :param key: ключ курсора
+        :param spec: описание команды (journal или docker)
+        """
+        lines, first=self.read_log(key, spec)
+        if first:
+            return "Последние записи:", "\n".join(lines)
+        if not lines:
+            return "Новых записей нет", ""
+        return f"Новых записей: {len(lines)}", "\n".join(lines)
+
+    def do_follow(self, update: Update, context):
+        """/follow_[имя] - подписка чата на новые записи журнала и отписка"""
+        # /follow_critical@MyBot - без имени бота
+        comm="get_"+update.message.text.split()[0].split("@")[0][len("/follow_"):]
+        chat_id=update.effective_chat.id
+        with self.__follow_lock:
+            chats=self.follows.setdefault(comm, set())
+            enabled=chat_id not in chats
+            if enabled:
+                chats.add(chat_id)
+            else:
+                chats.discard(chat_id)
+            count=len(chats)
+        # подписки - в отдельной таблице: не вытесняются и переживают перезапуск
+        self.db.set_follow(comm, chat_id, enabled)
+        if enabled:
+            self.reply(update.message, f"Новые записи /{comm} будут присылаться в этот чат. Повтор команды - отписка")
+        else:
+            self.reply(update.message, f"Подписка на /{comm} отменена")
+        logging.info("[U:%s] follow %s: %s chats", update.effective_user.username, comm, count)
+
+    def follow_loop(self):
+        """Рассылка новых записей журналов подписанным чатам"""
+        while not self.__follow_stop.wait(self.config.follow_interval):
+            # подписки, сделанные через другие экземпляры бота
+            try:
+                follows=self.db.get_follows()
+                with self.__follow_lock:
+                    self.follows=follows
+            except psycopg2.Error as e:
+                logging.warning("follow: load subscriptions failed: %s", e)
+            for comm, spec in self.__remote_exec_comm.items():
+                with self.__follow_lock:
+                    chats=list(self.follows.get(comm, ())) if spec.get("follow") else None
+                if not chats:
+                    continue
+                # курсор - в таблице рядом с подписками: не вытесняется из сессий
+                try:
+                    cursor=self.db.get_follow_cursor(comm)
+                    lines, new=self.fetch_log(spec, cursor)
+                    if new and new != cursor:
+                        self.db.set_follow_cursor(comm, new)
+                except Exception as e:
+                    logging.warning("follow %s: read failed: %s", comm, e)
+                    continue
+                # первое чтение только устанавливает курсор
+                if cursor is None or not lines:
+                    continue
+                text=f"/{comm}: новых записей {len(lines)}\n"+"\n".join(lines[-50:])
+                for chat_id in chats:
+                    self.sender.send(chat_id, text[-4000:], sender.background)
+
+    def reply(self, message, text: str, priority: int=0, **kwargs):
+        """Ответ в чат сообщения: через очередь отправки, если она запущена
+
+        :param message: сообщение, на которое отвечаем
+        :param text: текст
+        :param priority: приоритет (sender.interactive, sender.bulk, sender.background)
+        :param kwargs: параметры send_message
+        """
+        if self.sender:
+            self.sender.send(message.chat_id, text, priority, **kwargs)
+        else:
+            message.reply_text(text, **kwargs)
+
+    def sampled(self, host: str, comm: str):
+        """Вывод команды из фонового замера и его возраст (None - нет замера)
+
+        :param host: имя хоста
+        :param comm: команда бота
+        """
+        return self.sampler.latest(host, comm) if self.sampler else None
+
+    ##
+    # История и тренды показателей хостов
+    ##
+    # период: число и единица (m, h, d)
+    window_regex=re.compile(r"^(\d+)([mhd])$")
+    # интервалов в истории
+    history_points=30
+
+    def sample_args(self, update: Update):
+        """Разбор аргументов /get_trend и /get_history: [период] [хост или группа].
+        Возвращает период в секундах, его запись и имена хостов или None с ответом об ошибке
+
+        :param update: обновление
+        """
+        args=update.message.text.split()[1:]
+        window="1h"
+        if args and self.window_regex.match(args[0]):
+            window=args.pop(0)
+        target=args[0] if args else self.config.collect_target
+        names=self.fleet.resolve(target) if self.exec.safe_args_regex.match(target) else None
+        if not names or len(args) > 1:
+            self.reply(update.message, "Формат: [период: 30m, 6h, 7d] [хост или группа]\n"
+                                       +f"Группы: {', '.join(self.fleet.groups)}\nХосты: {', '.join(self.fleet.hosts)}")
+            return None
+        m=self.window_regex.match(window)
+        seconds=int(m[1])*{"m": 60, "h": 3600, "d": 86400}[m[2]]
+        return seconds, window, names
+
+    def do_get_trend(self, update: Update, context):
+        """/get_trend - минимум, среднее и максимум показателей за период"""
+        logging.info("[U:%s] get_trend: start", update.effective_user.username)
+        args=self.sample_args(update)
+        if not args:
+            return
+        seconds, window, names=args
+        rows=self.db.sample_trend(names, seconds)
+        if not rows:
+            self.reply(update.message, f"Нет замеров за {window}")
+            return
+        report=[]
+        for row in rows:
+            report.append(f"{row[0]}: {row[1]} замеров за {window}, min / avg / max")
+            for i, name in enumerate(db.sample_metrics):
+                values=" / ".join("-" if v is None else f"{v:.1f}" for v in row[2+i*3:5+i*3])
+                report.append(f"  {name:14} {values}")
+        self.more(update.effective_user.id, "\n".join(report))
+        self.do_more(update, context)
+
+    def do_get_history(self, update: Update, context):
+        """/get_history - средние значения показателей по интервалам периода"""
+        logging.info("[U:%s] get_history: start", update.effective_user.username)
+        args=self.sample_args(update)
+        if not args:
+            return
+        seconds, window, names=args
+        step=max(seconds//self.history_points, self.config.collect_interval, 60)
+        rows=self.db.sample_history(names, seconds, step)
+        if not rows:
+            self.reply(update.message, f"Нет замеров за {window}")
+            return
+        report=[]
+        host=None
+        for row in rows:
+            if row[0] != host:
+                host=row[0]
+                report.append(f"{host}: время {' '.join(db.sample_metrics)}")
+            values=" ".join("-" if v is None else f"{v:.1f}" for v in row[2:])
+            report.append(f"  {row[1]:%d.%m %H:%M} {values}")
+        self.more(update.effective_user.id, "\n".join(report))
         self.do_more(update, context)
 
     ##
@@ -618,43 +4024,122 @@ class bot:
         :param cmd: имя команды
         :param decs: описание
         """
-        logging.debug(f"main_menu: adding {cmd}")
+        logging.debug("main_menu: adding %s", cmd)
         self.__bot_main_menu.append(BotCommand(command=cmd, description=desc))
     
     def main_menu(self):
-        """Основное меню"""
+        """Основное меню. Если хэш меню совпадает с сохраненным при прошлом запуске -
+        Telegram не вызывается"""
+        digest=hashlib.sha256(json.dumps([(i.command, i.description) for i in self.__bot_main_menu],
+                                         ensure_ascii=False).encode()).hexdigest()
+        if self.config.menu_hash_file:
+            try:
+                with open(self.config.menu_hash_file) as f:
+                    if f.read().strip() == digest:
+                        logging.debug("main_menu: unchanged, skip")
+                        return
+            except OSError:
+                pass
         # очистка списка команд
         logging.debug("main_menu: set default menu")
         # очистка меню по-уполномочию
         self.updater.bot.delete_my_commands()
         self.updater.bot.set_my_commands(commands=self.__bot_main_menu)
+        if self.config.menu_hash_file:
+            try:
+                with open(self.config.menu_hash_file, "w") as f:
+                    f.write(digest)
+            except OSError as e:
+                logging.warning("main_menu: unable to save hash: %s", e)
 
     def do_help(self, update: Update, context):
-        logging.info(f"[U:{update.effective_user.username}] help: start")
+        logging.info("[U:%s] help: start", update.effective_user.username)
         data="Справка по использованию бота:"
         for i in self.__bot_main_menu:
             data += f"\n/{i.command} - {i.description}"
-        update.message.reply_text(data)
+        data += ("\n\nКоманды удаленного запуска принимают хост или группу: /get_df all"
+                 +"\nи diff - только изменения с прошлого вызова: /get_services diff"
+                 +f"\nГруппы: {', '.join(self.config.ssh_groups)}"
+                 +f"\n\n/get_ps: {self.query.usage['ps']}\n/get_ss: {self.query.usage['ss']}")
+        self.reply(update.message, data)
 
     def do_cancel(self, update: Update, context):
         """Общая команда отмены диалога"""
-        logging.info(f"[U:{update.effective_user.username}] cancel ")
-        update.message.reply_text('Завершение диалога')
+        logging.info("[U:%s] cancel ", update.effective_user.username)
+        self.reply(update.message, 'Завершение диалога')
         return ConversationHandler.END
 
     ##
     # Инициализация класса
     ## 
-    def __init__(self, config: config):
-        """Инициализация бота
+    def setup(self, config: config):
+        """Инициализация внутренних компонентов бота (без telegram)
 
         :param config: класс с конфигурацией
         """
         # конфигурация
         self.config=config
+        # меню - свое у каждого экземпляра
+        self.__bot_main_menu=[]
+        # пул обработчиков (SSH, БД)
+        self.workers=executor(config, self.reply)
+        # поиск email и телефонов
+        self.extractor=extractor(
+            {"emails": self.email_regex.pattern, "phones": self.phone_number_regex.pattern},
+            {"emails": lambda v: db.normalize_email(v.rstrip(".-")), "phones": db.normalize_phone},
+            config
+        )
+        # хранилище сессий
+        self.sessions=session_store(config)
+        self.sessions.register("save", config.session_ttl, on_evict=self.drop_save_data, dump=lambda v: v, load=lambda v: v)
+        # постраничный вывод
+        self.pager=pager(config, self.sessions)
+        # кэш результатов удаленных команд
+        self.cache=result_cache()
+        # фоновый замер показателей хостов (запускается в start)
+        self.sampler=None
+        # допуск удаленных команд
+        self.admission=admission(config)
+        # процессы и сокеты с фильтрами на сервере
+        self.query=host_query()
+        # снимки вывода для режима diff
+        self.sessions.register("snapshot", config.snapshot_ttl, max_bytes=config.snapshot_memory)
+        self.snapshots=snapshot_diff(self.sessions)
+        # очередь отправки сообщений (запускается вместе с telegram)
+        self.sender=None
+        # журналы: курсоры пользователей и подписки чатов
+        self.logs=log_reader(config)
+        self.sessions.register("cursor", config.log_cursor_ttl, dump=lambda v: v, load=lambda v: v)
+        self.__follow_stop=threading.Event()
+        # подписки на журналы: команда - множество chat_id (копия таблицы follow)
+        self.follows={}
+        self.__follow_lock=threading.Lock()
+        # готовность: запуск завершен, обновления принимаются
+        self.ready=threading.Event()
+        metrics.gauge("bot_startup_seconds", "Время запуска бота до приема обновлений")
+        metrics.routes["/healthz"]=lambda: (200, "ok\n")
+        metrics.routes["/readyz"]=lambda: (200, "ready\n") if self.ready.is_set() else (503, "starting\n")
+        # метрика постраничного вывода
+        metrics.histogram("pager_page_seconds", "Подготовка страницы постраничного вывода")
+
+    def __init__(self, config: config):
+        """Инициализация бота
+
+        :param config: класс с конфигурацией
+        """
+        self.setup(config)
         # инициализация бота
         logging.debug("Инициализация бота")
-        self.updater = Updater(config.token, use_context=True)
+        self.updater = Updater(
+            config.token,
+            base_url=config.telegram_api_url and config.telegram_api_url.rstrip("/")+"/bot",
+            base_file_url=config.telegram_api_url and config.telegram_api_url.rstrip("/")+"/file/bot",
+            workers=config.bot_workers,
+            # ответы отправляются и из пула обработчиков
+            request_kwargs={"con_pool_size": config.bot_workers+config.workers+4},
+            use_context=True
+            )
+        self.sender=sender(config, self.updater.bot)
         dp = self.updater.dispatcher
         # общая функция отмены диалога
         cancel_conversation=CommandHandler('cancel', self.do_cancel)
@@ -663,35 +4148,41 @@ class bot:
         # регистрация /help
         dp.add_handler(CommandHandler("help", self.do_help))
         # регистрация кнопки save
-        dp.add_handler(CallbackQueryHandler(self.do_save_button, pattern="save_search"))
+        dp.add_handler(CallbackQueryHandler(self.workers.handler(self.do_save_button), pattern="save_search"))
         # регистрация /find_email
         self.register_to_main_menu("find_email", "Поиск email-адресов в тексте")
         dp.add_handler(
             ConversationHandler(
                 entry_points=[CommandHandler("find_email", self.do_find_email)],
                 states={
-                    'find_email': [MessageHandler(Filters.text & ~Filters.command, self.find_email)]
+                    'find_email': [
+                        MessageHandler(Filters.text & ~Filters.command, self.find_email),
+                        MessageHandler(Filters.document, self.workers.handler(self.find_email_document, ConversationHandler.END)),
+                    ]
                 },
                 fallbacks=[cancel_conversation]
             )
         )
         # регистрация /get_emails
         self.register_to_main_menu("get_emails", "Сохраненные email")
-        dp.add_handler(CommandHandler("get_emails", self.do_get_emails))
+        dp.add_handler(CommandHandler("get_emails", self.workers.handler(self.do_get_emails)))
         # регистрация /find_phone_number
         self.register_to_main_menu("find_phone_number", "Поиск телефонных номеров в тексте")
         dp.add_handler(
             ConversationHandler(
                 entry_points=[CommandHandler("find_phone_number", self.do_find_phone_number)],
                 states={
-                    'find_phone_number': [MessageHandler(Filters.text & ~Filters.command, self.find_phone_number)]
+                    'find_phone_number': [
+                        MessageHandler(Filters.text & ~Filters.command, self.find_phone_number),
+                        MessageHandler(Filters.document, self.workers.handler(self.find_phone_number_document, ConversationHandler.END)),
+                    ]
                 },
                 fallbacks=[]
             )
         )
         # регистрация /get_phones
         self.register_to_main_menu("get_phone_numbers", "Сохраненные телефонные номера")
-        dp.add_handler(CommandHandler("get_phone_numbers", self.do_get_phones))
+        dp.add_handler(CommandHandler("get_phone_numbers", self.workers.handler(self.do_get_phones)))
         
         # регистрация /verify_password
         self.register_to_main_menu("verify_password", "Проверка сложности пароля")
@@ -707,60 +4198,267 @@ class bot:
         # регистрация /вызова команд
         for comm in self.__remote_exec_comm:
             self.register_to_main_menu(comm, self.__remote_exec_comm[comm]["desc"])
-            dp.add_handler(CommandHandler(comm, self.do_simple_remote_exec))
+            dp.add_handler(CommandHandler(comm, self.workers.handler(self.do_simple_remote_exec)))
         # регистрация /get_apt_list
         self.register_to_main_menu("get_apt_list", "Вывод списка пакетов, поиск и вывод информации")
         dp.add_handler(
             ConversationHandler(
-                entry_points=[CommandHandler("get_apt_list", self.do_get_apt_list)],
+                entry_points=[CommandHandler("get_apt_list", self.workers.handler(self.do_get_apt_list, "get_apt_list"))],
                 states={
-                    'get_apt_list': [MessageHandler(Filters.text & ~Filters.command, self.get_apt_list_filter)],
+                    'get_apt_list': [MessageHandler(Filters.text & ~Filters.command, self.workers.handler(self.get_apt_list_filter, "get_apt_list"))],
                 },
                 fallbacks=[cancel_conversation]
             )
         )
+        # регистрация подписок на журналы
+        for comm in self.__remote_exec_comm:
+            if self.__remote_exec_comm[comm].get("follow") and config.follow_interval:
+                follow="follow_"+comm[len("get_"):]
+                self.register_to_main_menu(follow, f"Подписка на новые записи: {self.__remote_exec_comm[comm]['desc']}")
+                dp.add_handler(CommandHandler(follow, self.workers.handler(self.do_follow)))
+        # регистрация /get_trend и /get_history
+        self.register_to_main_menu("get_trend", "Минимум, среднее и максимум показателей хостов за период")
+        dp.add_handler(CommandHandler("get_trend", self.workers.handler(self.do_get_trend)))
+        self.register_to_main_menu("get_history", "История показателей хостов за период")
+        dp.add_handler(CommandHandler("get_history", self.workers.handler(self.do_get_history)))
         # подсказка по cancel
         self.register_to_main_menu("cancel", "Отмена ввода данных")
         # регистрация кнопки more
-        dp.add_handler(CallbackQueryHandler(self.do_more, pattern="more"))
-        # меню
-        self.main_menu()
+        dp.add_handler(CallbackQueryHandler(self.workers.handler(self.do_more), pattern="more"))
 
-    def start(self):
-        # база данных
+    def webhook_path(self):
+        """Путь webhook: без секрета обновления не принимаются"""
+        return f"/webhook/{self.config.webhook_secret}"
+
+    def start_updater(self):
+        """Запуск получения обновлений: long polling или webhook"""
+        if self.config.bot_mode != "webhook":
+            logging.info("Получение обновлений: polling")
+            self.updater.start_polling()
+            return
+        url=self.config.webhook_url.rstrip("/")+self.webhook_path()
+        logging.info("Получение обновлений: webhook на %s:%s", self.config.webhook_listen, self.config.webhook_port)
+        self.updater.start_webhook(
+            listen=self.config.webhook_listen,
+            port=self.config.webhook_port,
+            url_path=self.webhook_path(),
+            webhook_url=url,
+            max_connections=self.config.webhook_max_connections,
+            bootstrap_retries=3
+            )
+        self.check_webhook(url)
+
+    def check_webhook(self, url: str):
+        """Проверка webhook при запуске: локальный сервер отвечает,
+        в Telegram зарегистрирован нужный адрес
+
+        :param url: ожидаемый адрес webhook
+        """
+        # локальный сервер: GET на путь webhook - 405 (принимается только POST)
+        host="127.0.0.1" if self.config.webhook_listen in ("0.0.0.0", "") else self.config.webhook_listen
+        conn=http.client.HTTPConnection(host, self.config.webhook_port, timeout=5)
+        try:
+            conn.request("GET", self.webhook_path())
+            status=conn.getresponse().status
+        except OSError as e:
+            raise BaseException(f"Локальный сервер webhook недоступен: {e}")
+        finally:
+            conn.close()
+        if status != 405:
+            raise BaseException(f"Локальный сервер webhook: неожиданный ответ {status}")
+        # регистрация в Telegram
+        info=self.updater.bot.get_webhook_info()
+        if info.url != url:
+            raise BaseException("Webhook не зарегистрирован в Telegram")
+        if info.last_error_date:
+            logging.warning("webhook: last error %s: %s", time.ctime(info.last_error_date), info.last_error_message)
+        logging.info("webhook: registered, pending updates %s", info.pending_update_count)
+
+    def start_db(self):
+        """Подключение к БД и хранилищу сессий"""
         logging.info("Подключение к БД")
         self.db=db(self.config)
-        # инициализация удаленного запуска
+        self.follows=self.db.get_follows()
+        if self.config.session_backend == "postgres":
+            self.sessions.attach(self.db)
+
+    def start_remote(self):
+        """Инициализация удаленного запуска"""
         logging.info("Инициализация удаленного подключения")
         self.exec=remote_execution(self.config)
+        self.fleet=remote_fleet(self.config, self.exec)
+        self.apt=apt_index(self.exec, self.config)
+
+    def startup(self):
+        """Запуск без ожидания завершения: БД, SSH и меню - параллельно,
+        затем фоновые задачи и получение обновлений. Возвращает время запуска, секунд"""
+        started=time.monotonic()
+        self.clean_tmp()
+        # метрики и /healthz - сразу, /readyz - после запуска
+        if self.config.metrics_port:
+            metrics.serve(self.config.metrics_listen, self.config.metrics_port)
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as pool:
+            tasks=[pool.submit(i) for i in (self.start_db, self.start_remote, self.main_menu)]
+        # первая ошибка прерывает запуск
+        for i in tasks:
+            i.result()
+        if self.config.collect_interval:
+            self.sampler=host_sampler(self.config, self.fleet, self.db,
+                                      {i: self.__remote_exec_comm[i]["cmd"] for i in ("get_free", "get_uptime", "get_mpstat")})
+        if self.config.follow_interval:
+            threading.Thread(target=self.follow_loop, name="follow", daemon=True).start()
         # Запускаем бота
-        logging.info("Запуск бота")
-        self.updater.start_polling()
+        self.start_updater()
+        self.ready.set()
+        seconds=time.monotonic()-started
+        metrics.set("bot_startup_seconds", seconds)
+        logging.info("Запуск бота: %.3fs", seconds)
+        return seconds
+
+    def start(self):
+        self.startup()
         # Останавливаем бота при нажатии Ctrl+C
         self.updater.idle()
+        self.stop()
+
+    def stop(self):
+        """Остановка получения обновлений, фоновых задач и подключений"""
         logging.info("Прерывание работы")
+        self.ready.clear()
+        self.updater.stop()
+        self.__follow_stop.set()
+        metrics.close()
+        self.workers.close()
+        self.sender.close()
+        if self.sampler:
+            self.sampler.close()
+        self.fleet.close()
         self.exec.close()
         self.db.close()
 
+##
+# Логирование
+##
+class log_json_formatter(logging.Formatter):
+    """Запись журнала - одна строка JSON. Поля user, command, duration - из extra"""
+
+    # дополнительные поля записи
+    fields=("user", "command", "duration")
+
+    def format(self, record):
+        """Форматирование записи
+
+        :param record: запись журнала
+        """
+        data={
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for i in self.fields:
+            if hasattr(record, i):
+                data[i]=getattr(record, i)
+        if record.exc_info:
+            data["exception"]=self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class log_sampler(logging.Filter):
+    """Прореживание DEBUG-записей: для каждого вида (шаблона сообщения)
+    пропускается первая запись и далее каждая N-я. Остальные уровни - без изменений"""
+
+    # максимум отслеживаемых видов записей
+    max_kinds=10000
+
+    def filter(self, record):
+        """Пропуск записи
+
+        :param record: запись журнала
+        """
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        if not self.every:
+            return False
+        if len(self.__counts) > self.max_kinds:
+            self.__counts.clear()
+        count=self.__counts[record.msg]
+        self.__counts[record.msg]=count+1
+        return count % self.every == 0
+
+    ##
+    # Инициализация класса
+    ##
+    def __init__(self, rate: float):
+        """Инициализация
+
+        :param rate: доля сохраняемых записей (1 - все, 0 - ни одной)
+        """
+        super().__init__()
+        self.every=round(1/rate) if rate > 0 else 0
+        self.__counts=collections.Counter()
+
+class log_queue_handler(logging.handlers.QueueHandler):
+    """Передача записей в очередь без форматирования: сообщение собирается
+    и пишется в консоль/файл фоновым потоком QueueListener"""
+
+    def prepare(self, record):
+        """Запись передается как есть - в пределах процесса копия не нужна
+
+        :param record: запись журнала
+        """
+        return record
+
+def setup_logging(config: config, console: bool=True):
+    """Настройка журнала: обработчики только ставят записи в очередь,
+    форматирование и запись - в фоновом потоке. Возвращает запущенный QueueListener
+
+    :param config: конфигурация
+    :param console: вывод в консоль
+    """
+    if config.log_format == "json":
+        console_formatter=file_formatter=log_json_formatter()
+    else:
+        console_formatter=logging.Formatter(' %(asctime)s - %(levelname)s - %(message)s')
+        file_formatter=logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers=[]
+    if console:
+        handlers.append(logging.StreamHandler())
+        handlers[0].setFormatter(console_formatter)
+    # сохранение в файл с ротацией по размеру
+    if config.log_file:
+        if config.log_max_bytes:
+            file_handler=logging.handlers.RotatingFileHandler(config.log_file, maxBytes=config.log_max_bytes,
+                                                              backupCount=config.log_backups, encoding="utf-8")
+        else:
+            file_handler=logging.FileHandler(config.log_file, encoding="utf-8")
+        file_handler.setFormatter(file_formatter)
+        handlers.append(file_handler)
+    log_queue=queue.SimpleQueue()
+    handler=log_queue_handler(log_queue)
+    handler.addFilter(log_sampler(config.log_debug_sample))
+    logger=logging.getLogger()
+    for i in logger.handlers[:]:
+        logger.removeHandler(i)
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, config.log_level))
+    listener=logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
 def main():
-    # инициализация логирования в консоль
-    logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s - %(levelname)s - %(message)s')
     # загрузка конфигурации
     c=config()
-    # настойка уровня логирования
-    logger=logging.getLogger()
-    logger.setLevel(getattr(logging,c.log_level))
-    logging.debug(f"log_level: {c.log_level}")
-    # сохранение в файл
+    # логирование через очередь с фоновой записью
+    listener=setup_logging(c)
+    logging.debug("log_level: %s", c.log_level)
     if c.log_file:
-        logging.info(f"log to file: {c.log_file}")
-        logging_file_handler=logging.FileHandler(c.log_file)
-        logging_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        logging_file_handler.setLevel(getattr(logging,c.log_level))
-        logger.addHandler(logging_file_handler)
+        logging.info("log to file: %s", c.log_file)
     # инициализация бота
-    b=bot(c)
-    b.start()
+    try:
+        b=bot(c)
+        b.start()
+    finally:
+        listener.stop()
 
 if __name__ == '__main__':
     """ Запуск main()"""
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+"""Оффлайн-замеры производительности бота.
+
+Работает без telegram, ssh и PostgreSQL: update/context - поддельные,
+remote_execution и db - заглушки. Результат - JSON, режим сравнения
+отмечает регрессии относительно сохраненного базового замера.
+
+Запуск:
+    python3 bot/benchmark.py --output bench.json
+    python3 bot/benchmark.py --compare bench.json --threshold 0.2
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+import main
+
+
+class bench_config(main.config):
+    """Конфигурация без чтения окружения: значения по-умолчанию из config"""
+
+    token="123456:benchmark"
+    # поиск не прерывается по времени - замеряется полностью
+    extract_timeout=600
+
+    def __init__(self):
+        """Параметры БД берутся из окружения только для --postgres"""
+        self.db_host=os.environ.get("DB_HOST", "localhost")
+        self.db_port=int(os.environ.get("DB_PORT", self.db_port))
+        self.db_user=os.environ.get("DB_USER")
+        self.db_password=os.environ.get("DB_PASS")
+        self.db_database=os.environ.get("DB_DTBS")
+        self.db_schema=os.environ.get("DB_SCHM", self.db_schema)
+
+##
+# Поддельные объекты telegram
+##
+class fake_user:
+    """Пользователь"""
+    def __init__(self, id: int):
+        self.id=id
+        self.username=f"bench{id}"
+        self.full_name=f"Bench {id}"
+
+class fake_message:
+    """Сообщение: ответы запоминаются"""
+    def __init__(self, text: str=None):
+        self.text=text
+        self.document=None
+        self.replies=[]
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append((text, kwargs))
+
+class fake_update:
+    """Обновление"""
+    def __init__(self, user_id: int=1, text: str=None, callback: bool=False):
+        self.effective_user=fake_user(user_id)
+        self.effective_chat=self.effective_user
+        self.message=fake_message(text)
+        self.callback_query=None
+        if callback:
+            self.callback_query=type("callback_query", (), {"message": self.message, "data": "more"})()
+
+class fake_context:
+    """Контекст обработчика"""
+    bot=None
+    args=[]
+
+##
+# Заглушки удаленного запуска и БД
+##
+class stub_exec:
+    """Удаленный запуск: заранее заданный вывод"""
+    safe_args_regex=main.remote_execution.safe_args_regex
+
+    def __init__(self, output: str=""):
+        self.output=output
+
+    def run_stream(self, command: str, args: dict={}):
+        return iter(self.output.splitlines())
+
+    def run(self, command: str, args: dict={}):
+        return self.output
+
+    def close(self):
+        pass
+
+class fake_connection:
+    """Подключение psycopg2: только кодировка"""
+    encoding="UTF8"
+
+class fake_cursor:
+    """Курсор psycopg2 без сервера: достаточно для execute_values"""
+    connection=fake_connection()
+
+    def __init__(self, table: set):
+        self.table=table
+        self.pending=[]
+        self.result=[]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def mogrify(self, template, args):
+        self.pending.extend(args)
+        return template % tuple(("'"+str(i).replace("'", "''")+"'").encode() for i in args)
+
+    def execute(self, sql, args=None):
+        self.result=[]
+        for record in self.pending:
+            if record not in self.table:
+                self.table.add(record)
+                self.result.append((len(self.table),))
+        self.pending=[]
+
+    def fetchall(self):
+        return self.result
+
+class fake_db(main.db):
+    """БД в памяти: запросы выполняются поддельным курсором"""
+    def __init__(self, config):
+        self.config=config
+        self.tables={self.email_tbl: set(), self.phones_tbl: set()}
+        self.__table=None
+
+    def add_records(self, table: str, list: list):
+        self.__table=table
+        return super().add_records(table, list)
+
+    def run(self, func, read: bool=False):
+        return func(fake_cursor(self.tables[self.__table]))
+
+    def close(self):
+        pass
+
+class fake_records_db(fake_db):
+    """БД с большой таблицей записей: страницы keyset-запросов
+    строятся по id без хранения таблицы, запросы считаются"""
+    def __init__(self, config, count: int):
+        super().__init__(config)
+        self.count=count
+        self.queries=0
+
+    def get_records(self, table: str, after_id: int=0, limit: int=200):
+        self.queries += 1
+        return [(i, f"user{i}@example.com") for i in range(after_id+1, min(after_id+limit, self.count)+1)]
+
+    def count_estimate(self, table: str):
+        return self.count
+
+##
+# Локальная замена Telegram Bot API
+##
+class stub_bot_api:
+    """Bot API на локальном HTTP-сервере: getUpdates (long polling),
+    setWebhook с доставкой обновлений POST-запросом, sendMessage.
+    Время доставки ответа замеряется от отправки обновления"""
+
+    # максимальное ожидание getUpdates, секунд (короче - быстрее остановка updater)
+    max_poll=0.5
+
+    def __init__(self):
+        self.lock=threading.Condition()
+        self.updates=[]
+        self.update_id=0
+        self.webhook=""
+        self.replies=[]
+        stub=self
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length=int(self.headers.get("Content-Length", 0))
+                body=self.rfile.read(length) if length else b""
+                try:
+                    data=json.loads(body) if body else {}
+                except ValueError:
+                    data={}
+                result=stub.call(self.path.rsplit("/", 1)[-1], data)
+                answer=json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            def log_message(self, format, *args):
+                pass
+        self.server=http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url=f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def call(self, method: str, data: dict):
+        """Выполнение метода Bot API
+
+        :param method: имя метода
+        :param data: параметры
+        """
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            offset=int(data.get("offset") or 0)
+            deadline=time.monotonic()+min(float(data.get("timeout") or 0), self.max_poll)
+            with self.lock:
+                while True:
+                    updates=[i for i in self.updates if i["update_id"] >= offset]
+                    if updates or time.monotonic() >= deadline:
+                        return updates
+                    self.lock.wait(deadline-time.monotonic())
+        if method == "setWebhook":
+            self.webhook=data.get("url", "")
+            return True
+        if method == "deleteWebhook":
+            self.webhook=""
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook, "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "sendMessage":
+            with self.lock:
+                self.replies.append(time.perf_counter())
+                self.lock.notify_all()
+            return {"message_id": 1, "date": int(time.time()), "text": data.get("text", ""),
+                    "chat": {"id": data.get("chat_id"), "type": "private"}}
+        return True
+
+    def round_trip(self, text: str="/start", timeout: float=10):
+        """Отправка обновления и ожидание ответа бота. Возвращает задержку, секунд
+
+        :param text: текст сообщения
+        :param timeout: ограничение ожидания
+        """
+        with self.lock:
+            self.update_id += 1
+            replies=len(self.replies)
+            update={
+                "update_id": self.update_id,
+                "message": {
+                    "message_id": self.update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": 1, "type": "private"},
+                    "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+                    "text": text,
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else [],
+                },
+            }
+            started=time.perf_counter()
+            if not self.webhook:
+                self.updates=[update]
+                self.lock.notify_all()
+        if self.webhook:
+            request=urllib.request.Request(self.webhook, json.dumps(update).encode(), {"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=timeout).read()
+        with self.lock:
+            if not self.lock.wait_for(lambda: len(self.replies) > replies, timeout):
+                raise TimeoutError("бот не ответил")
+            return self.replies[replies]-started
+
+    def close(self):
+        """Остановка сервера"""
+        self.server.shutdown()
+
+##
+# Входные данные
+##
+def make_text(size: int):
+    """Текст заданного размера с email и телефонами
+
+    :param size: размер, байт
+    """
+    line=0
+    parts=[]
+    total=0
+    while total < size:
+        text=(f"{line:08d} Lorem ipsum dolor sit amet user{line % 997}@example{line % 13}.com "
+              +f"consectetur tel 8 (9{line % 100:02d}) {line % 1000:03d}-45-67 adipiscing elit\n")
+        parts.append(text)
+        total += len(text)
+        line += 1
+    return "".join(parts)[:size]
+
+def parse_size(text: str):
+    """Размер вида 10K, 1M
+
+    :param text: строка
+    """
+    units={"K": 1024, "M": 1024*1024}
+    if text[-1].upper() in units:
+        return int(float(text[:-1])*units[text[-1].upper()])
+    return int(text)
+
+def size_name(size: int):
+    """Имя размера для отчета
+
+    :param size: размер, байт
+    """
+    if size >= 1024*1024:
+        return f"{size//(1024*1024)}MB"
+    return f"{size//1024}KB"
+
+def make_bot(output: str=""):
+    """Бот без telegram с заглушками
+
+    :param output: вывод удаленных команд
+    """
+    b=main.bot.__new__(main.bot)
+    b.setup(bench_config())
+    b.exec=stub_exec(output)
+    b.db=fake_db(b.config)
+    return b
+
+##
+# Замеры: генераторы (имя, обработано байт, функция)
+##
+cases=[]
+def case(func):
+    """Регистрация замера"""
+    cases.append(func)
+    return func
+
+def selected(options, *names):
+    """Нужен ли хотя бы один из замеров по --filter.
+    Проверяется до подготовки данных и запуска серверов
+
+    :param options: параметры командной строки
+    :param names: имена замеров
+    """
+    return not options.filter or any(options.filter in i for i in names)
+
+@case
+def bench_find_re_report(sizes: list, options):
+    b=make_bot()
+    for size in sizes:
+        if not selected(options, *(f"find_re_report.{kind}.{size_name(size)}" for kind in ("emails", "phones"))):
+            continue
+        text=make_text(size)
+        for kind in ("emails", "phones"):
+            yield f"find_re_report.{kind}.{size_name(size)}", size, lambda text=text, kind=kind: b.find_re_report(text, kind, 1)
+
+@case
+def bench_verify_password(sizes: list, options):
+    b=make_bot()
+    updates=[fake_update(text=p) for p in ("qwerty", "Qwerty123!", "aaaaaaaaaaaaaaaaaaaa", "P@ssw0rd")*250]
+    def run():
+        for update in updates:
+            b.verify_password(update, fake_context())
+    yield "verify_password.1000", 0, run
+
+@case
+def bench_more(sizes: list, options):
+    for size in sizes:
+        if not selected(options, f"more.{size_name(size)}", f"more.first_page.{size_name(size)}"):
+            continue
+        b=make_bot()
+        text=make_text(size)
+        def run():
+            b.more(1, text)
+            update=fake_update(callback=True)
+            while True:
+                b.do_more(update, fake_context())
+                if not update.message.replies[-1][1].get("reply_markup"):
+                    break
+        yield f"more.{size_name(size)}", size, run
+        def first_page():
+            b.more(1, text)
+            b.do_more(fake_update(), fake_context())
+        yield f"more.first_page.{size_name(size)}", size, first_page
+
+@case
+def bench_records(sizes: list, options):
+    """Вывод большой таблицы (/get_emails): первая страница и листание.
+    Количество запросов к БД на первую страницу не должно зависеть от размера таблицы"""
+    count=200000
+    if not selected(options, "records.first_page.200k", "records.pages_10.200k"):
+        return
+    b=make_bot()
+    b.db=fake_records_db(b.config, count)
+    queries={}
+    def first_page():
+        b.db.queries=0
+        b.do_get_emails(fake_update(text="/get_emails"), fake_context())
+        queries["first_page"]=b.db.queries
+    yield "records.first_page.200k", 0, first_page
+    def pages():
+        b.db.queries=0
+        b.do_get_emails(fake_update(text="/get_emails"), fake_context())
+        update=fake_update(callback=True)
+        for i in range(9):
+            b.do_more(update, fake_context())
+        queries["pages_10"]=b.db.queries
+    yield "records.pages_10.200k", 0, pages
+    for name, value in queries.items():
+        print(f"{'records.'+name+'.queries':45} {value:10d}", file=sys.stderr)
+
+@case
+def bench_add_records(sizes: list, options):
+    if not selected(options, "db.add_records.1000", "db.add_records.10000"):
+        return
+    if options.postgres:
+        d=main.db(bench_config())
+    else:
+        d=fake_db(bench_config())
+    for count in (1000, 10000):
+        records=[f"user{i}@example.com" for i in range(count)]
+        yield f"db.add_records.{count}", 0, lambda records=records: d.add_emails(records)
+
+@case
+def bench_updates(sizes: list, options):
+    """Задержка доставки обновления до ответа: polling и webhook через локальный Bot API"""
+    if not selected(options, "telegram.polling.50_updates", "telegram.webhook.50_updates"):
+        return
+    stub=stub_bot_api()
+    for mode in ("polling", "webhook"):
+        if not selected(options, f"telegram.{mode}.50_updates"):
+            continue
+        c=bench_config()
+        c.telegram_api_url=stub.url
+        c.bot_mode=mode
+        c.webhook_listen="127.0.0.1"
+        c.webhook_port=stub.server.server_address[1]+1
+        c.webhook_url=f"http://127.0.0.1:{c.webhook_port}"
+        c.webhook_secret="benchmark-secret-path"
+        # замеряется доставка обновлений, не лимиты отправки в один чат
+        c.send_chat_rate=c.send_chat_burst=c.send_global_rate=1000
+        b=main.bot(c)
+        b.start_updater()
+        stub.round_trip()
+        latencies=[]
+        def run():
+            for i in range(50):
+                latencies.append(stub.round_trip())
+        yield f"telegram.{mode}.50_updates", 0, run
+        b.updater.stop()
+        b.workers.close()
+        b.sender.close()
+        if latencies:
+            latencies.sort()
+            print(f"{'telegram.'+mode+'.latency':45} p50 {latencies[len(latencies)//2]*1000:.2f} ms, "
+                  +f"p95 {latencies[int(len(latencies)*0.95)]*1000:.2f} ms", file=sys.stderr)
+    stub.close()
+
+@case
+def bench_logging(sizes: list, options):
+    """Затраты журнала на обновление: без журнала, синхронная запись в файл и очередь (text/json)"""
+    b=make_bot()
+    updates=[fake_update(text=p) for p in ("qwerty", "Qwerty123!", "aaaaaaaaaaaaaaaaaaaa", "P@ssw0rd")*250]
+    logger=logging.getLogger()
+    saved=(logger.handlers[:], logger.level)
+    seconds={}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("off", "sync_file", "queue_text", "queue_json"):
+            if not selected(options, f"logging.{mode}.1000_updates"):
+                continue
+            c=bench_config()
+            c.log_level="DEBUG"
+            c.log_file=os.path.join(tmp, f"{mode}.log")
+            listener=None
+            if mode == "off":
+                logger.handlers=[]
+                logger.setLevel(logging.CRITICAL)
+            elif mode == "sync_file":
+                # как до очереди: форматирование и запись в потоке обработчика
+                handler=logging.FileHandler(c.log_file)
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+                logger.handlers=[handler]
+                logger.setLevel(logging.DEBUG)
+            else:
+                c.log_format=mode.split("_")[1]
+                listener=main.setup_logging(c, console=False)
+            def run(mode=mode):
+                started=time.perf_counter()
+                for update in updates:
+                    b.verify_password(update, fake_context())
+                seconds.setdefault(mode, []).append(time.perf_counter()-started)
+            yield f"logging.{mode}.1000_updates", 0, run
+            if listener:
+                listener.stop()
+            for handler in logger.handlers:
+                handler.close()
+        logger.handlers, level=saved
+        logger.setLevel(level)
+    if "off" in seconds:
+        base=statistics.median(seconds["off"])
+        for mode, runs in seconds.items():
+            if mode != "off":
+                print(f"{'logging.'+mode+'.overhead':45} {(statistics.median(runs)-base)/len(updates)*1e6:10.2f} us/update", file=sys.stderr)
+
+@case
+def bench_startup(sizes: list, options):
+    """Запуск: импорт модуля в новом процессе и время до первого ответа.
+    Подключения к БД и SSH заменены задержкой connect_delay"""
+    connect_delay=0.2
+    code=f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(main.__file__))!r}); import main"
+    yield "startup.import_main", 0, lambda: subprocess.run([sys.executable, "-c", code], check=True)
+    if not selected(options, "startup.first_reply.menu_sync", "startup.first_reply.menu_cached"):
+        return
+    stub=stub_bot_api()
+    with tempfile.TemporaryDirectory() as tmp:
+        c=bench_config()
+        c.telegram_api_url=stub.url
+        c.collect_interval=c.follow_interval=0
+        c.menu_hash_file=os.path.join(tmp, "menu.sha256")
+        c.tmp_dir=tmp
+        c.send_chat_rate=c.send_chat_burst=c.send_global_rate=1000
+        def connect_db(b):
+            time.sleep(connect_delay)
+            b.db=fake_db(c)
+        def connect_remote(b):
+            time.sleep(connect_delay)
+            b.exec=stub_exec()
+            b.fleet=main.remote_fleet(c, b.exec)
+            b.apt=main.apt_index(b.exec, c)
+        for mode in ("menu_sync", "menu_cached"):
+            if not selected(options, f"startup.first_reply.{mode}"):
+                continue
+            latencies=[]
+            def run(mode=mode):
+                if mode == "menu_sync" and os.path.exists(c.menu_hash_file):
+                    os.remove(c.menu_hash_file)
+                started=time.perf_counter()
+                b=main.bot(c)
+                b.start_db=lambda: connect_db(b)
+                b.start_remote=lambda: connect_remote(b)
+                b.startup()
+                stub.round_trip()
+                latencies.append(time.perf_counter()-started)
+                b.stop()
+            yield f"startup.first_reply.{mode}", 0, run
+            if latencies:
+                print(f"{'startup.first_reply.'+mode:45} {statistics.median(latencies)*1000:10.2f} ms "
+                      +f"(connect_delay {connect_delay*1000:.0f} ms)", file=sys.stderr)
+    stub.close()
+
+##
+# Запуск и сравнение
+##
+def run_cases(options):
+    """Выполнение замеров
+
+    :param options: параметры командной строки
+    """
+    sizes=[parse_size(i) for i in options.sizes.split(",")]
+    results={}
+    for func in cases:
+        for name, size, run in func(sizes, options):
+            if options.filter and options.filter not in name:
+                continue
+            runs=[]
+            for i in range(options.repeat):
+                started=time.perf_counter()
+                run()
+                runs.append(time.perf_counter()-started)
+            median=statistics.median(runs)
+            results[name]={"seconds": median, "runs": runs}
+            if size:
+                results[name]["mb_s"]=size/median/1e6
+            print(f"{name:45} {median*1000:10.2f} ms", file=sys.stderr)
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": options.repeat,
+            "sizes": options.sizes,
+        },
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float):
+    """Сравнение с базовым замером. Возвращает список регрессий
+
+    :param current: текущий замер
+    :param baseline: базовый замер
+    :param threshold: допустимое относительное замедление
+    """
+    regressions=[]
+    for name, result in current["results"].items():
+        base=baseline["results"].get(name)
+        if not base:
+            continue
+        ratio=result["seconds"]/base["seconds"]
+        mark="REGRESSION" if ratio > 1+threshold else ""
+        print(f"{name:45} {base['seconds']*1000:10.2f} -> {result['seconds']*1000:10.2f} ms  x{ratio:.2f} {mark}", file=sys.stderr)
+        if mark:
+            regressions.append(name)
+    return regressions
+
+def main_benchmark():
+    parser=argparse.ArgumentParser(description="Оффлайн-замеры производительности бота")
+    parser.add_argument("--sizes", default="10K,1M,10M,50M", help="размеры входных данных (10K,1M,...)")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов каждого замера (берется медиана)")
+    parser.add_argument("--filter", default=None, help="только замеры, содержащие строку")
+    parser.add_argument("--output", default=None, help="файл результата JSON (по-умолчанию stdout)")
+    parser.add_argument("--compare", default=None, help="базовый замер JSON для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    parser.add_argument("--postgres", action="store_true", help="db.add_records на реальной БД (DB_* из окружения)")
+    options=parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    result=run_cases(options)
+    data=json.dumps(result, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline=json.load(f)
+        regressions=compare(result, baseline, options.threshold)
+        if regressions:
+            print(f"Регрессии: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    """ Запуск замеров"""
+    main_benchmark()